@@ -38,6 +38,8 @@ if __name__ == "__main__":
                 "neo4j==5.16.0",
                 "responses<0.19",
                 "py2neo==2021.2.4",
+                "aiohttp",
+                "pyarrow",
                 # "jupyterlab",
                 # "ipykernel",
                 # # for jupyter lab
@@ -1,11 +1,14 @@
 import os
-from typing import Dict
+from contextlib import nullcontext
+from typing import ContextManager, Dict, List, Union
 
 import requests
 from dotenv import load_dotenv
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 
+from ..common.http_cache import BaseHTTPCache, CachedSession
+
 load_dotenv()
 FROM = os.getenv("FROM")
 
@@ -15,12 +18,29 @@ class Service:
     Generic class for REST services.
     """
 
-    def __init__(self, REST_URL: str = "", HEADERS: Dict[str, str] = {}):
+    def __init__(
+        self,
+        REST_URL: str = "",
+        HEADERS: Dict[str, str] = {},
+        cache: Union[BaseHTTPCache, None] = None,
+    ):
         self.REST_URL = REST_URL
         self.HEADERS = HEADERS
-        self.retry_request = self.requests_retry_session()
+        self.cache = cache
+        self.retry_request = self.requests_retry_session(
+            session=CachedSession(cache) if cache is not None else None
+        )
         self.retry_request.headers.update(self.HEADERS)
 
+    def prefetch(
+        self, urls: List[str], params: Union[List[dict], None] = None
+    ) -> ContextManager:
+        """Context in which the GET requests of the urls use cache entries looked up at once,
+        see `CachedSession.prefetch`. Does nothing without cache."""
+        if isinstance(self.retry_request, CachedSession):
+            return self.retry_request.prefetch(urls, params)
+        return nullcontext()
+
     def requests_retry_session(
         self,
         retries=4,
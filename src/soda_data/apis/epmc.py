@@ -1,6 +1,9 @@
+from typing import Dict, List, Union
+
 from requests.models import Response
 
 from . import FROM, Service
+from ..common.http_cache import BaseHTTPCache
 from ..sdneo.api_utils import remove_whitespace
 
 
@@ -9,33 +12,48 @@ class EPMC(Service):
     Service to retrieve data from EuropePMC.
     """
 
-    def __init__(self):
+    def __init__(self, cache: Union[BaseHTTPCache, None] = None):
         self.REST_URL = "https://www.ebi.ac.uk/europepmc/webservices/rest/search"
         self.HEADERS = {"From": FROM, "Content-type": "application/json;charset=UTF-8"}
-        Service.__init__(self, self.REST_URL, self.HEADERS)
+        Service.__init__(self, self.REST_URL, self.HEADERS, cache=cache)
+
+    NO_ABSTRACT = "No abstract foind for this DOI."
 
-    def _search(self, query: str, limit: int = 1) -> Response:
+    def _search(
+        self, query: str, limit: int = 1, cursor_mark: Union[str, None] = None
+    ) -> Response:
         """Search for data in EuropePMC.
 
         Args:
             query (str): Query string in format used by EuropePMC.
             limit (int, optional): Maximum number of results returned. Defaults to 1.
+            cursor_mark (str, optional): Cursor of the page of results to return,
+                "*" for the first one. Defaults to None.
 
         Returns:
             Response: EuropePMC response.
         """
-        params = {
-            "query": query,
-            "resultType": "core",
-            "format": "json",
-            "pageSize": limit,
-        }
+        params = self._search_params(query, limit, cursor_mark)
         print(self.REST_URL, self.HEADERS, params)
         response = self.retry_request.get(
             self.REST_URL, params=params, headers=self.HEADERS, timeout=30
         )  # EuropePMC accepts only POST
         return response
 
+    @staticmethod
+    def _search_params(
+        query: str, limit: int = 1, cursor_mark: Union[str, None] = None
+    ) -> Dict[str, Union[str, int]]:
+        params: Dict[str, Union[str, int]] = {
+            "query": query,
+            "resultType": "core",
+            "format": "json",
+            "pageSize": limit,
+        }
+        if cursor_mark is not None:
+            params["cursorMark"] = cursor_mark
+        return params
+
     def get_abstract(self, doi: str) -> str:
         """Get abstract for a given DOI."""
         abstract = ""
@@ -46,7 +64,47 @@ class EPMC(Service):
             abstract = response_json["resultList"]["result"][0].get("abstractText", "")
             return remove_whitespace(abstract)
         else:
-            return "No abstract foind for this DOI."
+            return self.NO_ABSTRACT
+
+    def get_abstracts(
+        self, dois: List[str], chunk_size: int = 100, page_size: int = 1000
+    ) -> Dict[str, str]:
+        """Get the abstracts of several DOIs with a few OR-joined queries.
+
+        Args:
+            dois (List[str]): The DOIs.
+            chunk_size (int, optional): Number of DOIs per query. Defaults to 100.
+            page_size (int, optional): Number of results per page, at most 1000. Defaults to 1000.
+
+        Returns:
+            Dict[str, str]: The abstract of each DOI, as returned by `get_abstract`.
+        """
+        unique_dois = list(dict.fromkeys(dois))
+        found: Dict[str, str] = {}
+        queries = [
+            " OR ".join(f'DOI:"{doi}"' for doi in unique_dois[start:start + chunk_size])
+            for start in range(0, len(unique_dois), chunk_size)
+        ]
+        # the cached first pages of all the queries are looked up at once
+        first_pages = [self._search_params(query, page_size, "*") for query in queries]
+        with self.prefetch([self.REST_URL] * len(queries), first_pages):
+            for query in queries:
+                cursor_mark = "*"
+                while True:
+                    response = self._search(query, limit=page_size, cursor_mark=cursor_mark)
+                    response.raise_for_status()
+                    response_json = response.json()
+                    results = response_json.get("resultList", {}).get("result", [])
+                    for result in results:
+                        doi = result.get("doi", "").lower()
+                        # keep the first hit, as get_abstract does
+                        if doi and doi not in found:
+                            found[doi] = remove_whitespace(result.get("abstractText", ""))
+                    next_cursor_mark = response_json.get("nextCursorMark")
+                    if not results or not next_cursor_mark or next_cursor_mark == cursor_mark:
+                        break
+                    cursor_mark = next_cursor_mark
+        return {doi: found.get(doi.lower(), self.NO_ABSTRACT) for doi in unique_dois}
 
 
 if __name__ == "__main__":
@@ -1,10 +1,15 @@
-from typing import List, Union
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
+from typing import Dict, List, Union
 
 import requests
 from requests.models import Response
 
 from . import FROM, Service
 from ..common import logging
+from ..common.http_cache import BaseHTTPCache
 from ..sdneo.api_utils import remove_whitespace
 
 logging.configure_logging()
@@ -14,10 +19,19 @@ logger = logging.get_logger(__name__)
 class Uniprot(Service):
     """This class is used to query the Uniprot REST API."""
 
-    def __init__(self):
+    def __init__(
+        self, cache: Union[BaseHTTPCache, None] = None, max_entries: int = 10000
+    ):
+        """
+        Args:
+            cache (BaseHTTPCache, optional): Cache of the HTTP responses. Defaults to None.
+            max_entries (int, optional): Number of parsed entries kept in memory,
+                least recently used first out. Defaults to 10000.
+        """
         self.REST_URL = "https://www.ebi.ac.uk/proteins/api/proteins"
         self.HEADERS = {"From": FROM, "Accept": "application/json"}
-        Service.__init__(self, self.REST_URL, self.HEADERS)
+        Service.__init__(self, self.REST_URL, self.HEADERS, cache=cache)
+        self._entries = _LRUMemo(max_entries)
 
     def _search(
         self, accession: Union[List[str], str], reviewed: str = "true"
@@ -56,99 +70,229 @@ class Uniprot(Service):
         """Generate the yaml file for the tests."""
         self._search(accession)
 
+    def get_entry(self, accession: str) -> "UniprotEntry":
+        """Get the entry of a protein, requested only once per accession.
+
+        Args:
+            accession (str): Accession number of the protein.
+
+        Raises:
+            requests.exceptions.HTTPError: If the request failed.
+
+        Returns:
+            UniprotEntry: The entry, empty if the accession was not found.
+        """
+        entry = self._entries.get(accession)
+        if entry is None:
+            response = self._search(accession)
+            try:
+                response.raise_for_status()
+            except requests.exceptions.HTTPError as http_err:
+                logger.debug(f"failed loading json object with status ({http_err})")
+                raise http_err
+            entry = UniprotEntry(self._response_to_dict(response))
+            self._entries.put(accession, entry)
+        return entry
+
+    def fetch_many(
+        self, accessions: List[str], batch_size: int = 100, max_concurrency: int = 4
+    ) -> Dict[str, "UniprotEntry"]:
+        """Get the entries of many proteins, requesting up to `batch_size` accessions at once.
+        Entries already in memory are not requested again and fetched entries are memoized.
+
+        Args:
+            accessions (List[str]): Accession numbers of the proteins.
+            batch_size (int, optional): Number of accessions per request, at most 100.
+                Defaults to 100.
+            max_concurrency (int, optional): Number of requests in flight. Defaults to 4.
+
+        Returns:
+            Dict[str, UniprotEntry]: The entry of each accession. Missing and obsolete
+                accessions get an empty entry. Secondary accessions get the entry of their
+                primary accession.
+        """
+        batch_size = min(batch_size, 100)
+        entries: Dict[str, UniprotEntry] = {}
+        to_fetch = []
+        for acc in dict.fromkeys(accessions):
+            entry = self._entries.get(acc)
+            if entry is not None:
+                entries[acc] = entry
+            else:
+                to_fetch.append(acc)
+        batches = [
+            to_fetch[start:start + batch_size]
+            for start in range(0, len(to_fetch), batch_size)
+        ]
+        # the cached responses of all the batches are looked up at once
+        with self.prefetch([self._batch_url(batch) for batch in batches]):
+            if max_concurrency > 1 and len(batches) > 1:
+                with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+                    for fetched in executor.map(self._fetch_batch, batches):
+                        entries.update(fetched)
+            else:
+                for batch in batches:
+                    entries.update(self._fetch_batch(batch))
+        return {acc: entries[acc] for acc in dict.fromkeys(accessions)}
+
+    def _batch_url(self, accessions: List[str], reviewed: str = "true") -> str:
+        return f"{self.REST_URL}?accession={','.join(accessions)}&reviewed={reviewed}&size=100"
+
+    def _fetch_batch(
+        self, accessions: List[str], reviewed: str = "true"
+    ) -> Dict[str, "UniprotEntry"]:
+        """Requests a batch of accessions at once and memoizes their entries."""
+        request_url = self._batch_url(accessions, reviewed)
+        response = self.retry_request.get(request_url, headers=self.HEADERS, timeout=30)
+        if response.status_code == 404:
+            # none of the accessions was found
+            results = []
+        elif not response.ok:
+            # e.g. one of the accessions is malformed: fall back to one request per accession
+            logger.debug(f"batch request failed ({response.status_code}), fetching one by one")
+            entries = {}
+            for acc in accessions:
+                try:
+                    entries[acc] = self.get_entry(acc)
+                except requests.exceptions.HTTPError:
+                    entries[acc] = UniprotEntry({})
+                    self._entries.put(acc, entries[acc])
+            return entries
+        else:
+            results = response.json()
+        entries = {}
+        requested = set(accessions)
+        for data in results:
+            entry = UniprotEntry(data)
+            for acc in [entry.accession] + data.get("secondaryAccession", []):
+                if acc in requested and acc not in entries:
+                    entries[acc] = entry
+        for acc in accessions:
+            if acc not in entries:
+                logger.debug(f"{acc} not found in Uniprot")
+                entries[acc] = UniprotEntry({})
+            self._entries.put(acc, entries[acc])
+        return entries
+
     def get_recommended_names(self, accession: str) -> List[str]:
         """Get the recommended names of a protein."""
-        recommended_names = []
-        response = self._search(accession)
-        try:
-            response.raise_for_status()
-            response_json = self._response_to_dict(response)
-            if response_json:
-                protein = response_json.get("protein", {})
-                if protein:
-                    if isinstance(protein.get("recommendedName", {}), list):
-                        for recommended_name in protein.get("recommendedName", {}):
-                            if recommended_name:
-                                recommended_names.append(
-                                    remove_whitespace(
-                                        recommended_name["fullName"]["value"]
-                                    )
-                                )
-                    else:
-                        recommended_names.append(
-                            remove_whitespace(
-                                protein["recommendedName"]["fullName"]["value"]
-                            )
-                        )
-                    for alternative_name in protein.get("alternativeName", []):
-                        if alternative_name:
-                            recommended_names.append(
-                                remove_whitespace(alternative_name["fullName"]["value"])
-                            )
-                    return recommended_names
-                else:
-                    return []
-            else:
-                return []
-        except requests.exceptions.HTTPError as http_err:
-            logger.debug(f"failed loading json object with status ({http_err})")
-            raise http_err
+        return self.get_entry(accession).recommended_names
 
     def get_short_names(self, accession: str) -> List[str]:
         """Get the short names of a protein."""
-        short_names = []
-        response = self._search(accession)
-        try:
-            response.raise_for_status()
-            response_json = self._response_to_dict(response)
-            if response_json:
-                protein = response_json.get("protein", {})
-                if protein:
-                    for short_name in protein["recommendedName"].get("shortName", []):
-                        short_names.append(remove_whitespace(short_name["value"]))
-                    for alternative_name in protein.get("alternativeName", []):
-                        for short_name in alternative_name.get("shortName", []):
-                            short_names.append(remove_whitespace(short_name["value"]))
-            return short_names
-        except requests.exceptions.HTTPError as http_err:
-            logger.debug(f"failed loading json object with status ({http_err})")
-            raise http_err
+        return self.get_entry(accession).short_names
 
     def get_protein_function(self, accession: str) -> str:
         """Get the protein function of a protein."""
-        protein_functions = []
-        response = self._search(accession)
-        try:
-            response.raise_for_status()
-            response_json = self._response_to_dict(response)
-            if response_json:
-                comments = response_json.get("comments", {})
-                if comments:
-                    for comment in comments:
-                        if comment["type"] == "FUNCTION":
-                            for function in comment["text"]:
-                                protein_functions.append(
-                                    remove_whitespace(function["value"])
-                                )
-            return ". ".join(protein_functions)
-        except requests.exceptions.HTTPError as http_err:
-            logger.debug(f"failed loading json object with status ({http_err})")
-            raise http_err
+        return self.get_entry(accession).protein_function
 
     def _response_to_dict(self, response: Response) -> dict:
         """Convert the response to a dictionary."""
-        if isinstance(response.json(), list) and len(response.json()) > 0:
-            return response.json()[0]
-        elif isinstance(response.json(), list) and len(response.json()) == 0:
+        response_json = response.json()
+        if isinstance(response_json, list) and len(response_json) > 0:
+            return response_json[0]
+        elif isinstance(response_json, list) and len(response_json) == 0:
             return {}
-        elif isinstance(response.json(), dict):
-            return response.json()
+        elif isinstance(response_json, dict):
+            return response_json
         else:
             raise ValueError(
-                f"response json is not a list or dict but {type(response.json())}"
+                f"response json is not a list or dict but {type(response_json)}"
             )
 
 
+class UniprotEntry:
+    """A protein entry of the Uniprot REST API, parsed once."""
+
+    def __init__(self, data: dict):
+        self.data = data
+        self.accession = data.get("accession", "")
+
+    def __bool__(self) -> bool:
+        return bool(self.data)
+
+    @cached_property
+    def recommended_names(self) -> List[str]:
+        """The recommended and alternative full names of the protein."""
+        recommended_names = []
+        protein = self.data.get("protein", {})
+        if protein:
+            if isinstance(protein.get("recommendedName", {}), list):
+                for recommended_name in protein.get("recommendedName", {}):
+                    if recommended_name:
+                        recommended_names.append(
+                            remove_whitespace(recommended_name["fullName"]["value"])
+                        )
+            else:
+                recommended_names.append(
+                    remove_whitespace(protein["recommendedName"]["fullName"]["value"])
+                )
+            for alternative_name in protein.get("alternativeName", []):
+                if alternative_name:
+                    recommended_names.append(
+                        remove_whitespace(alternative_name["fullName"]["value"])
+                    )
+        return recommended_names
+
+    @cached_property
+    def short_names(self) -> List[str]:
+        """The recommended and alternative short names of the protein."""
+        short_names = []
+        protein = self.data.get("protein", {})
+        if protein:
+            for short_name in protein["recommendedName"].get("shortName", []):
+                short_names.append(remove_whitespace(short_name["value"]))
+            for alternative_name in protein.get("alternativeName", []):
+                for short_name in alternative_name.get("shortName", []):
+                    short_names.append(remove_whitespace(short_name["value"]))
+        return short_names
+
+    @cached_property
+    def protein_function(self) -> str:
+        """The function comments of the protein joined in a single text."""
+        protein_functions = []
+        for comment in self.data.get("comments", []):
+            if comment["type"] == "FUNCTION":
+                for function in comment["text"]:
+                    protein_functions.append(remove_whitespace(function["value"]))
+        return ". ".join(protein_functions)
+
+
+class _LRUMemo:
+    """Thread-safe memo keeping the `maxsize` most recently used items."""
+
+    def __init__(self, maxsize: int = 10000):
+        self.maxsize = maxsize
+        self._items: "OrderedDict[str, UniprotEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Union["UniprotEntry", None]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._items.move_to_end(key)
+            return item
+
+    def put(self, key: str, item: "UniprotEntry"):
+        with self._lock:
+            self._items[key] = item
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._items
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
 if __name__ == "__main__":
     uniprot = Uniprot()
     accessions = ["P34152", "P34153", "P34157", "P0DTC1"]
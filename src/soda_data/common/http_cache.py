@@ -0,0 +1,434 @@
+"""
+On-disk cache for the JSON documents downloaded from the SourceData, EuropePMC and UniProt APIs.
+
+Responses are stored in a SQLite database under the `CACHE` folder, keyed by the
+full request url (including the query parameters). Entries younger than `ttl` are
+served without contacting the server; older entries are revalidated with
+`If-None-Match` / `If-Modified-Since` when the server sent an `ETag` or a
+`Last-Modified` header. The least recently used entries are evicted when the
+cache grows beyond `max_size` bytes.
+
+`RedisHTTPCache` stores the same entries in Redis so that several processes
+or nodes share their lookups (requires the optional `redis` package).
+
+Usage:
+```python
+cache = HTTPCache()
+session = CachedSession(cache)
+response = session.get(url)
+with session.prefetch(urls):  # one lookup for all the urls
+    responses = [session.get(url) for url in urls]
+cache.stats()
+```
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from abc import ABC
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Union
+
+import requests
+from requests.models import PreparedRequest, Response
+from requests.structures import CaseInsensitiveDict
+
+from .. import CACHE
+from . import logging
+
+try:
+    import redis
+except ImportError:  # pragma: no cover
+    redis = None
+
+logging.configure_logging()
+logger = logging.get_logger(__name__)
+
+DEFAULT_TTL = 24 * 60 * 60
+DEFAULT_MAX_SIZE = 1024**3
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
+
+
+@dataclass
+class CacheEntry:
+    url: str
+    status: int
+    headers: Dict[str, str]
+    body: bytes
+    stored_at: float
+
+    @property
+    def etag(self) -> Union[str, None]:
+        return self.headers.get("ETag") or self.headers.get("etag")
+
+    @property
+    def last_modified(self) -> Union[str, None]:
+        return self.headers.get("Last-Modified") or self.headers.get("last-modified")
+
+    def to_response(self, request: PreparedRequest) -> Response:
+        """Rebuilds a `requests` response from the cached entry."""
+        response = Response()
+        response.status_code = self.status
+        response.reason = "OK"
+        response.headers = CaseInsensitiveDict(self.headers)
+        response._content = self.body
+        response.url = self.url
+        response.request = request
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.from_cache = True  # type: ignore
+        return response
+
+
+class BaseHTTPCache(ABC):
+    """Base class of the HTTP response caches used by `CachedSession`."""
+
+    def __init__(self, ttl: float = DEFAULT_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "revalidated": 0, "stores": 0, "evictions": 0}
+
+    @staticmethod
+    def key(url: str) -> str:
+        """Key of the entry for a given url, query parameters included."""
+        return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+    def get(self, url: str) -> Union[CacheEntry, None]:
+        """Returns the cached entry for a url, whether fresh or not, or None."""
+        raise NotImplementedError
+
+    def get_many(self, urls: List[str]) -> Dict[str, CacheEntry]:
+        """Returns the cached entries found for several urls."""
+        entries = {url: self.get(url) for url in urls}
+        return {url: entry for url, entry in entries.items() if entry is not None}
+
+    def set(self, url: str, response: Response):
+        """Stores a response."""
+        raise NotImplementedError
+
+    def touch(self, url: str):
+        """Marks an entry as fresh again after a successful revalidation."""
+        raise NotImplementedError
+
+    def is_fresh(self, entry: CacheEntry) -> bool:
+        return time.time() - entry.stored_at < self.ttl
+
+    def record(self, event: str):
+        with self._lock:
+            self._stats[event] += 1
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the hit/miss counters of this process."""
+        with self._lock:
+            return dict(self._stats)
+
+    def close(self):
+        pass
+
+
+class HTTPCache(BaseHTTPCache):
+    """
+    Size-bounded LRU cache of HTTP responses stored in SQLite.
+    """
+
+    def __init__(
+        self,
+        path: Union[str, None] = None,
+        ttl: float = DEFAULT_TTL,
+        max_size: int = DEFAULT_MAX_SIZE,
+    ):
+        """
+        Args:
+            path (str, optional): Path to the SQLite database.
+                Defaults to `http_cache.sqlite` in the `CACHE` folder.
+            ttl (float, optional): Number of seconds during which an entry is served
+                without revalidation. Defaults to one day.
+            max_size (int, optional): Maximum total size of the cached bodies in bytes.
+                Defaults to 1 GB.
+        """
+        super().__init__(ttl)
+        if path is None:
+            path = os.path.join(CACHE, "http_cache.sqlite")
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.path = path
+        self.max_size = max_size
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                url TEXT,
+                status INTEGER,
+                headers TEXT,
+                body BLOB,
+                size INTEGER,
+                stored_at REAL,
+                accessed_at REAL
+            )"""
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)"
+        )
+        self._conn.commit()
+
+    def get(self, url: str) -> Union[CacheEntry, None]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT url, status, headers, body, stored_at FROM responses WHERE key = ?",
+                (self.key(url),),
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE responses SET accessed_at = ? WHERE key = ?",
+                (time.time(), self.key(url)),
+            )
+            self._conn.commit()
+        url, status, headers, body, stored_at = row
+        return CacheEntry(url, status, json.loads(headers), body, stored_at)
+
+    def set(self, url: str, response: Response):
+        """Stores a response and evicts the least recently used entries if needed."""
+        body = response.content
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    self.key(url),
+                    url,
+                    response.status_code,
+                    json.dumps(dict(response.headers)),
+                    body,
+                    len(body),
+                    now,
+                    now,
+                ),
+            )
+            self._stats["stores"] += 1
+            self._evict()
+            self._conn.commit()
+
+    def touch(self, url: str):
+        with self._lock:
+            now = time.time()
+            self._conn.execute(
+                "UPDATE responses SET stored_at = ?, accessed_at = ? WHERE key = ?",
+                (now, now, self.key(url)),
+            )
+            self._conn.commit()
+
+    def _evict(self):
+        (total,) = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()
+        if total <= self.max_size:
+            return
+        for key, size in self._conn.execute(
+            "SELECT key, size FROM responses ORDER BY accessed_at ASC"
+        ).fetchall():
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._stats["evictions"] += 1
+            total -= size
+            if total <= self.max_size:
+                break
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the hit/miss counters and the current number and size of entries."""
+        with self._lock:
+            entries, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+            return {**self._stats, "entries": entries, "size": size}
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class RedisHTTPCache(BaseHTTPCache):
+    """
+    HTTP response cache stored in Redis and shared by all the processes using the same server.
+    Entries expire in Redis `ttl + stale_ttl` seconds after they were stored, so that they can
+    still be revalidated during `stale_ttl`. Eviction beyond the memory limit is left to
+    the `maxmemory-policy` of the server (e.g. `allkeys-lru`).
+    """
+
+    PREFIX = "soda_data:http:"
+
+    def __init__(
+        self,
+        url: str = REDIS_URL,
+        ttl: float = DEFAULT_TTL,
+        stale_ttl: float = 7 * DEFAULT_TTL,
+        compress_min_size: int = 1024,
+        client=None,
+    ):
+        """
+        Args:
+            url (str, optional): Url of the Redis server. Defaults to the `REDIS_URL` env variable
+                or the `redis` service of docker-compose.
+            ttl (float, optional): Number of seconds during which an entry is served
+                without revalidation. Defaults to one day.
+            stale_ttl (float, optional): Number of seconds during which an expired entry is kept
+                for revalidation. Defaults to one week.
+            compress_min_size (int, optional): Bodies larger than this number of bytes are stored
+                compressed with zlib. Defaults to 1024.
+            client (redis.Redis, optional): An existing Redis client (e.g. `fakeredis.FakeRedis`).
+                Defaults to None.
+        """
+        super().__init__(ttl)
+        if client is None:
+            if redis is None:
+                raise ImportError("RedisHTTPCache requires the redis package: pip install redis")
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.stale_ttl = stale_ttl
+        self.compress_min_size = compress_min_size
+
+    def _redis_key(self, url: str) -> str:
+        return self.PREFIX + self.key(url)
+
+    @staticmethod
+    def _decode(fields: Dict[bytes, bytes]) -> Union[CacheEntry, None]:
+        if not fields:
+            return None
+        body = fields[b"body"]
+        if fields.get(b"compressed") == b"1":
+            body = zlib.decompress(body)
+        return CacheEntry(
+            fields[b"url"].decode("utf-8"),
+            int(fields[b"status"]),
+            json.loads(fields[b"headers"]),
+            body,
+            float(fields[b"stored_at"]),
+        )
+
+    def get(self, url: str) -> Union[CacheEntry, None]:
+        return self._decode(self.client.hgetall(self._redis_key(url)))
+
+    def get_many(self, urls: List[str]) -> Dict[str, CacheEntry]:
+        """Returns the cached entries found for several urls in a single round trip."""
+        pipe = self.client.pipeline(transaction=False)
+        for url in urls:
+            pipe.hgetall(self._redis_key(url))
+        entries = {url: self._decode(fields) for url, fields in zip(urls, pipe.execute())}
+        return {url: entry for url, entry in entries.items() if entry is not None}
+
+    def set(self, url: str, response: Response):
+        body = response.content
+        compressed = len(body) >= self.compress_min_size
+        if compressed:
+            body = zlib.compress(body)
+        key = self._redis_key(url)
+        pipe = self.client.pipeline()
+        pipe.hset(
+            key,
+            mapping={
+                "url": url,
+                "status": response.status_code,
+                "headers": json.dumps(dict(response.headers)),
+                "body": body,
+                "compressed": int(compressed),
+                "stored_at": time.time(),
+            },
+        )
+        pipe.expire(key, int(self.ttl + self.stale_ttl))
+        pipe.execute()
+        self.record("stores")
+
+    def touch(self, url: str):
+        key = self._redis_key(url)
+        pipe = self.client.pipeline()
+        pipe.hset(key, "stored_at", time.time())
+        pipe.expire(key, int(self.ttl + self.stale_ttl))
+        pipe.execute()
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=self.PREFIX + "*"))
+        if keys:
+            self.client.delete(*keys)
+
+    def close(self):
+        self.client.close()
+
+
+class CachedSession(requests.Session):
+    """
+    A `requests.Session` serving GET requests from an `HTTPCache`.
+    Can be passed as `session` to the `requests_retry_session` helpers.
+    """
+
+    def __init__(self, cache: BaseHTTPCache):
+        super().__init__()
+        self.cache = cache
+        # entries looked up by `prefetch`, None for the urls missing from the cache
+        self._prefetched: Dict[str, Union[CacheEntry, None]] = {}
+        self._lock = threading.Lock()
+
+    def prepared_url(self, url: str, params: Union[dict, None] = None) -> str:
+        """The url of a GET request as sent by the session, which is the key of its entry."""
+        return self.prepare_request(requests.Request("GET", url, params=params)).url
+
+    @contextmanager
+    def prefetch(
+        self, urls: List[str], params: Union[List[dict], None] = None
+    ) -> Iterator[None]:
+        """Looks up several GET requests in the cache at once with `get_many`, a single round trip
+        with Redis. Within the context, these requests use the entries found instead of looking
+        them up one by one, and only the missing or stale ones are sent to the server.
+
+        Args:
+            urls (List[str]): Urls of the requests.
+            params (List[dict], optional): Query parameters of each request. Defaults to None.
+        """
+        if params is None:
+            params = [None] * len(urls)
+        keys = [self.prepared_url(url, p) for url, p in zip(urls, params)]
+        entries = self.cache.get_many(keys)
+        with self._lock:
+            self._prefetched.update({key: entries.get(key) for key in keys})
+        try:
+            yield
+        finally:
+            with self._lock:
+                for key in keys:
+                    self._prefetched.pop(key, None)
+
+    def _lookup(self, url: str) -> Union[CacheEntry, None]:
+        with self._lock:
+            if url in self._prefetched:
+                return self._prefetched.pop(url)
+        return self.cache.get(url)
+
+    def send(self, request: PreparedRequest, **kwargs) -> Response:
+        if request.method != "GET" or kwargs.get("stream") or request.url is None:
+            return super().send(request, **kwargs)
+        url = request.url
+        entry = self._lookup(url)
+        if entry is not None and self.cache.is_fresh(entry):
+            self.cache.record("hits")
+            return entry.to_response(request)
+        if entry is not None:
+            if entry.etag:
+                request.headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                request.headers["If-Modified-Since"] = entry.last_modified
+        response = super().send(request, **kwargs)
+        if entry is not None and response.status_code == 304:
+            self.cache.touch(url)
+            self.cache.record("revalidated")
+            return entry.to_response(request)
+        self.cache.record("misses")
+        if response.status_code == 200:
+            self.cache.set(url, response)
+        return response
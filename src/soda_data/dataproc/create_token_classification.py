@@ -4,15 +4,43 @@ from .token_classification import (
     DataGeneratorForPanelization,
 )
 from .xml_extract import SourceDataCodes as sdc
+from .xml_extract import XMLCorpus, write_datasets
+from .manifest import EncodingManifest
+from .shards import INDEX_FILE, changed_shards, read_index
 import os
+from typing import List, Tuple
 from .. import JSON_FOLDER
 from ..sdneo import HF_TOKEN
-from huggingface_hub import HfApi
+from huggingface_hub import HfApi, hf_hub_download
+from huggingface_hub.utils import EntryNotFoundError, HfHubHTTPError
 from ..common import logging
 
 logging.configure_logging()
 logger = logging.get_logger(__name__)
 
+TASKS = ["panelization", "ner", "roles_gene", "roles_small_mol", "roles_multi"]
+
+
+def shards_to_upload(repo_id: str, path_in_repo: str, task_dir: str, token: str) -> Tuple[List[str], List[str]]:
+    """Compares the index of the shards of a task with the one uploaded to the hub.
+
+    Returns:
+        Tuple[List[str], List[str]]: The new or changed shards, and the shards of the previous
+        upload that no longer exist, relative to the task folder.
+    """
+    shards = read_index(os.path.join(task_dir, INDEX_FILE))
+    try:
+        previous_index = hf_hub_download(
+            repo_id, f"{path_in_repo}/{INDEX_FILE}", repo_type="dataset", token=token
+        )
+        previous_shards = read_index(previous_index)
+    except (EntryNotFoundError, HfHubHTTPError):
+        previous_shards = {}
+    files = {shard["file"] for split in shards.values() for shard in split}
+    removed = [shard["file"] for split in previous_shards.values() for shard in split if shard["file"] not in files]
+    return changed_shards(shards, previous_shards), removed
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description="Converts XML data into AI ready data and uploads it to the huggingface repository.")
@@ -21,32 +49,29 @@ if __name__ == "__main__":
     parser.add_argument("--repo_name", default="", help="Name of the repository where the dataset will be uploaded.")
     parser.add_argument("--token", default="", help="Huggingface token to upload the dataset.")
     parser.add_argument("--patch_generic", action="store_true", help="Apply patches.")
+    parser.add_argument("--num_proc", type=int, default=1, help="Number of processes encoding the XML files.")
+    parser.add_argument("--format", default="jsonl", choices=["jsonl", "parquet"], help="Format of the data files.")
+    parser.add_argument("--max_shard_size", type=int, default=0, help="Maximum size of the shards in MB. Defaults to a single file per split.")
+    parser.add_argument("--compression", default=None, choices=["gzip", "zstd"], help="Compression of the data files.")
+    parser.add_argument("--incremental", action="store_true", help="Only encode the XML files changed since the last build.")
     args = parser.parse_args()
 
     # Instantiating the classes
     logger.info("""Instantiating the classes""")
     patch_generic = True if args.patch_generic else False
 
-    panelization = DataGeneratorForPanelization()
-    ner = DataGeneratorForTokenClassification(apply_generic_patch=patch_generic)
-    roles_gene = DataGeneratorForTokenClassification(code_map=sdc.GENEPROD_ROLES)  # type: ignore
-    roles_small_mol = DataGeneratorForTokenClassification(code_map=sdc.SMALL_MOL_ROLES)  # type: ignore
-    roles_multi = DataGeneratorForTokenClassification(roles="multiple")
+    # the XML files are parsed once and shared by all the generators, which are instantiated
+    # before any of them is used; each file is released once all of them have encoded it
+    corpus = XMLCorpus()
+    # the encodings of the previous build are recorded next to the split file
+    manifest = EncodingManifest() if args.incremental else None
+    panelization = DataGeneratorForPanelization(corpus=corpus, manifest=manifest)
+    ner = DataGeneratorForTokenClassification(apply_generic_patch=patch_generic, corpus=corpus, manifest=manifest)
+    roles_gene = DataGeneratorForTokenClassification(code_map=sdc.GENEPROD_ROLES, corpus=corpus, manifest=manifest)  # type: ignore
+    roles_small_mol = DataGeneratorForTokenClassification(code_map=sdc.SMALL_MOL_ROLES, corpus=corpus, manifest=manifest)  # type: ignore
+    roles_multi = DataGeneratorForTokenClassification(roles="multiple", corpus=corpus, manifest=manifest)
 
-    # Generate the datasets
-    logger.info("""Generating the datasets""")
-    logger.info("""Generating the panelization dataset""")
-    panelization_dataset = panelization.generate_dataset()
-    logger.info("""Generating the ner dataset""")
-    ner_dataset = ner.generate_dataset()
-    logger.info("""Generating the geneprod roles dataset""")
-    roles_gene_dataset = roles_gene.generate_dataset()
-    logger.info("""Generating the small molecule roles dataset""")
-    roles_small_mol_dataset = roles_small_mol.generate_dataset()
-    logger.info("""Generating the multi roles dataset""")
-    roles_multi_dataset = roles_multi.generate_dataset()
-
-    # Generate folder to store the jsonl data
+    # Generate folder to store the data files
     tclass_dir = os.path.join(JSON_FOLDER, f"{args.destination_dir}")
     if not os.path.exists(tclass_dir):
         os.mkdir(tclass_dir)
@@ -54,13 +79,33 @@ if __name__ == "__main__":
     if not os.path.exists(output_dir):
         os.mkdir(output_dir)
 
-    # Save the data to the folder
-    logger.info("""Writing the data to the folder""")
-    panelization.to_jsonl(panelization_dataset, os.path.join(output_dir, "panelization"))
-    ner.to_jsonl(ner_dataset, os.path.join(output_dir, "ner"))
-    roles_gene.to_jsonl(roles_gene_dataset, os.path.join(output_dir, "roles_gene"))
-    roles_small_mol.to_jsonl(roles_small_mol_dataset, os.path.join(output_dir, "roles_small_mol"))
-    roles_multi.to_jsonl(roles_multi_dataset, os.path.join(output_dir, "roles_multi"))
+    max_shard_size = args.max_shard_size * 1024**2 if args.max_shard_size else None
+
+    # Generate the datasets in a single pass over the XML files, writing the examples
+    # of every task to the folder as each file is encoded
+    logger.info("""Generating the datasets""")
+    generators = {
+        "panelization": panelization,
+        "ner": ner,
+        "roles_gene": roles_gene,
+        "roles_small_mol": roles_small_mol,
+        "roles_multi": roles_multi,
+    }
+    counts = write_datasets(
+        generators,
+        output_dir,
+        format=args.format,
+        num_proc=args.num_proc,
+        max_shard_size=max_shard_size,
+        compression=args.compression,
+    )
+    for task, task_counts in counts.items():
+        logger.info(f"""{task}: {task_counts}""")
+    logger.info(f"""Parsed {corpus.n_parsed} XML files""")
+    corpus.clear()
+    if manifest is not None:
+        logger.info(f"""Encodings reused from the last build: {manifest.stats()}""")
+        manifest.close()
 
     if args.repo_name:
         logger.info("""Uploading the data to the hub""")
@@ -72,10 +117,31 @@ if __name__ == "__main__":
         api = HfApi(
             token=args.token,
         )
-        api.upload_folder(
-            folder_path=tclass_dir,
-            path_in_repo="token_classification",
-            repo_id=args.repo_name,
-            repo_type="dataset",
-            token=token,
-        )
+        if max_shard_size is None:
+            api.upload_folder(
+                folder_path=tclass_dir,
+                path_in_repo="token_classification",
+                repo_id=args.repo_name,
+                repo_type="dataset",
+                token=token,
+            )
+        else:
+            # only the shards whose hash changed since the last upload are pushed
+            allow_patterns, delete_patterns = [], []
+            for task in TASKS:
+                task_path = f"v_{args.version}/{task}"
+                changed, removed = shards_to_upload(
+                    args.repo_name, f"token_classification/{task_path}", os.path.join(output_dir, task), token
+                )
+                logger.info(f"""{task}: {len(changed)} shards to upload, {len(removed)} to delete""")
+                allow_patterns += [f"{task_path}/{f}" for f in changed + [INDEX_FILE]]
+                delete_patterns += [f"{task_path}/{f}" for f in removed]
+            api.upload_folder(
+                folder_path=tclass_dir,
+                path_in_repo="token_classification",
+                repo_id=args.repo_name,
+                repo_type="dataset",
+                token=token,
+                allow_patterns=allow_patterns,
+                delete_patterns=delete_patterns or None,
+            )
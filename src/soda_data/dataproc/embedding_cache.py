@@ -0,0 +1,134 @@
+"""
+Persistent store of the caption embeddings computed for the NEL dataset.
+
+Captions rarely change between versions of the corpus, so the embeddings of a caption are
+stored on disk keyed by the model name, the sha256 of the caption and the windowing parameters.
+Rebuilding the dataset only runs the model on the captions that are new or were edited.
+
+The embeddings are appended as float16 to a single binary file that is memory-mapped for reading,
+so a lookup returns a view of the mapped file without copying it. An SQLite index records the offset
+and shape of the embeddings of each key.
+
+Usage:
+```python
+cache = EmbeddingCache(model_name="michiyasunaga/BioLinkBERT-base")
+embeddings = cache.get(caption, max_length=512, window=50)
+if embeddings is None:
+    cache.set(caption, compute_embeddings(caption), max_length=512, window=50)
+```
+"""
+import hashlib
+import json
+import os
+import sqlite3
+from typing import Dict, Union
+
+import numpy as np
+
+from .utils import SPLIT_FILE
+
+DTYPE = np.float16
+# bump when a change of the computation of the embeddings invalidates those already stored
+EMBEDDING_VERSION = 1
+
+
+class EmbeddingCache:
+    """
+    Caption embeddings stored as memory-mapped float16 arrays with an SQLite offset index.
+    """
+
+    def __init__(self, model_name: str, folder: Union[str, None] = None, commit_every: int = 100):
+        """
+        Args:
+            model_name (str): Name of the model computing the embeddings, part of the keys.
+            folder (str, optional): Folder of the store.
+                Defaults to `embedding_cache` in the folder of the split file.
+            commit_every (int, optional): Number of embeddings written between two commits of the index.
+                Defaults to 100.
+        """
+        if folder is None:
+            folder = os.path.join(os.path.dirname(SPLIT_FILE), "embedding_cache")
+        os.makedirs(folder, exist_ok=True)
+        self.model_name = model_name
+        self.folder = folder
+        self.commit_every = commit_every
+        self._pending = 0
+        self._stats = {"hits": 0, "misses": 0}
+        self._data_path = os.path.join(folder, "embeddings.f16")
+        # embeddings are only ever appended, the index is written after the data it points to
+        self._data = open(self._data_path, "ab")
+        self._mmap: Union[np.memmap, None] = None
+        self._conn = sqlite3.connect(os.path.join(folder, "index.sqlite"))
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                offset INTEGER,
+                n_tokens INTEGER,
+                hidden_size INTEGER
+            )"""
+        )
+        self._conn.commit()
+
+    def key(self, caption: str, max_length: int, window: int) -> str:
+        """Key of the embeddings of a caption computed with the model and windowing parameters,
+        including the version of the computation."""
+        return json.dumps({
+            "model": self.model_name,
+            "caption": hashlib.sha256(caption.encode("utf-8")).hexdigest(),
+            "max_length": max_length,
+            "window": window,
+            "version": EMBEDDING_VERSION,
+        }, sort_keys=True)
+
+    def _mapped(self, end: int) -> np.memmap:
+        """Memory map of the data file covering at least `end` values."""
+        if self._mmap is None or len(self._mmap) < end:
+            self._data.flush()
+            self._mmap = np.memmap(self._data_path, dtype=DTYPE, mode="r")
+        return self._mmap
+
+    def get(self, caption: str, max_length: int = 512, window: int = 50) -> Union[np.ndarray, None]:
+        """Returns a read-only float16 view of the embeddings of a caption, or None if they are not stored."""
+        row = self._conn.execute(
+            "SELECT offset, n_tokens, hidden_size FROM embeddings WHERE key = ?",
+            (self.key(caption, max_length, window),)
+        ).fetchone()
+        if row is None:
+            self._stats["misses"] += 1
+            return None
+        self._stats["hits"] += 1
+        offset, n_tokens, hidden_size = row
+        if n_tokens == 0:
+            return np.zeros((0, hidden_size), dtype=DTYPE)
+        end = offset + n_tokens * hidden_size
+        return self._mapped(end)[offset:end].reshape(n_tokens, hidden_size)
+
+    def set(self, caption: str, embeddings: np.ndarray, max_length: int = 512, window: int = 50):
+        """Stores the embeddings of a caption, an array of shape (n_tokens, hidden_size)."""
+        embeddings = np.ascontiguousarray(embeddings, dtype=DTYPE)
+        n_tokens, hidden_size = embeddings.shape
+        offset = self._data.tell() // np.dtype(DTYPE).itemsize
+        self._data.write(embeddings.tobytes())
+        self._conn.execute(
+            "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)",
+            (self.key(caption, max_length, window), offset, n_tokens, hidden_size),
+        )
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self._data.flush()
+        self._conn.commit()
+        self._pending = 0
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the number of lookups found and missing in the store, and of stored captions."""
+        (entries,) = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        return {**self._stats, "entries": entries}
+
+    def close(self):
+        self.commit()
+        self._data.close()
+        self._conn.close()
+        self._mmap = None
@@ -0,0 +1,135 @@
+"""
+Manifest of the encoded XML files, used to rebuild the datasets incrementally.
+
+For each XML file and encoding configuration (data generator, xpath, CodeMap, ...)
+the manifest records the sha256 of the file content and the examples encoded from it.
+Data generators given a manifest only parse and encode the files that are new or whose
+content changed since the last build, and read the encodings of the other files back
+from the manifest. The manifest is a SQLite database stored next to the split file.
+
+Usage:
+```python
+manifest = EncodingManifest()
+ner = DataGeneratorForTokenClassification(manifest=manifest)
+ner.write_jsonl(outfolder)
+manifest.stats()
+```
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import zlib
+from typing import Any, Dict, List, Tuple, Union
+
+from .utils import SPLIT_FILE
+
+# bump when a change of the encoders invalidates the encodings already recorded
+ENCODING_VERSION = 1
+
+
+class EncodingManifest:
+    """
+    Content hashes and encoded examples of the XML files, stored in SQLite.
+    """
+
+    def __init__(self, path: Union[str, None] = None, commit_every: int = 100):
+        """
+        Args:
+            path (str, optional): Path to the SQLite database.
+                Defaults to `encoding_manifest.sqlite` in the folder of the split file.
+            commit_every (int, optional): Number of encodings written between two commits.
+                Defaults to 100.
+        """
+        if path is None:
+            path = os.path.join(os.path.dirname(SPLIT_FILE), "encoding_manifest.sqlite")
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.path = path
+        self.commit_every = commit_every
+        self._hashes: Dict[Tuple[str, int, int], str] = {}
+        self._pending = 0
+        self._stats = {"reused": 0, "encoded": 0}
+        self._conn = sqlite3.connect(path)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS encodings (
+                file_name TEXT,
+                config TEXT,
+                content_hash TEXT,
+                examples BLOB,
+                updated_at REAL,
+                PRIMARY KEY (file_name, config)
+            )"""
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def config_key(config: Dict[str, Any]) -> str:
+        """Key of an encoding configuration, including the version of the encoders."""
+        return json.dumps({**config, "version": ENCODING_VERSION}, sort_keys=True)
+
+    def content_hash(self, filepath: str) -> str:
+        """sha256 of the content of a file, computed again only if the file was modified."""
+        stat = os.stat(filepath)
+        key = (os.path.abspath(filepath), stat.st_mtime_ns, stat.st_size)
+        if key not in self._hashes:
+            sha = hashlib.sha256()
+            with open(filepath, "rb") as f:
+                for block in iter(lambda: f.read(1024**2), b""):
+                    sha.update(block)
+            self._hashes[key] = sha.hexdigest()
+        return self._hashes[key]
+
+    def fresh(self, config: str, content_hashes: Dict[str, str]) -> List[str]:
+        """Returns the files whose encoding is recorded for the configuration and the given content hashes.
+
+        Args:
+            config (str): Key of the encoding configuration.
+            content_hashes (Dict[str, str]): Content hash of each file name.
+        """
+        rows = self._conn.execute(
+            "SELECT file_name, content_hash FROM encodings WHERE config = ?", (config,)
+        ).fetchall()
+        return [file_name for file_name, content_hash in rows if content_hashes.get(file_name) == content_hash]
+
+    def get(self, file_name: str, config: str) -> Union[list, None]:
+        """Returns the examples recorded for a file and configuration, or None."""
+        row = self._conn.execute(
+            "SELECT examples FROM encodings WHERE file_name = ? AND config = ?", (file_name, config)
+        ).fetchone()
+        if row is None:
+            return None
+        self._stats["reused"] += 1
+        return json.loads(zlib.decompress(row[0]))
+
+    def set(self, file_name: str, config: str, content_hash: str, examples: list):
+        """Records the examples encoded from a file."""
+        self._conn.execute(
+            "INSERT OR REPLACE INTO encodings VALUES (?, ?, ?, ?, ?)",
+            (
+                file_name,
+                config,
+                content_hash,
+                zlib.compress(json.dumps(examples, ensure_ascii=False).encode("utf-8")),
+                time.time(),
+            ),
+        )
+        self._stats["encoded"] += 1
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self._conn.commit()
+        self._pending = 0
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the number of encodings reused and written, and recorded in the manifest."""
+        (entries,) = self._conn.execute("SELECT COUNT(*) FROM encodings").fetchone()
+        return {**self._stats, "entries": entries}
+
+    def close(self):
+        self.commit()
+        self._conn.close()
@@ -2,16 +2,33 @@ import json
 import os
 import re
 import argparse
+from itertools import chain
 from lxml import etree
 from transformers import AutoModel, AutoTokenizer
+import numpy as np
+import pyarrow as pa
 import torch
 from tqdm import tqdm
+from .embedding_cache import EmbeddingCache
 from .utils import SPLIT_FILE  # Assuming utils.py is in the same directory
 
+
 # Define helper functions
 def innertext(elem):
-    """Extract all text content from an XML element."""
-    return (elem.text or '') + ''.join(innertext(e) for e in elem) + (elem.tail or '')
+    """Extract all text content from an XML element, including its tail."""
+    parts = []
+    # depth-first with an explicit stack: the tail of a node follows the text of its descendants
+    stack = [(elem, False)]
+    while stack:
+        node, closed = stack.pop()
+        if closed:
+            parts.append(node.tail or '')
+            continue
+        parts.append(node.text or '')
+        stack.append((node, True))
+        stack.extend((child, False) for child in reversed(node))
+    return ''.join(parts)
+
 
 def load_split_file(split_file=SPLIT_FILE):
     split_file_path = os.path.join(split_file)
@@ -19,32 +36,124 @@ def load_split_file(split_file=SPLIT_FILE):
         split_dict = json.load(file)
     return split_dict
 
+
+WORD_RE = re.compile(r'\w+|[^\w\s]')
+
+
 def tokenize(text):
     """Tokenize text using regular expression."""
-    return re.findall(r'\w+|[^\w\s]', text)
-
-def get_caption_embeddings(caption, tokenizer, model, max_length=512, window=50):
+    return WORD_RE.findall(text)
+
+
+def window_bounds(n_tokens, size, window):
+    """Bounds (start, end) of the windows of at most `size` tokens covering `n_tokens` tokens,
+    consecutive windows overlapping by `window` tokens."""
+    if window >= size:
+        raise ValueError(f"The overlap of the windows ({window}) must be smaller than their size ({size})")
+    bounds = []
+    start = 0
+    while True:
+        bounds.append((start, min(start + size, n_tokens)))
+        if start + size >= n_tokens:
+            return bounds
+        start += size - window
+
+
+def embed_captions(captions, tokenizer, model, max_length=512, window=50, batch_size=16, cache=None):
+    """Get the embeddings of the subword tokens of several captions.
+
+    Each caption is tokenized once. Captions longer than the model are split into windows of
+    `max_length` tokens, special tokens included, overlapping by `window` tokens, and the embeddings
+    of the positions covered by several windows are averaged. The windows of all the captions are sorted
+    by length and packed into padded batches run under `torch.inference_mode`. The embeddings of the
+    special tokens and padding are dropped, so row `k` of the embeddings of a caption is the embedding
+    of token `k` of `tokenizer(caption, add_special_tokens=False)`, whose character offsets
+    `align_words` maps to the words of the caption.
+
+    With an `EmbeddingCache`, only the captions missing from the cache go through the model.
+    The embeddings are then those stored in the cache, rounded to float16: the captions found in the cache
+    get the read-only view of the cache without copying it, `segment_means` reading float16 as it is.
+
+    Returns:
+        list: One tensor of shape (n_tokens, hidden_size) per caption, or a float16 array with a cache.
+    """
+    if cache is not None:
+        cached = [cache.get(caption, max_length, window) for caption in captions]
+        missing = [caption for caption, embeddings in zip(captions, cached) if embeddings is None]
+        computed = iter(embed_captions(missing, tokenizer, model, max_length, window, batch_size))
+        result = []
+        for caption, embeddings in zip(captions, cached):
+            if embeddings is None:
+                embeddings = next(computed).numpy()
+                cache.set(caption, embeddings, max_length, window)
+                embeddings = embeddings.astype(np.float16)
+            result.append(embeddings)
+        return result
+
+    if not captions:
+        return []
+    size = max_length - tokenizer.num_special_tokens_to_add()
+    token_ids = tokenizer(list(captions), add_special_tokens=False)["input_ids"]
+    segments = []  # (caption index, start, end)
+    for i, ids in enumerate(token_ids):
+        for start, end in window_bounds(len(ids), size, window):
+            if end > start:  # empty captions have no token to embed
+                segments.append((i, start, end))
+    segments.sort(key=lambda s: s[2] - s[1])
+
+    hidden_size = model.config.hidden_size
+    # position of the caption tokens after the leading special tokens, e.g. 1 after [CLS]
+    offset = tokenizer.build_inputs_with_special_tokens([-1]).index(-1)
+    sums = [torch.zeros((len(ids), hidden_size)) for ids in token_ids]
+    counts = [torch.zeros((len(ids), 1)) for ids in token_ids]
+    with torch.inference_mode():
+        for batch_start in range(0, len(segments), batch_size):
+            batch = segments[batch_start:batch_start + batch_size]
+            input_ids = [tokenizer.build_inputs_with_special_tokens(token_ids[i][start:end]) for i, start, end in batch]
+            inputs = tokenizer.pad({"input_ids": input_ids}, return_tensors="pt")
+            outputs = model(**inputs)
+            for (i, start, end), hidden in zip(batch, outputs.last_hidden_state):
+                sums[i][start:end] += hidden[offset:offset + end - start]
+                counts[i][start:end] += 1
+
+    return [total / count.clamp(min=1) for total, count in zip(sums, counts)]
+
+
+def get_caption_embeddings(caption, tokenizer, model, max_length=512, window=50, cache=None):
     """Get embeddings for the entire caption with handling long captions."""
-    tokens = tokenizer.tokenize(caption)
-    token_segments = []
-
-    if len(tokens) <= max_length:
-        token_segments.append(caption)
-    else:
-        start = 0
-        while start < len(tokens):
-            segment = tokenizer.convert_tokens_to_string(tokens[start:start + max_length])
-            token_segments.append(segment)
-            start += (max_length - window)
-
-    all_embeddings = []
-    for segment in token_segments:
-        inputs = tokenizer(segment, return_tensors="pt", padding=True, truncation=True, max_length=max_length)
-        outputs = model(**inputs)
-        segment_embeddings = outputs.last_hidden_state.squeeze(0)
-        all_embeddings.append(segment_embeddings)
-
-    return torch.cat(all_embeddings, dim=0)
+    return embed_captions([caption], tokenizer, model, max_length=max_length, window=window, cache=cache)[0]
+
+
+def align_words(caption, tokenizer):
+    """Subword tokens of each word of `tokenize(caption)`, from the offset mapping of a fast tokenizer.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Index of the first subword token of each word and index
+        following its last one. Words without subword tokens get an empty span.
+    """
+    word_offsets = np.array([m.span() for m in WORD_RE.finditer(caption)], dtype=np.int64).reshape(-1, 2)
+    token_offsets = np.array(
+        tokenizer(caption, add_special_tokens=False, return_offsets_mapping=True)["offset_mapping"], dtype=np.int64
+    ).reshape(-1, 2)
+    # the first token ending after the start of the word, the first token starting at or after its end
+    first = np.searchsorted(token_offsets[:, 1], word_offsets[:, 0], side="right")
+    last = np.searchsorted(token_offsets[:, 0], word_offsets[:, 1], side="left")
+    return first, np.maximum(first, last)
+
+
+def segment_means(embeddings, starts, ends):
+    """Mean of the rows `starts[k]:ends[k]` of `embeddings` for each k, zeros for empty segments.
+    The embeddings, float32 or float16, are summed in float64 without being copied."""
+    embeddings = np.asarray(embeddings)
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    cumsum = np.zeros((len(embeddings) + 1, embeddings.shape[1]), dtype=np.float64)
+    np.cumsum(embeddings, axis=0, dtype=np.float64, out=cumsum[1:])
+    lengths = ends - starts
+    means = (cumsum[ends] - cumsum[starts]) / np.maximum(lengths, 1)[:, None]
+    means[lengths == 0] = 0
+    return means.astype(np.float32)
+
 
 def write_to_jsonl(data, file_path):
     """Write the dataset to a JSON Lines file."""
@@ -53,47 +162,154 @@ def write_to_jsonl(data, file_path):
             json.dump(entry, outfile)
             outfile.write('\n')
 
-def assign_embeddings_to_words(caption_tokens, caption_embeddings, panel_data):
-    embeddings = []
-    zero_vector = []  # Zero vector for non-entity words
-
-    current_entity_tokens = []
-    current_entity_start_index = None
-
-    for i, word in enumerate(panel_data["words"]):
-        if panel_data["labels"][i].startswith("B-"):
-            # If starting a new entity, process the previous entity
-            if current_entity_tokens:
-                entity_embedding = torch.mean(caption_embeddings[current_entity_start_index:i], dim=0)
-                embeddings.extend([entity_embedding.tolist()] * len(current_entity_tokens))
-            
-            # Start a new entity
-            current_entity_tokens = [word]
-            current_entity_start_index = i
-
-        elif panel_data["labels"][i] == "I-GENEPROD":
-            # Continue the current entity
-            current_entity_tokens.append(word)
-
-        else:
-            # If not part of an entity, assign zero vector
-            if current_entity_tokens:
-                entity_embedding = torch.mean(caption_embeddings[current_entity_start_index:i], dim=0)
-                embeddings.extend([entity_embedding.tolist()] * len(current_entity_tokens))
-                current_entity_tokens = []
-                current_entity_start_index = None
-            
-            embeddings.append(zero_vector)
-
-    # Process the last entity if exists
-    if current_entity_tokens:
-        entity_embedding = torch.mean(caption_embeddings[current_entity_start_index:], dim=0)
-        embeddings.extend([entity_embedding.tolist()] * len(current_entity_tokens))
 
+def entity_spans(labels):
+    """Word spans (start, end) of the entities of a panel. An entity starts at a `B-` label
+    and continues over the following `I-GENEPROD` labels."""
+    spans = []
+    start = None
+    for i, label in enumerate(labels):
+        if label.startswith("B-"):
+            if start is not None:
+                spans.append((start, i))
+            start = i
+        elif label != "I-GENEPROD" and start is not None:
+            spans.append((start, i))
+            start = None
+    if start is not None:
+        spans.append((start, len(labels)))
+    return spans
+
+
+def span_embeddings(caption_embeddings, word_subwords, spans):
+    """Mean embedding of the subword tokens of each entity span, as an array of shape (n_spans, hidden_size).
+
+    Args:
+        caption_embeddings: Embeddings of the subword tokens of the caption.
+        word_subwords: Subword span of each word, as returned by `align_words`.
+        spans: Word spans of the entities.
+    """
+    first, last = word_subwords
+    spans = np.asarray(spans, dtype=np.int64).reshape(-1, 2)
+    return segment_means(caption_embeddings, first[spans[:, 0]], last[spans[:, 1] - 1])
+
+
+def assign_embeddings_to_words(word_subwords, caption_embeddings, panel_data):
+    """Embedding of the entity of each word of a panel, an empty list for the words outside entities."""
+    spans = entity_spans(panel_data["labels"])
+    embeddings = [[] for _ in panel_data["words"]]
+    for (start, end), entity_embedding in zip(spans, span_embeddings(caption_embeddings, word_subwords, spans)):
+        entity_embedding = entity_embedding.tolist()
+        for i in range(start, end):
+            embeddings[i] = entity_embedding
     return embeddings
 
+
+class EmbeddingWriter:
+    """Writes the entity embeddings of a split as a fixed size list column of an Arrow IPC file,
+    which can be memory-mapped with `pa.memory_map` and `pa.ipc.open_file`."""
+
+    def __init__(self, path, hidden_size, float16=False, buffer_rows=1024):
+        self.path = path
+        self.dtype = np.float16 if float16 else np.float32
+        # the schema is known up front, so a split without any entity still gets an empty file
+        self.schema = pa.schema([("embedding", pa.list_(pa.from_numpy_dtype(self.dtype), hidden_size))])
+        self.buffer_rows = buffer_rows
+        self.n_rows = 0
+        self._buffer = []
+        self._buffered = 0
+        self._sink = None
+        self._writer = None
+
+    def write(self, embeddings):
+        """Appends embeddings of shape (n, hidden_size) and returns the indices of their rows."""
+        rows = list(range(self.n_rows, self.n_rows + len(embeddings)))
+        if len(embeddings):
+            self._buffer.append(np.asarray(embeddings, dtype=self.dtype))
+            self._buffered += len(embeddings)
+            self.n_rows += len(embeddings)
+            if self._buffered >= self.buffer_rows:
+                self._flush()
+        return rows
+
+    def _open(self):
+        if self._writer is None:
+            self._sink = pa.OSFile(self.path, "wb")
+            self._writer = pa.ipc.new_file(self._sink, self.schema)
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        embeddings = np.concatenate(self._buffer)
+        column = pa.FixedSizeListArray.from_arrays(pa.array(embeddings.reshape(-1)), self.schema[0].type.list_size)
+        self._open()
+        self._writer.write_batch(pa.record_batch([column], schema=self.schema))
+        self._buffer = []
+        self._buffered = 0
+
+    def close(self):
+        self._flush()
+        self._open()
+        self._writer.close()
+        self._sink.close()
+
+
+GENEPROD_XPATH = './/sd-tag[@category="entity" and (@entity_type="gene" or @entity_type="protein")]'
+
+
+def index_figure(figure):
+    """Pre-pass over a figure, shared by its panels.
+
+    Returns:
+        Tuple[str, List[str], Dict[str, List[int]], List[Tuple[Element, List[Element]]]]: The figure caption,
+        its words, the positions of each lowercased word, and the GENEPROD tags of each panel
+        in document order.
+    """
+    # Concatenate figure title and all figure panels for the figure caption
+    figure_caption = "".join(innertext(children) + " " for children in figure)
+    caption_tokens = tokenize(figure_caption)
+    positions = {}
+    for i, word in enumerate(caption_tokens):
+        positions.setdefault(word.strip().lower(), []).append(i)
+
+    # a single query for the tags of all the panels, each tag belonging to the panels containing it
+    panels = figure.xpath('.//sd-panel')
+    panel_tags = {panel: [] for panel in panels}
+    for entity in figure.xpath(GENEPROD_XPATH):
+        for ancestor in entity.iterancestors('sd-panel'):
+            if ancestor in panel_tags:
+                panel_tags[ancestor].append(entity)
+    return figure_caption, caption_tokens, positions, [(panel, panel_tags[panel]) for panel in panels]
+
+
+def panel_entity_map(entities):
+    """Map of the lowercased words of the GENEPROD tags of a panel to their label and IDs.
+    A word of several tags takes the IDs of the last one."""
+    entity_map = {}
+    for entity in entities:
+        # Normalize entity text
+        entity_text = entity.text.strip().lower() if entity.text is not None else ""
+        uniprot_id = entity.get('ext_urls', 'O') + entity.get('ext_ids', 'O')
+        taxonomy_id = entity.get('ext_tax_ids', 'O')
+
+        if entity_text:
+            # We include all parts of the compound entity in the map
+            for part in tokenize(entity_text):
+                entity_map[part] = {
+                    'label': 'B-GENEPROD',
+                    'uniprot_id': uniprot_id if uniprot_id != "" else 'O',
+                    'taxonomy_id': taxonomy_id if taxonomy_id != "" else 'O'
+                }
+    return entity_map
+
+
 def process_xml_file(file_path):
-    """Process a single XML file and return the dataset."""
+    """Process a single XML file and return the dataset.
+
+    Every panel gets a record over all the words of its figure caption, the words of the GENEPROD tags
+    of the panel being labelled wherever they occur in the caption. A matched word continues the entity
+    of the previous word (`I-GENEPROD`) if that word was matched to the same IDs.
+    """
     with open(file_path, 'r') as file:
         xml_tree = etree.parse(file)
 
@@ -102,71 +318,36 @@ def process_xml_file(file_path):
 
     # Iterate through each figure
     for figure in xml_tree.xpath('./fig'):
-        # Concatenate figure title and all figure panels for the figure caption
-
-        figure_caption = ""
-        for children in figure:
-            figure_caption += innertext(children) + " "
-        
-        # Tokenize the figure caption
-        caption_tokens = tokenize(figure_caption)
+        figure_caption, caption_tokens, positions, panels = index_figure(figure)
+        n_words = len(caption_tokens)
 
         # Iterate through each panel in the figure
-        for panel in figure.xpath('.//sd-panel'):
-            words = []
-            labels = []
-            ext_dbs = []
-            tax_ids = []
-            last_uniprot_id = None  # Track the last Uniprot ID
-
-            # Create a map of entities in the panel
-            entity_map = {}
-            for entity in panel.xpath('.//sd-tag[@category="entity" and (@entity_type="gene" or @entity_type="protein")]'):
-                # Normalize entity text
-                entity_text = entity.text.strip().lower() if entity.text is not None else ""
-                uniprot_id = entity.get('ext_urls', 'O') + entity.get('ext_ids', 'O')
-                taxonomy_id = entity.get('ext_tax_ids', 'O')
-
-                if entity_text:
-                    # We include all parts of the compound entity in the map
-                    for part in re.findall(r'\w+|[^\w\s]', entity_text):
-                        entity_map[part] = {
-                            'label': 'B-GENEPROD',
-                            'uniprot_id': uniprot_id if uniprot_id != "" else 'O',
-                            'taxonomy_id': taxonomy_id if taxonomy_id != "" else 'O'
-                        }
-
-            # Assign labels and IDs to each word in the caption
-            for word in caption_tokens:
-                normalized_word = word.strip().lower()
-                if normalized_word in entity_map:
-                    # Entity found in the map
-                    words.append(word)
-                    current_uniprot_id = entity_map[normalized_word]['uniprot_id']
-
-                    # Check if the current entity is the same as the last one
-                    if current_uniprot_id == last_uniprot_id:
-                        label = 'I-GENEPROD'  # Inside of an entity
-                    else:
-                        label = 'B-GENEPROD'  # Beginning of a new entity
-
-                    labels.append(label)
-                    ext_dbs.append(current_uniprot_id)
-                    tax_ids.append(entity_map[normalized_word]['taxonomy_id'])
-                    last_uniprot_id = current_uniprot_id  # Update last Uniprot ID
+        for panel, entities in panels:
+            labels = ['O'] * n_words
+            ext_dbs = ['O'] * n_words
+            tax_ids = ['O'] * n_words
+
+            # only the positions of the words of the entities are visited
+            matches = {}
+            for word, entity in panel_entity_map(entities).items():
+                for i in positions.get(word, ()):
+                    matches[i] = entity
+            for i in sorted(matches):
+                current_uniprot_id = matches[i]['uniprot_id']
+                previous = matches.get(i - 1)
+                # Check if the current entity is the same as the one of the previous word
+                if previous is not None and previous['uniprot_id'] == current_uniprot_id:
+                    labels[i] = 'I-GENEPROD'  # Inside of an entity
                 else:
-                    # Non-entity word
-                    words.append(word)
-                    labels.append('O')
-                    ext_dbs.append('O')
-                    tax_ids.append('O')
-                    last_uniprot_id = None  # Reset last Uniprot ID
+                    labels[i] = 'B-GENEPROD'  # Beginning of a new entity
+                ext_dbs[i] = current_uniprot_id
+                tax_ids[i] = matches[i]['taxonomy_id']
 
             # Create a dictionary for this panel's data
             panel_data = {
                 "doi": doi,
                 "figure_caption": figure_caption.strip(),
-                "words": words,
+                "words": list(caption_tokens),
                 "labels": labels,
                 "ext_dbs": ext_dbs,
                 "tax_ids": tax_ids
@@ -176,51 +357,119 @@ def process_xml_file(file_path):
             dataset.append(panel_data)
     return dataset
 
-def main(xml_folder, output_folder):
-    output_files = {
-        'train': open(os.path.join(output_folder, 'train.jsonl'), 'w'),
-        'validation': open(os.path.join(output_folder, 'validation.jsonl'), 'w'),
-        'test': open(os.path.join(output_folder, 'test.jsonl'), 'w')
-    }
+
+def file_chunks(datasets, batch_size):
+    """Groups the datasets of consecutive files until the number of their distinct captions reaches `batch_size`,
+    so that the captions of a chunk, embedded together, fill the batches of windows."""
+    chunk, captions = [], set()
+    for dataset in datasets:
+        chunk.append(dataset)
+        captions.update(panel_data["figure_caption"] for panel_data in dataset)
+        if len(captions) >= batch_size:
+            yield chunk
+            chunk, captions = [], set()
+    if chunk:
+        yield chunk
+
+
+def main(
+    xml_folder, output_folder, batch_size=16, num_threads=None, cache_dir=None, use_cache=True,
+    embeddings_format="json", float16=False
+):
+    """Main function to process XML files and generate dataset.
+
+    Args:
+        xml_folder (str): Folder containing the XML files.
+        output_folder (str): Folder where the jsonl file of each split is written.
+        batch_size (int): Number of caption windows embedded in one forward pass. The XML files are processed
+            in chunks with at least as many captions, embedded together.
+        num_threads (int, optional): Number of CPU threads used by torch. Defaults to the torch default.
+        cache_dir (str, optional): Folder of the embedding cache. Defaults to the folder of the split file.
+        use_cache (bool): Reuse the embeddings of the captions embedded by previous runs.
+        embeddings_format (str): "json" writes the embedding of every word in the jsonl rows.
+            "arrow" writes the embedding of each entity once to `<split>.embeddings.arrow`, the jsonl rows
+            keeping the word spans of the entities (`entity_spans`) and their rows in the file (`embedding_rows`).
+        float16 (bool): Store the embeddings of the arrow files as float16.
+    """
+    splits = ['train', 'validation', 'test']
+    output_files = {split: open(os.path.join(output_folder, f'{split}.jsonl'), 'w') for split in splits}
 
     split_dict = load_split_file()
 
-    """Main function to process XML files and generate dataset."""
     files = [f for f in os.listdir(xml_folder) if f.endswith('.xml')]
 
+    if num_threads:
+        torch.set_num_threads(num_threads)
+
     # Load BioLinkBERT model
     model_name = "michiyasunaga/BioLinkBERT-base"
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
-    model = AutoModel.from_pretrained(model_name)
-
-    for file in tqdm(files, desc="Processing XML files"):
-        file_path = os.path.join(xml_folder, file)
-        dataset = process_xml_file(file_path)
-
-        for panel_data in dataset:
-            # Get embeddings for the entire caption
-            caption_embeddings = get_caption_embeddings(panel_data["figure_caption"], tokenizer, model)
-
-            # Tokenize the figure caption
-            caption_tokens = tokenize(panel_data["figure_caption"])
+    tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)  # the offset mapping aligns words and tokens
+    model = AutoModel.from_pretrained(model_name).to("cpu")
+    model.eval()
+    embedding_writers = {}
+    if embeddings_format == "arrow":
+        embedding_writers = {
+            split: EmbeddingWriter(
+                os.path.join(output_folder, f'{split}.embeddings.arrow'), model.config.hidden_size, float16=float16
+            )
+            for split in splits
+        }
+    cache = EmbeddingCache(model_name, folder=cache_dir) if use_cache else None
+
+    datasets = (
+        process_xml_file(os.path.join(xml_folder, file)) for file in tqdm(files, desc="Processing XML files")
+    )
+    for chunk in file_chunks(datasets, batch_size):
+        # the panels of a figure share its caption, which is embedded and tokenized only once,
+        # and the captions of several files are embedded together
+        captions = list(dict.fromkeys(panel_data["figure_caption"] for dataset in chunk for panel_data in dataset))
+        embeddings = embed_captions(captions, tokenizer, model, batch_size=batch_size, cache=cache)
+        caption_embeddings = dict(zip(captions, embeddings))
+        word_subwords = {caption: align_words(caption, tokenizer) for caption in captions}
+
+        for panel_data in chain.from_iterable(chunk):
+            caption = panel_data["figure_caption"]
+            split = split_dict.get(panel_data["doi"].replace(".", "-").replace("/", "_"), 'train')  # Default to 'train' if DOI not in SPLIT_DICT
 
-            # Assign embeddings to each word
-            panel_data["embeddings"] = assign_embeddings_to_words(caption_tokens, caption_embeddings, panel_data)
+            if embedding_writers:
+                # one embedding per entity, stored in the arrow file of the split
+                spans = entity_spans(panel_data["labels"])
+                panel_data["entity_spans"] = [list(span) for span in spans]
+                panel_data["embedding_rows"] = embedding_writers[split].write(
+                    span_embeddings(caption_embeddings[caption], word_subwords[caption], spans)
+                )
+            else:
+                # Assign embeddings to each word
+                panel_data["embeddings"] = assign_embeddings_to_words(
+                    word_subwords[caption], caption_embeddings[caption], panel_data
+                )
 
-            split = split_dict.get(panel_data["doi"].replace(".", "-").replace("/", "_"), 'train')  # Default to 'train' if DOI not in SPLIT_DICT
             json.dump(panel_data, output_files[split])
             output_files[split].write('\n')
 
     # Close output files
     for file in output_files.values():
         file.close()
+    for writer in embedding_writers.values():
+        writer.close()
+    if cache is not None:
+        print(f"Embedding cache: {cache.stats()}")
+        cache.close()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Process XML files for gene product NEL.")
     parser.add_argument('xml_folder', type=str, help='Folder containing XML files.')
     parser.add_argument('--output', type=str, default='output.jsonl', help='Path to output JSON Lines file.')
+    parser.add_argument('--batch_size', type=int, default=16, help='Number of caption windows embedded per forward pass.')
+    parser.add_argument('--num_threads', type=int, default=None, help='Number of CPU threads used by torch.')
+    parser.add_argument('--cache_dir', type=str, default=None, help='Folder of the embedding cache.')
+    parser.add_argument('--no_cache', action='store_true', help='Compute the embeddings of all the captions again.')
+    parser.add_argument('--embeddings_format', default='json', choices=['json', 'arrow'], help='Format of the embeddings.')
+    parser.add_argument('--float16', action='store_true', help='Store the arrow embeddings as float16.')
     args = parser.parse_args()
-    main(args.xml_folder, args.output)
-
-
+    main(
+        args.xml_folder, args.output, batch_size=args.batch_size, num_threads=args.num_threads,
+        cache_dir=args.cache_dir, use_cache=not args.no_cache,
+        embeddings_format=args.embeddings_format, float16=args.float16
+    )
@@ -2924,4 +2924,13 @@ UNNORMALIZED_CELLS = {'dLNs': {'entity_type': 'cell_type',
   'ext_dbs': 'Uberon',
   'ext_urls': 'https://www.ebi.ac.uk/ols/ontologies/uberon/terms?iri=http%3A%2F%2Fpurl.obolibrary.org%2Fobo%2FUBERON_'},
  'text': {'entity_type': '', 'ext_ids': '', 'ext_dbs': '', 'ext_urls': ''}
- }
\ No newline at end of file
+ }
+
+# compiled once: the generic terms are looked up once per entity
+GENERIC_TERMS = frozenset(PATCH_GENERIC_TERMS["label_text"])
+GENERIC_TERMS_V2 = frozenset(PATCH_GENERIC_TERMS_V2["label_text"])
+
+# generic terms whose labels are removed, for each CodeMap name
+GENERIC_PATCHES = {
+    "entity_types": GENERIC_TERMS_V2,
+}
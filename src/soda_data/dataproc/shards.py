@@ -0,0 +1,218 @@
+"""
+Sharded output of the datasets.
+
+The examples of each split are written into shards of bounded size named like
+`train-00000-of-00004.jsonl.gz`, so that they can be streamed and loaded in parallel.
+An `index.json` file lists the shards of each split with their number of examples,
+size and sha256. Comparing the index with the one of a previous upload gives the shards
+that changed and need to be uploaded again.
+
+JSON lines shards can be compressed with gzip or zstd (requires the optional `zstandard` package);
+parquet shards are compressed by parquet itself.
+"""
+import glob
+import gzip
+import hashlib
+import json
+import os
+from typing import Dict, List, Union
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+INDEX_FILE = "index.json"
+COMPRESSION_EXTENSIONS = {None: "", "gzip": ".gz", "zstd": ".zst"}
+
+
+def shard_name(split: str, shard: int, n_shards: int, extension: str) -> str:
+    return f"{split}-{shard:05d}-of-{n_shards:05d}{extension}"
+
+
+def file_sha256(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024**2), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class ShardWriter:
+    """Base class of the writers of the examples of a split into shards of at most `max_shard_size` bytes.
+    Without `max_shard_size`, the split is written into a single file named after it, e.g. `train.jsonl`.
+    """
+
+    extension = ""
+
+    def __init__(self, outfolder: str, split: str, max_shard_size: Union[int, None] = None):
+        self.outfolder = outfolder
+        self.split = split
+        self.max_shard_size = max_shard_size
+        self._paths: List[str] = []
+        self._counts: List[int] = []
+        os.makedirs(outfolder, exist_ok=True)
+        if max_shard_size is not None:
+            # shards of a previous run would be mixed with the new ones
+            for path in glob.glob(os.path.join(outfolder, f"{split}-*-of-*{self.extension}")):
+                os.remove(path)
+        self._open_shard()
+
+    def _open_shard(self):
+        if self.max_shard_size is None:
+            path = os.path.join(self.outfolder, f"{self.split}{self.extension}")
+        else:
+            path = os.path.join(self.outfolder, f"{self.split}-{len(self._paths):05d}.tmp{self.extension}")
+        self._paths.append(path)
+        self._counts.append(0)
+        self._open(path)
+
+    def _rotate(self):
+        """Starts a new shard if the current one is full."""
+        if self.max_shard_size is not None and self._counts[-1] and self._size() >= self.max_shard_size:
+            self._close()
+            self._open_shard()
+
+    def close(self) -> List[Dict[str, Union[str, int]]]:
+        """Closes the last shard and gives the shards their final name.
+
+        Returns:
+            List[Dict[str, Union[str, int]]]: File name, number of examples, size and sha256 of each shard.
+        """
+        self._close()
+        shards = []
+        for shard, (path, count) in enumerate(zip(self._paths, self._counts)):
+            if self.max_shard_size is not None:
+                final_path = os.path.join(self.outfolder, shard_name(self.split, shard, len(self._paths), self.extension))
+                os.replace(path, final_path)
+                path = final_path
+            shards.append({
+                "file": os.path.basename(path),
+                "num_examples": count,
+                "num_bytes": os.path.getsize(path),
+                "sha256": file_sha256(path),
+            })
+        return shards
+
+    def _open(self, path: str):
+        raise NotImplementedError
+
+    def _size(self) -> int:
+        raise NotImplementedError
+
+    def _close(self):
+        raise NotImplementedError
+
+
+class JSONLinesShardWriter(ShardWriter):
+    """Writes examples as JSON lines, optionally compressed with gzip or zstd. The size of the shards
+    is bounded before compression."""
+
+    def __init__(
+        self,
+        outfolder: str,
+        split: str,
+        max_shard_size: Union[int, None] = None,
+        compression: Union[str, None] = None,
+        buffer_size: int = 1024**2,
+    ):
+        if compression not in COMPRESSION_EXTENSIONS:
+            raise ValueError(f"Unknown compression {compression}, must be one of gzip, zstd or None")
+        if compression == "zstd" and zstandard is None:
+            raise ImportError("zstd compression requires the zstandard package: pip install zstandard")
+        self.extension = ".jsonl" + COMPRESSION_EXTENSIONS[compression]
+        self.compression = compression
+        self.buffer_size = buffer_size
+        super().__init__(outfolder, split, max_shard_size)
+
+    def _open(self, path: str):
+        self._raw = open(path, "wb", buffering=self.buffer_size)
+        if self.compression == "gzip":
+            # no file name nor time in the header: shards with the same examples have the same hash
+            self._file = gzip.GzipFile(filename="", mode="wb", fileobj=self._raw, mtime=0)
+        elif self.compression == "zstd":
+            self._file = zstandard.ZstdCompressor().stream_writer(self._raw)
+        else:
+            self._file = self._raw
+        self._written = 0
+
+    def write(self, example: dict):
+        self._rotate()
+        line = (json.dumps(example, ensure_ascii=False) + "\n").encode("utf-8")
+        self._file.write(line)
+        self._written += len(line)
+        self._counts[-1] += 1
+
+    def _size(self) -> int:
+        return self._written
+
+    def _close(self):
+        if self._file is not self._raw:
+            self._file.close()
+        self._raw.close()
+
+
+class ParquetShardWriter(ShardWriter):
+    """Writes record batches of examples to parquet files, one row group per batch.
+    Shards are closed once their row groups reach `max_shard_size` bytes on disk, so they can exceed it
+    by one row group and the footer."""
+
+    extension = ".parquet"
+
+    def __init__(
+        self,
+        outfolder: str,
+        split: str,
+        schema: pa.Schema,
+        max_shard_size: Union[int, None] = None,
+        compression: Union[str, None] = None,
+    ):
+        self.schema = schema
+        # parquet compresses the columns itself, snappy being the default of pyarrow
+        self.compression = compression or "snappy"
+        super().__init__(outfolder, split, max_shard_size)
+
+    def _open(self, path: str):
+        self._sink = pa.OSFile(path, "wb")
+        self._writer = pq.ParquetWriter(self._sink, self.schema, compression=self.compression)
+
+    def write_batch(self, batch: pa.RecordBatch):
+        self._rotate()
+        self._writer.write_batch(batch)
+        self._counts[-1] += batch.num_rows
+
+    def _size(self) -> int:
+        return self._sink.tell()
+
+    def _close(self):
+        self._writer.close()
+        self._sink.close()
+
+
+def write_index(outfolder: str, shards: Dict[str, List[Dict[str, Union[str, int]]]]):
+    """Writes the index of the shards of each split."""
+    with open(os.path.join(outfolder, INDEX_FILE), "w") as f:
+        json.dump({"splits": shards}, f, indent=2)
+
+
+def read_index(path: str) -> Dict[str, List[Dict[str, Union[str, int]]]]:
+    """Reads the shards of each split from an index file."""
+    with open(path) as f:
+        return json.load(f)["splits"]
+
+
+def changed_shards(
+    shards: Dict[str, List[Dict[str, Union[str, int]]]],
+    previous_shards: Dict[str, List[Dict[str, Union[str, int]]]],
+) -> List[str]:
+    """Returns the files of the shards that are new or whose content changed since the previous index."""
+    previous = {shard["file"]: shard["sha256"] for split in previous_shards.values() for shard in split}
+    return [
+        shard["file"]  # type: ignore
+        for split in shards.values()
+        for shard in split
+        if previous.get(shard["file"]) != shard["sha256"]  # type: ignore
+    ]
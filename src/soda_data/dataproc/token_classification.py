@@ -1,19 +1,22 @@
 """Prepares data for token classification tasks following
 the HuggingFace Transformers library.
 """
-from .xml_extract import XMLEncoder, CodeMap
+from .xml_extract import SPLITS, XMLCorpus, XMLEncoder, CodeMap
+from .manifest import EncodingManifest
 from .. import XML_FOLDER
 from .utils import SPLIT_FILE, innertext
-from lxml.etree import fromstring, Element
-from typing import Dict, List, Tuple
+from typing import Any, Dict, FrozenSet, Iterable, Iterator, List, Tuple, Union
 from .xml_extract import SourceDataCodes as sdc
+import hashlib
 import os
 import json
-from tqdm import tqdm
-from .patches import PATCH_GENERIC_TERMS_V2
+import numpy as np
+from .patches import GENERIC_PATCHES
 
 
 class DataGeneratorForTokenClassification(XMLEncoder):
+    COLUMNS = ("words", "labels", "is_category", "text")
+
     def __init__(
             self,
             xml_data=XML_FOLDER,
@@ -27,6 +30,9 @@ class DataGeneratorForTokenClassification(XMLEncoder):
             code_map: CodeMap = sdc.ENTITY_TYPES,  # type: ignore
             roles: str = "single",
             apply_generic_patch: bool = False,
+            corpus: Union[XMLCorpus, None] = None,
+            manifest: Union[EncodingManifest, None] = None,
+            generic_patches: Dict[str, Iterable[str]] = GENERIC_PATCHES,
             ):
         """ Initializes the DataGeneratorForTokenClassification class.
         It inherits from the XMLEncoder class. It generates a dataset for
@@ -47,6 +53,13 @@ class DataGeneratorForTokenClassification(XMLEncoder):
                 Defaults to sdc.ENTITY_TYPES.
             roles (str, optional): Whether to use single or multiple roles. Defaults to "single".
             apply_generic_patch (bool, optional): Whether to apply patches to clean data.
+            generic_patches (Dict[str, Iterable[str]], optional): Generic terms whose labels are removed
+                by the patch, for each CodeMap name. Defaults to GENERIC_PATCHES, the terms of
+                PATCH_GENERIC_TERMS_V2 for entity types.
+            corpus (XMLCorpus, optional): Corpus shared with other data generators, parsing each file once.
+                Defaults to None.
+            manifest (EncodingManifest, optional): Manifest of a previous build. Only the files that are
+                new or changed since are encoded again. Defaults to None.
 
             ```python
 
@@ -122,6 +135,11 @@ class DataGeneratorForTokenClassification(XMLEncoder):
             ```
 
         """
+        # set first: the encodings recorded in the manifest depend on them
+        self.code_map = code_map
+        self.roles = roles
+        self.apply_generic_patch = apply_generic_patch
+        self._generic_terms = frozenset(generic_patches.get(code_map.name, ())) if apply_generic_patch else frozenset()
         super().__init__(
             xml_data,
             xpath,
@@ -131,12 +149,22 @@ class DataGeneratorForTokenClassification(XMLEncoder):
             min_length,
             split_dict,
             split_file,
+            corpus,
+            manifest,
             )
-        self.code_map = code_map
-        self.roles = roles
-        self.apply_generic_patch = apply_generic_patch
 
-    def generate_dataset(self) -> Dict[str, dict]:
+    def _encoding_config(self) -> Dict[str, Any]:
+        config = {**super()._encoding_config(), "code_map": self.code_map.name, "roles": self.roles}
+        if self._generic_terms:
+            config["generic_terms"] = hashlib.sha256("\n".join(sorted(self._generic_terms)).encode("utf-8")).hexdigest()
+        return config
+
+    @property
+    def label_code_map(self) -> CodeMap:
+        # multiple roles merge the geneprod and small molecule roles, which share their labels
+        return sdc.GENEPROD_ROLES if self.roles == "multiple" else self.code_map  # type: ignore
+
+    def generate_dataset(self, num_proc: int = 1) -> Dict[str, dict]:
         """
         Generates a dataset for token classification tasks. This dataset is
         compatible with the HuggingFace Transformers library.
@@ -148,51 +176,27 @@ class DataGeneratorForTokenClassification(XMLEncoder):
 
         Args:
             split_file (str, optional): Path to the split file. Defaults to os.path.join(JSON_FOLDER, "split.json").
+            num_proc (int, optional): Number of processes encoding the XML files. The output does not depend
+                on it. Defaults to 1.
 
         Returns:
             Dict[str, List[Tuple[List[str], List[int], str]]]: Dictionary with keys as split and values as a list of tuples
             with the following structure:
             (words, labels, tag_mask, text)
         """
-        split_data = {
-            "train": [],
-            "validation": [],
-            "test": []
-        }
-        for file_name, split in tqdm(self.split_dict.items()):
-            split_data[split].extend(self._encode_xml_example(file_name))
-
-        dataset = {
-            "train": {
-                "words": [x[0] for x in split_data["train"]],
-                "labels": [x[1] for x in split_data["train"]],
-                "is_category": [x[2] for x in split_data["train"]],
-                "text": [x[3] for x in split_data["train"]],
-            },
-            "validation": {
-                "words": [x[0] for x in split_data["validation"]],
-                "labels": [x[1] for x in split_data["validation"]],
-                "is_category": [x[2] for x in split_data["validation"]],
-                "text": [x[3] for x in split_data["validation"]],
-            },
-            "test": {
-                "words": [x[0] for x in split_data["test"]],
-                "labels": [x[1] for x in split_data["test"]],
-                "is_category": [x[2] for x in split_data["test"]],
-                "text": [x[3] for x in split_data["test"]],
-            }
-        }
-
-        if self.code_map == sdc.ENTITY_TYPES:
-            if self.apply_generic_patch:
-                dataset = {
-                    "train": self._apply_patch_generic_terms(dataset["train"]),
-                    "validation": self._apply_patch_generic_terms(dataset["validation"]),
-                    "test": self._apply_patch_generic_terms(dataset["test"])
-                }
+        dataset = {split: {column: [] for column in self.COLUMNS} for split in SPLITS}
+        for split, example in self.iter_examples(num_proc):
+            for column in self.COLUMNS:
+                dataset[split][column].append(example[column])
 
         return dataset
 
+    def _file_examples(self, file_name: str, examples: list) -> Iterator[Tuple[str, Dict[str, list]]]:
+        """Yields the split and the examples of a file, with the keys words, labels, is_category and text."""
+        split = self.split_dict[file_name]
+        for words, labels, is_category, text in examples:
+            yield split, {"words": words, "labels": labels, "is_category": is_category, "text": text}
+
     def to_jsonl(self, dataset: dict, outfolder: str):
         """
         Writes the dataset into a jsonl file.
@@ -231,16 +235,15 @@ class DataGeneratorForTokenClassification(XMLEncoder):
         """
         results = []
 
-        for encoded_element in self.xml_encoded_dict[file_name]:
-
-            xml_element: Element = fromstring(encoded_element)  # type: ignore
+        for xml_element in self._xml_elements(file_name):
             is_category = []
-            words, entity_labels, inner_text = self._get_entity_labels(xml_element, sdc.ENTITY_TYPES)
 
             if self.roles == "single":
                 if self.code_map.name != "entity_types":
                     role_type = "GENEPROD" if self.code_map.name == "geneprod_roles" else "SMALL_MOLECULE"
-                    _, role_labels, _ = self._get_entity_labels(xml_element, self.code_map)
+                    words, (entity_labels, role_labels), inner_text = self._get_entity_labels_many(
+                        xml_element, [sdc.ENTITY_TYPES, self.code_map]
+                    )
                     for label in entity_labels:
                         if role_type in label:
                             is_category.append(1)
@@ -248,6 +251,7 @@ class DataGeneratorForTokenClassification(XMLEncoder):
                             is_category.append(0)
                     results.append((words, role_labels, is_category, inner_text))
                 else:
+                    words, entity_labels, inner_text = self._get_entity_labels(xml_element, sdc.ENTITY_TYPES)
                     for label in entity_labels:
                         if label != "O":
                             is_category.append(1)
@@ -255,8 +259,9 @@ class DataGeneratorForTokenClassification(XMLEncoder):
                             is_category.append(0)
                     results.append((words, entity_labels, is_category, inner_text))
             else:
-                _, geneprod_labels, _ = self._get_entity_labels(xml_element, sdc.GENEPROD_ROLES)
-                _, small_mol_labels, _ = self._get_entity_labels(xml_element, sdc.SMALL_MOL_ROLES)
+                words, (entity_labels, geneprod_labels, small_mol_labels), inner_text = self._get_entity_labels_many(
+                    xml_element, [sdc.ENTITY_TYPES, sdc.GENEPROD_ROLES, sdc.SMALL_MOL_ROLES]
+                )
 
                 role_labels = []
                 for geneprod_label, small_mol_label in zip(geneprod_labels, small_mol_labels):
@@ -276,19 +281,34 @@ class DataGeneratorForTokenClassification(XMLEncoder):
                         is_category.append(0)
                 results.append((words, role_labels, is_category, inner_text))
 
+        if self._generic_terms:
+            results = [
+                (*self._patch_generic_terms(words, labels), inner_text)
+                for words, labels, _, inner_text in results
+            ]
         return results
 
     def _get_entity_labels(self, xml_element, code_map) -> Tuple[List[str], List[str], str]:
-        xml_encoded = self.encode(xml_element, code_map)  # type: ignore
-        char_level_labels = xml_encoded['label_ids']
-        inner_text = innertext(xml_element)
-        words, word_level_labels = self._from_char_to_word_labels(
-            code_map,  # type: ignore
-            list(inner_text),
-            char_level_labels
-            )
+        words, (word_level_labels,), inner_text = self._get_entity_labels_many(xml_element, [code_map])
         return words, word_level_labels, inner_text
 
+    def _get_entity_labels_many(self, xml_element, code_maps: List) -> Tuple[List[str], List[List[str]], str]:
+        """Word-level labels of the element for several CodeMaps, from a single traversal
+        of the XML tree and a single segmentation of the text into words.
+
+        Returns:
+            Tuple[List[str], List[List[str]], str]: the words, their IOB2 labels for each CodeMap
+            and the text of the element.
+        """
+        label_buffers = self._label_buffers(xml_element, code_maps)
+        inner_text = innertext(xml_element)
+        words, starts, is_run = self._segment_words(inner_text)
+        labels_per_map = [
+            self._to_word_labels(code_map, starts, is_run, label_buffer)
+            for code_map, label_buffer in zip(code_maps, label_buffers)
+        ]
+        return words, labels_per_map, inner_text
+
     def _from_char_to_word_labels(self, code_map: CodeMap, text: List[str], labels: List) -> Tuple[List[str], List[str]]:
         """
         Generic conversion of char-level labels to token (word-separated) labels.
@@ -302,115 +322,37 @@ class DataGeneratorForTokenClassification(XMLEncoder):
         Returns:
             List[str]           Word-level tokenized labels for the input text
         """
-
-        word, label_word = '', ''
-        word_level_words, word_level_labels = [], []
-
-        for i, char in enumerate(text):
-            if char.isalnum():
-                word += char
-                label_word += str(labels[i]).replace("None", "O")
-            elif char == " ":
-                if word not in [""]:
-                    word_level_words.append(word)
-                    word_level_labels.append(label_word[0])
-                word = ''
-                label_word = ''
-            else:
-                if word not in [""]:
-                    word_level_words.append(word)
-                    word_level_labels.append(label_word[0])
-
-                word_level_words.append(char)
-                word_level_labels.append(str(labels[i]).replace("None", "O"))
-                word = ''
-                label_word = ''
-
-        word_level_iob2_labels = self._labels_to_iob2(code_map, word_level_labels)
-        assert len(word_level_words) == len(word_level_iob2_labels), "Length of labels and words not identical!"
-        return word_level_words, word_level_iob2_labels
+        words, starts, is_run = self._segment_words(text)
+        label_buffer = np.fromiter((label or 0 for label in labels), dtype=np.int64, count=len(labels))
+        return words, self._to_word_labels(code_map, starts, is_run, label_buffer)
+
+    def _to_word_labels(self, code_map: CodeMap, starts: np.ndarray, is_run: np.ndarray, label_buffer: np.ndarray) -> List[str]:
+        """Word-level IOB2 labels gathered from the char-level label codes at the first character of each word."""
+        codes = label_buffer[starts]
+        # runs of alphanumeric characters keep the first digit of their code
+        long_codes = is_run & (codes >= 10)
+        while long_codes.any():
+            codes[long_codes] //= 10
+            long_codes = is_run & (codes >= 10)
+        word_level_iob2_labels = self._codes_to_iob2(code_map, codes)
+        assert len(starts) == len(word_level_iob2_labels), "Length of labels and words not identical!"
+        return word_level_iob2_labels
 
     def _apply_patch_generic_terms(self, split):
         """
         Applies a patch to remove labels of generic terms.
         These terms are listed in patches.py
         """
-        words = split["words"]
-        labels = split["labels"]
-
-        patched_labels = []
         patched_words = []
+        patched_labels = []
         patched_is_category = []
 
-        entity_name = []
-        entity_label = []
-
-        for w_sentence, l_sentence in zip(words, labels):
-            inside_entity = False
-            patched_labels_sentence = []
-            patched_words_sentence = []
-
-            for word, label in zip(w_sentence, l_sentence):
-                if (label == "O") and (not inside_entity):
-                    patched_labels_sentence.append(label)
-                    patched_words_sentence.append(word)
-                if (label.startswith("B-")) and (inside_entity):
-                    if " ".join(entity_name).lower() in PATCH_GENERIC_TERMS_V2["label_text"]:
-                        for w in entity_name:
-                            patched_words_sentence.append(w)
-                            patched_labels_sentence.append("O")
-                    else:
-                        for w, l in zip(entity_name, entity_label):
-                            patched_words_sentence.append(w)
-                            patched_labels_sentence.append(l)
-                    inside_entity = True
-                    entity_name = [word]
-                    entity_label = [label]
-                if (label.startswith("B-")) and (not inside_entity):
-                    inside_entity = True
-                    entity_name = [word]
-                    entity_label = [label]
-                if (label != "O") and (label.startswith("I-")):
-                    entity_name.append(word)
-                    entity_label.append(label)
-                if (label == "O") and (inside_entity):
-                    inside_entity = False
-                    if " ".join(entity_name).lower() in PATCH_GENERIC_TERMS_V2["label_text"]:
-                        for w in entity_name:
-                            patched_words_sentence.append(w)
-                            patched_labels_sentence.append("O")
-                    else:
-                        for w, l in zip(entity_name, entity_label):
-                            patched_words_sentence.append(w)
-                            patched_labels_sentence.append(l)
-                    patched_words_sentence.append(word)
-                    patched_labels_sentence.append(label)
-            if inside_entity:
-                if " ".join(entity_name).lower() in PATCH_GENERIC_TERMS_V2["label_text"]:
-                    for w in entity_name:
-                        patched_words_sentence.append(w)
-                        patched_labels_sentence.append("O")
-                else:
-                    for w, l in zip(entity_name, entity_label):
-                        patched_words_sentence.append(w)
-                        patched_labels_sentence.append(l)
-
-            assert len(patched_labels_sentence) == len(l_sentence), f"{len(patched_labels_sentence)} not same length as {len(l_sentence)}: \n {patched_labels_sentence} \n {l_sentence} \n {' '.join(w_sentence)}"
-            assert len(patched_words_sentence) == len(w_sentence), f"{len(patched_words_sentence)} not same length as {len(w_sentence)}:  \n {patched_words_sentence} \n {w_sentence} \n {' '.join(w_sentence)}"
-
-            patched_is_category_sentence = []
-            for lab in patched_labels_sentence:
-                if lab != "O":
-                    if "GENEPROD" in lab:
-                        patched_is_category_sentence.append(1)
-                    elif "SMALL_MOLECULE" in lab:
-                        patched_is_category_sentence.append(2)
-                else:
-                    patched_is_category_sentence.append(0)
-
-            patched_labels.append(patched_labels_sentence)
-            patched_words.append(patched_words_sentence)
-            patched_is_category.append(patched_is_category_sentence)
+        generic_terms = self._generic_terms or GENERIC_PATCHES[sdc.ENTITY_TYPES.name]
+        for w_sentence, l_sentence in zip(split["words"], split["labels"]):
+            words, labels, is_category = self._patch_generic_terms(w_sentence, l_sentence, generic_terms)
+            patched_words.append(words)
+            patched_labels.append(labels)
+            patched_is_category.append(is_category)
 
         return {
             "words": patched_words,
@@ -419,8 +361,49 @@ class DataGeneratorForTokenClassification(XMLEncoder):
             "text": split["text"],
         }
 
+    def _patch_generic_terms(
+            self, w_sentence: List[str], l_sentence: List[str], generic_terms: Union[FrozenSet[str], None] = None,
+            ) -> Tuple[List[str], List[str], List[int]]:
+        """Removes the labels of the entities of a single example that are generic terms, in a single pass.
+
+        Args:
+            w_sentence (List[str]): The words of the example.
+            l_sentence (List[str]): Their IOB2 labels.
+            generic_terms (FrozenSet[str], optional): Lower-cased generic terms.
+                Defaults to the terms of the CodeMap of the data generator.
+
+        Returns:
+            Tuple[List[str], List[str], List[int]]: The words, patched labels and patched is_category of the example.
+        """
+        if generic_terms is None:
+            generic_terms = self._generic_terms
+        patched_labels = list(l_sentence)
+        entity_start = None
+        for i in range(len(patched_labels) + 1):
+            label = patched_labels[i] if i < len(patched_labels) else "O"
+            if entity_start is not None and not label.startswith("I-"):
+                if " ".join(w_sentence[entity_start:i]).lower() in generic_terms:
+                    patched_labels[entity_start:i] = ["O"] * (i - entity_start)
+                entity_start = None
+            if label.startswith("B-"):
+                entity_start = i
+
+        patched_is_category = []
+        for lab in patched_labels:
+            if lab != "O":
+                if "GENEPROD" in lab:
+                    patched_is_category.append(1)
+                elif "SMALL_MOLECULE" in lab:
+                    patched_is_category.append(2)
+            else:
+                patched_is_category.append(0)
+
+        return list(w_sentence), patched_labels, patched_is_category
+
 
 class DataGeneratorForPanelization(XMLEncoder):
+    COLUMNS = ("words", "labels", "text")
+
     def __init__(
             self,
             xml_data=XML_FOLDER,
@@ -431,6 +414,8 @@ class DataGeneratorForPanelization(XMLEncoder):
             min_length=32,
             split_dict: Dict[str, str] = {},
             split_file: str = SPLIT_FILE,
+            corpus: Union[XMLCorpus, None] = None,
+            manifest: Union[EncodingManifest, None] = None,
             ):
         """
         Generates a dataset for panelization tasks. This dataset is
@@ -449,6 +434,10 @@ class DataGeneratorForPanelization(XMLEncoder):
             min_length (int, optional): Minimum length of the XML elements to be encoded. Defaults to 32.
             split_dict (Dict[str, str], optional): Dictionary with keys as split and values as a list of file names. Defaults to {}.
             split_file (str, optional): Path to the split file. Defaults to SPLIT_FILE.
+            corpus (XMLCorpus, optional): Corpus shared with other data generators, parsing each file once.
+                Defaults to None.
+            manifest (EncodingManifest, optional): Manifest of a previous build. Only the files that are
+                new or changed since are encoded again. Defaults to None.
             """
         super().__init__(
             xml_data,
@@ -459,9 +448,15 @@ class DataGeneratorForPanelization(XMLEncoder):
             min_length,
             split_dict,
             split_file,
+            corpus,
+            manifest,
             )
 
-    def generate_dataset(self) -> Dict[str, dict]:
+    @property
+    def label_code_map(self) -> CodeMap:
+        return sdc.PANELIZATION  # type: ignore
+
+    def generate_dataset(self, num_proc: int = 1) -> Dict[str, dict]:
         """
         Generates a dataset for token classification tasks. This dataset is
         compatible with the HuggingFace Transformers library.
@@ -473,40 +468,27 @@ class DataGeneratorForPanelization(XMLEncoder):
 
         Args:
             split_file (str, optional): Path to the split file. Defaults to os.path.join(JSON_FOLDER, "split.json").
+            num_proc (int, optional): Number of processes encoding the XML files. The output does not depend
+                on it. Defaults to 1.
 
         Returns:
             Dict[str, List[Tuple[List[str], List[int], str]]]: Dictionary with keys as split and values as a list of tuples
             with the following structure:
             (words, labels, text)
         """
-        split_data = {
-            "train": [],
-            "validation": [],
-            "test": []
-        }
-        for file_name, split in tqdm(self.split_dict.items()):
-            split_data[split].extend(self._encode_xml_example(file_name))
-
-        dataset = {
-            "train": {
-                "words": [x[0] for x in split_data["train"]],
-                "labels": [x[1] for x in split_data["train"]],
-                "text": [x[2] for x in split_data["train"]],
-            },
-            "validation": {
-                "words": [x[0] for x in split_data["validation"]],
-                "labels": [x[1] for x in split_data["validation"]],
-                "text": [x[2] for x in split_data["validation"]],
-            },
-            "test": {
-                "words": [x[0] for x in split_data["test"]],
-                "labels": [x[1] for x in split_data["test"]],
-                "text": [x[2] for x in split_data["test"]],
-            }
-        }
+        dataset = {split: {column: [] for column in self.COLUMNS} for split in SPLITS}
+        for split, example in self.iter_examples(num_proc):
+            for column in self.COLUMNS:
+                dataset[split][column].append(example[column])
 
         return dataset
 
+    def _file_examples(self, file_name: str, examples: list) -> Iterator[Tuple[str, Dict[str, list]]]:
+        """Yields the split and the examples of a file, with the keys words, labels and text."""
+        split = self.split_dict[file_name]
+        for words, labels, text in examples:
+            yield split, {"words": words, "labels": labels, "text": text}
+
     def to_jsonl(self, dataset: dict, outfolder: str):
         """
         Writes the dataset into a jsonl file.
@@ -544,20 +526,13 @@ class DataGeneratorForPanelization(XMLEncoder):
         """
         results = []
 
-        for encoded_element in self.xml_encoded_dict[file_name]:
-
-            xml_element: Element = fromstring(encoded_element)  # type: ignore
+        for xml_element in self._xml_elements(file_name):
             inner_text = innertext(xml_element)
 
-            xml_encoded = self.encode(xml_element, sdc.PANELIZATION)  # type: ignore
-            char_level_labels = ["O"] * len(xml_encoded['label_ids'])
-            offsets = xml_encoded["offsets"]
-            for offset in offsets:
-                char_level_labels[offset[0]] = "B-PANEL_START"
-            words, word_level_labels = self._from_char_to_word_labels(
-                list(inner_text),
-                char_level_labels,
-                )
+            spans, length = self._encode(xml_element, sdc.PANELIZATION)  # type: ignore
+            panel_starts = np.zeros(length, dtype=bool)
+            panel_starts[[start for start, _, _ in spans]] = True
+            words, word_level_labels = self._panel_start_word_labels(inner_text, panel_starts)
             results.append((words, word_level_labels, inner_text))
 
         return results
@@ -566,42 +541,27 @@ class DataGeneratorForPanelization(XMLEncoder):
         """
         Generic conversion of char-level labels to token (word-separated) labels.
         Args:
-            code_map (CodeMap): CodeMap, each specifying Tthe XML-to-code mapping of label codes
-                                to specific combinations of tag name and attribute values.
             text (List[str]):     List of the characters inside the text of the XML elements
-            labels (List):        List of labels for each character inside the XML elements. They will be
-                                a mix of integers and None
+            labels (List):        List of labels for each character inside the XML elements,
+                                "B-PANEL_START" or "O"
 
         Returns:
             List[str]           Word-level tokenized labels for the input text
         """
+        return self._panel_start_word_labels(text, np.asarray(labels, dtype=object) == "B-PANEL_START")
 
-        word_level_words, word_level_labels = [], []
-        word, label_word = '', ''
-
-        for i, char in enumerate(text):
-            if char.isalnum():
-                word += char
-                label_word += str(labels[i])
-            elif char == " ":
-                if word not in [""]:
-                    word_level_words.append(word)
-                    if "B-PANEL_START" in label_word:
-                        word_level_labels.append("B-PANEL_START")
-                    else:
-                        word_level_labels.append("O")
-                word = ''
-                label_word = ''
-            else:
-                if word not in [""]:
-                    word_level_words.append(word)
-                    if "B-PANEL_START" in label_word:
-                        word_level_labels.append("B-PANEL_START")
-                    else:
-                        word_level_labels.append("O")
-                word_level_words.append(char)
-                word_level_labels.append(labels[i])
-                word = ''
-                label_word = ''
+    def _panel_start_word_labels(
+            self, text: Union[str, List[str]], panel_starts: np.ndarray
+            ) -> Tuple[List[str], List[str]]:
+        """Words of the text, labeled "B-PANEL_START" if a panel starts at any of their characters.
 
-        return word_level_words, word_level_labels
+        Args:
+            text (Union[str, List[str]]): The text of the XML element.
+            panel_starts (np.ndarray): Whether a panel starts at each character.
+        """
+        words, starts, _ = self._segment_words(text)
+        ends = starts + np.fromiter(map(len, words), dtype=np.intp, count=len(words))
+        # number of panel starts before each position, to count them within each word in one go
+        n_starts = np.concatenate(([0], np.cumsum(panel_starts)))
+        is_panel_start = n_starts[ends] > n_starts[starts]
+        return words, np.where(is_panel_start, "B-PANEL_START", "O").tolist()
@@ -1,16 +1,37 @@
+from array import array
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
 from dataclasses import dataclass, field
 from enum import Enum
 
-from typing import List, Union, Tuple, Dict, Any
+from typing import List, Union, Tuple, Dict, Any, Iterator, Set
 import os
 import glob
+import re
+import numpy as np
 from pathlib import Path
-from lxml.etree import parse, tostring
+from lxml.etree import fromstring, parse, tostring
+from tqdm import tqdm
 from xml.etree import ElementTree
 from .utils import innertext, cleanup, create_split, SPLIT_FILE
+from .manifest import EncodingManifest
+from .shards import JSONLinesShardWriter, ParquetShardWriter, write_index
 from .. import XML_FOLDER
 import json
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+SPLITS = ("train", "validation", "test")
+# words are runs of alphanumeric characters or any other single character but space
+WORD_RE = re.compile(r"([^\W_]+)|[^ ]")
+# arrow types of the columns of the datasets, the labels being stored as class ids (int64 as `datasets.ClassLabel`)
+ARROW_TYPES = {
+    "words": pa.list_(pa.string()),
+    "labels": pa.list_(pa.int64()),
+    "is_category": pa.list_(pa.int8()),
+    "text": pa.string(),
+}
 
 
 @dataclass
@@ -257,6 +278,98 @@ class SourceDataCodes(Enum):
     )
 
 
+class XMLCorpus:
+    """Parses each XML file once and memoises the examples extracted from it, so that
+    several extractors and data generators sharing the corpus do not parse and serialize
+    the same files again.
+
+    Extractors register with the corpus when they are instantiated. When a file is parsed, the examples
+    of every registered combination of xpath, keep_xml, remove_tail and min_length are extracted from it
+    and the parsed file is released. The examples are memoised as cleaned strings until every registered
+    extractor with their combination has consumed them. Data generators streaming their examples one after
+    the other thus hold the examples of the files that the following generators have not reached yet,
+    up to the whole corpus: `write_datasets` streams them in a single pass over the files instead,
+    holding the examples of one file at a time.
+    The extractors sharing the corpus must all be instantiated before they are used. An extractor
+    consuming the examples of a file again parses it again, and `clear` releases the examples still memoised.
+
+    ```python
+    corpus = XMLCorpus()
+    ner = DataGeneratorForTokenClassification(corpus=corpus)
+    roles = DataGeneratorForTokenClassification(code_map=sdc.GENEPROD_ROLES, corpus=corpus)
+    write_datasets({"ner": ner, "roles": roles}, "token_classification")
+    ```
+    """
+
+    def __init__(self):
+        self._examples: Dict[Tuple, List[str]] = {}
+        # an extractor and the number of registered extractors of each configuration
+        self._extractors: Dict[Tuple, "XMLExtractor"] = {}
+        self._consumers: Dict[Tuple, int] = {}
+        # number of extractors that consumed the examples of each file and configuration
+        self._consumed: Dict[Tuple, int] = {}
+        # configurations whose examples were extracted from each file
+        self._extracted: Dict[str, Set[Tuple]] = {}
+        self.n_parsed = 0
+
+    @staticmethod
+    def _config(extractor: "XMLExtractor") -> Tuple:
+        return (extractor.xpath, extractor.keep_xml, extractor.remove_tail, extractor.min_length)
+
+    def _key(self, extractor: "XMLExtractor", filepath: str) -> Tuple:
+        return (os.path.abspath(filepath),) + self._config(extractor)
+
+    def register(self, extractor: "XMLExtractor"):
+        """Registers an extractor that will consume the examples of the files."""
+        config = self._config(extractor)
+        self._extractors.setdefault(config, extractor)
+        self._consumers[config] = self._consumers.get(config, 0) + 1
+
+    def _extract(self, extractor: "XMLExtractor", filepath: str) -> List[str]:
+        key = self._key(extractor, filepath)
+        if key not in self._examples:
+            filepath = key[0]
+            with open(filepath) as f:
+                tree = parse(f)  # type: ignore
+            self.n_parsed += 1
+            extracted = self._extracted.setdefault(filepath, set())
+            extractors = {config: e for config, e in self._extractors.items() if config not in extracted}
+            extractors[key[1:]] = extractor
+            for config, config_extractor in extractors.items():
+                # the tree is shared: tails are left out when serializing instead of being removed
+                examples = config_extractor.extract_xml_elements(tree.xpath(config[0]))
+                self._examples[(filepath,) + config] = examples
+                extracted.add(config)
+        return self._examples[key]
+
+    def examples(self, extractor: "XMLExtractor", filepath: str) -> List[str]:
+        """Returns the examples that `extractor` extracts from the file."""
+        examples = self._extract(extractor, filepath)
+        self.release(extractor, filepath)
+        return examples
+
+    def elements(self, extractor: "XMLExtractor", filepath: str) -> List[Any]:
+        """Returns the examples that `extractor` extracts from the file, parsed."""
+        return [fromstring(e) for e in self.examples(extractor, filepath)]
+
+    def release(self, extractor: "XMLExtractor", filepath: str):
+        """Records that `extractor` consumed the examples of the file, or does not need them,
+        releasing them once all the registered extractors of its configuration did."""
+        key = self._key(extractor, filepath)
+        consumed = self._consumed.get(key, 0) + 1
+        if consumed >= self._consumers.get(key[1:], 0):
+            self._consumed.pop(key, None)
+            self._examples.pop(key, None)
+        else:
+            self._consumed[key] = consumed
+
+    def clear(self):
+        """Releases the memoised examples."""
+        self._examples = {}
+        self._consumed = {}
+        self._extracted = {}
+
+
 class XMLExtractor:
     def __init__(
             self,
@@ -267,7 +380,8 @@ class XMLExtractor:
             remove_tail: bool = True,
             min_length: int = 32,
             split_dict: Dict[str, str] = {},
-            split_file: str = SPLIT_FILE
+            split_file: str = SPLIT_FILE,
+            corpus: Union[XMLCorpus, None] = None,
     ) -> None:
         """Extracts XML elements from a file, file list, directory of files
 
@@ -289,6 +403,8 @@ class XMLExtractor:
                 provided. Used avoid noise. Defaults to 32.
             split_dict (Dict[str, str], optional): Dictionary with keys as file names and values as split. Defaults to {}.
             split_file (str, optional): Path to the split file. Defaults to SPLIT_FILE.
+            corpus (XMLCorpus, optional): Corpus shared with other extractors, parsing each file once.
+                Defaults to None.
         """
         self.xml_path = xml_data
         self.xml_files = self._get_file_list()
@@ -299,6 +415,10 @@ class XMLExtractor:
         self.keep_xml = keep_xml
         self.split_file = split_file
         self.split_dict = split_dict if split_dict else self.get_split_dict()
+        self.corpus = corpus
+        self._file_paths: Dict[str, str] = {}
+        if corpus is not None:
+            corpus.register(self)
 
     def _get_file_list(self) -> List[str]:
         """Returns a list of files to process."""
@@ -364,7 +484,7 @@ class XMLExtractor:
         examples = []
         for e in elements:
             if self.keep_xml:
-                text = tostring(e).decode('utf-8')
+                text = tostring(e, with_tail=not self.remove_tail).decode('utf-8')
                 inner = innertext(e)
             else:
                 text = innertext(e)
@@ -390,10 +510,13 @@ class XMLExtractor:
         xml_files = files if files else self.xml_files
 
         for file_ in xml_files:
-            xml_elements = self._parse_xml_file(file_)
-            results[os.path.splitext(os.path.basename(file_))[0]] = (
-                self.extract_xml_elements(xml_elements)
-                )
+            file_name = os.path.splitext(os.path.basename(file_))[0]
+            self._file_paths[file_name] = file_
+            if self.corpus is not None:
+                results[file_name] = self.corpus.examples(self, file_)
+            else:
+                xml_elements = self._parse_xml_file(file_)
+                results[file_name] = self.extract_xml_elements(xml_elements)
         return results
 
     @staticmethod
@@ -419,7 +542,9 @@ class XMLEncoder(XMLExtractor):
             remove_tail=True,
             min_length=32,
             split_dict: Dict[str, str] = {},
-            split_file: str = SPLIT_FILE
+            split_file: str = SPLIT_FILE,
+            corpus: Union[XMLCorpus, None] = None,
+            manifest: Union[EncodingManifest, None] = None,
             ):
         super().__init__(
             xml_data,
@@ -430,6 +555,7 @@ class XMLEncoder(XMLExtractor):
             min_length,
             split_dict,
             split_file,
+            corpus,
             )
         """Encodes XML elements into a list of character-level label codes (int).
         Args:
@@ -447,9 +573,218 @@ class XMLEncoder(XMLExtractor):
                 provided. Used avoid noise. Defaults to 32.
             split_dict (Dict[str, str], optional): Dictionary with keys as file names and values as split. Defaults to {}.
             split_file (str, optional): Path to the split file. Defaults to SPLIT_FILE.
+            corpus (XMLCorpus, optional): Corpus shared with other encoders, parsing each file once.
+                Defaults to None.
+            manifest (EncodingManifest, optional): Manifest of the encodings of a previous build. Only the
+                files that are new or changed since are encoded. Defaults to None.
        """
 
-        self.xml_encoded_dict = self.extract_xml_from_file_list()
+        self.manifest = manifest
+        # the files are extracted one at a time as they are encoded
+        self._file_paths = {os.path.splitext(os.path.basename(f))[0]: f for f in self.xml_files}
+        self._fresh: Set[str] = set()
+        if manifest is not None:
+            self._check_manifest()
+
+    @property
+    def files_to_encode(self) -> List[str]:
+        """The files of the split dictionary that are encoded, those that are not fresh in the manifest."""
+        return [file_name for file_name in self.split_dict if file_name not in self._fresh]
+
+    def extract_all(self) -> Dict[str, List[str]]:
+        """Extracts the examples of the files to encode, all of them without a manifest, holding
+        the whole corpus in memory: encoding the examples extracts them one file at a time instead."""
+        if self.manifest is None:
+            return self.extract_xml_from_file_list()
+        files = [self._file_paths[f] for f in self.files_to_encode if f in self._file_paths]
+        return self.extract_xml_from_file_list(files) if files else {}
+
+    def _xml_elements(self, file_name: str) -> List[Any]:
+        """The parsed examples of a file, shared through the corpus if there is one."""
+        filepath = self._file_paths[file_name]
+        if self.corpus is not None:
+            return self.corpus.elements(self, filepath)
+        return [fromstring(e) for e in self.extract_xml_from_file_list([filepath])[file_name]]
+
+    def _release(self, file_name: str):
+        """Tells the corpus that the examples of a file encoded without it are not needed."""
+        if self.corpus is not None:
+            self.corpus.release(self, self._file_paths[file_name])
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # the parsed elements of the corpus and the connection to the manifest cannot be pickled:
+        # worker processes share a corpus of their own between the encoders sent to them
+        state = self.__dict__.copy()
+        state["corpus"] = None
+        state["manifest"] = None
+        return state
+
+    def _encoding_config(self) -> Dict[str, Any]:
+        """Parameters on which the encoded examples depend, keying them in the manifest."""
+        return {
+            "encoder": type(self).__name__,
+            "xpath": self.xpath,
+            "xpath_filter": self.xpath_filter,
+            "keep_xml": self.keep_xml,
+            "remove_tail": self.remove_tail,
+            "min_length": self.min_length,
+        }
+
+    def _check_manifest(self):
+        """Finds the files of the split dictionary whose encoding recorded in the manifest is fresh,
+        the others being new or changed since."""
+        file_paths = {file_name: f for file_name, f in self._file_paths.items() if file_name in self.split_dict}
+        self._content_hashes = {file_name: self.manifest.content_hash(f) for file_name, f in file_paths.items()}
+        self._manifest_key = self.manifest.config_key(self._encoding_config())
+        self._fresh = set(self.manifest.fresh(self._manifest_key, self._content_hashes))
+
+    def _encode_files(self, num_proc: int = 1) -> Iterator[Tuple[str, list]]:
+        """Encodes the files of the split dictionary with `_encode_xml_example`. With a manifest,
+        the encodings of the files that did not change are read back instead and the new ones are recorded.
+
+        Args:
+            num_proc (int, optional): Number of worker processes. Files are sent to the workers
+                in chunks. Defaults to 1, encoding the files in the current process.
+
+        Yields:
+            Tuple[str, list]: File name and encoded examples, in the order of `split_dict`
+                whatever the number of processes.
+        """
+        for file_name, (examples,) in encode_files([self], num_proc):
+            yield file_name, examples
+
+    def _file_examples(self, file_name: str, examples: list) -> Iterator[Tuple[str, Dict[str, list]]]:
+        """Yields the split and the examples of a file encoded by `_encode_xml_example`."""
+        raise NotImplementedError
+
+    def iter_examples(self, num_proc: int = 1) -> Iterator[Tuple[str, Dict[str, list]]]:
+        """
+        Yields the examples of the dataset one file at a time.
+
+        Args:
+            num_proc (int, optional): Number of processes encoding the XML files. Defaults to 1.
+
+        Yields:
+            Tuple[str, Dict[str, list]]: Split and example, with the keys of `COLUMNS`.
+        """
+        for file_name, examples in self._encode_files(num_proc):
+            yield from self._file_examples(file_name, examples)
+
+    def write_jsonl(
+            self,
+            outfolder: str,
+            num_proc: int = 1,
+            buffer_size: int = 1024**2,
+            max_shard_size: Union[int, None] = None,
+            compression: Union[str, None] = None,
+            ) -> Dict[str, int]:
+        """Writes the examples into jsonl files as they are encoded, the XML files being extracted one
+        at a time, so that neither the dataset nor the corpus is held in memory. Generators sharing
+        an `XMLCorpus` hold the examples that the other generators have not consumed yet,
+        unless they are written together by `write_datasets`.
+        Without sharding nor compression, the files are the same as those written
+        by `to_jsonl(generate_dataset())`.
+
+        Args:
+            outfolder (str): Path to the output folder.
+            num_proc (int, optional): Number of processes encoding the XML files. Defaults to 1.
+            buffer_size (int, optional): Size of the write buffer of each file in bytes. Defaults to 1 MB.
+            max_shard_size (int, optional): If provided, each split is written into shards
+                (`train-00000-of-00004.jsonl`) of at most this number of bytes before compression,
+                listed in `index.json`. Defaults to None, a single file per split.
+            compression (str, optional): "gzip" or "zstd". Defaults to None.
+
+        Returns:
+            Dict[str, int]: Number of examples written in each split.
+        """
+        with DatasetWriter(self, outfolder, "jsonl", buffer_size=buffer_size, max_shard_size=max_shard_size,
+                           compression=compression) as writer:
+            for split, example in self.iter_examples(num_proc):
+                writer.write(split, example)
+        return writer.counts
+
+    @property
+    def label_code_map(self) -> CodeMap:
+        """The CodeMap whose `iob2_labels` are the labels of the examples."""
+        raise NotImplementedError
+
+    def arrow_schema(self) -> pa.Schema:
+        """Arrow schema of the examples, with the labels as class ids of `label_code_map.iob2_labels`.
+        The features are stored in the metadata of the schema so that `datasets` loads the labels as `ClassLabel`.
+        """
+        label_names = list(self.label_code_map.iob2_labels)
+        features = {
+            "words": {"feature": {"dtype": "string", "_type": "Value"}, "_type": "Sequence"},
+            "labels": {"feature": {"names": label_names, "_type": "ClassLabel"}, "_type": "Sequence"},
+            "is_category": {"feature": {"dtype": "int8", "_type": "Value"}, "_type": "Sequence"},
+            "text": {"dtype": "string", "_type": "Value"},
+        }
+        columns = self.COLUMNS  # type: ignore
+        return pa.schema(
+            [(column, ARROW_TYPES[column]) for column in columns],
+            metadata={"huggingface": json.dumps({"info": {"features": {c: features[c] for c in columns}}})},
+        )
+
+    def _record_batch(self, examples: List[Dict[str, list]], schema: pa.Schema) -> pa.RecordBatch:
+        """Converts examples to a record batch, replacing the IOB2 labels by their class id."""
+        label_ids = {label: i for i, label in enumerate(self.label_code_map.iob2_labels)}
+        columns = {column: [example[column] for example in examples] for column in schema.names}
+        columns["labels"] = [[label_ids[label] for label in labels] for labels in columns["labels"]]
+        return pa.RecordBatch.from_pydict(columns, schema=schema)
+
+    def to_arrow(self, dataset: Dict[str, dict]) -> Dict[str, pa.Table]:
+        """Converts a dataset returned by `generate_dataset` into an Arrow table per split,
+        with the labels as class ids of `label_code_map.iob2_labels`."""
+        schema = self.arrow_schema()
+        tables = {}
+        for split, columns in dataset.items():
+            examples = [dict(zip(columns, values)) for values in zip(*columns.values())]
+            tables[split] = pa.Table.from_batches([self._record_batch(examples, schema)], schema=schema)
+        return tables
+
+    def to_parquet(self, dataset: Dict[str, dict], outfolder: str, row_group_size: int = 1000):
+        """Writes a dataset returned by `generate_dataset` into a parquet file per split.
+
+        Args:
+            dataset (Dict[str, dict]): Dataset to be written.
+            outfolder (str): Path to the output folder.
+            row_group_size (int, optional): Number of examples per row group. Defaults to 1000.
+        """
+        os.makedirs(outfolder, exist_ok=True)
+        for split, table in self.to_arrow(dataset).items():
+            pq.write_table(table, os.path.join(outfolder, f"{split}.parquet"), row_group_size=row_group_size)
+
+    def write_parquet(
+            self,
+            outfolder: str,
+            num_proc: int = 1,
+            row_group_size: int = 1000,
+            max_shard_size: Union[int, None] = None,
+            compression: Union[str, None] = None,
+            ) -> Dict[str, int]:
+        """Writes the examples into parquet files as they are encoded, one row group
+        at a time, so that the dataset is never held in memory, and the XML files are extracted
+        one at a time as with `write_jsonl`. The labels are stored as class ids
+        of `label_code_map.iob2_labels`; `datasets.load_dataset("parquet", ...)` loads them as `ClassLabel`.
+
+        Args:
+            outfolder (str): Path to the output folder.
+            num_proc (int, optional): Number of processes encoding the XML files. Defaults to 1.
+            row_group_size (int, optional): Number of examples per row group. Defaults to 1000.
+            max_shard_size (int, optional): If provided, each split is written into shards
+                (`train-00000-of-00004.parquet`) closed once they reach this number of bytes,
+                listed in `index.json`. Defaults to None, a single file per split.
+            compression (str, optional): Parquet compression codec, e.g. "zstd" or "gzip".
+                Defaults to None, snappy.
+
+        Returns:
+            Dict[str, int]: Number of examples written in each split.
+        """
+        with DatasetWriter(self, outfolder, "parquet", row_group_size=row_group_size, max_shard_size=max_shard_size,
+                           compression=compression) as writer:
+            for split, example in self.iter_examples(num_proc):
+                writer.write(split, example)
+        return writer.counts
 
     def _encode_xml_example(self):
         raise NotImplementedError
@@ -478,7 +813,11 @@ class XMLEncoder(XMLExtractor):
                    - 'offsets' (Tuple[int, int]): the offsets indicating the start and end postition of each labeled element
                    - 'xml' (str): the xml as string for reference and debuging
         """
-        encoded, offsets, _ = self._encode(element, code_map)
+        spans, length = self._encode(element, code_map)
+        encoded: List[Union[int, None]] = [None] * length
+        for start, end, code in spans:
+            encoded[start:end] = [code] * (end - start)
+        offsets = [(start, end) for start, end, _ in spans]
         labels_and_offsets = {'label_ids': encoded, 'offsets': offsets, 'xml': tostring(element)}
 
         for start, end in offsets:
@@ -486,47 +825,102 @@ class XMLEncoder(XMLExtractor):
                 assert encoded[start] == encoded[end-1], f"{encoded[start:end]}\nstart={start}, end={end},\n{innertext(element)}\n{innertext(element)[start:end]}\n{tostring(element)}"
         return labels_and_offsets
 
-    def _encode(self, element, code_map: CodeMap, pos: int = 0) -> Tuple[Any, List[Tuple[int, int]], int]:
-        """Encodes XML Element into a list of character-level label codes (int).
-        Positions that are not assigned with any code are filled with None.
+    def encode_array(self, element, code_map: CodeMap) -> dict:
+        """Same as `encode` but the label codes are returned as a compact `array('b')`,
+        with 0 for the positions that are not assigned with any code.
+
         Args:
             element (`lxml.etree.Element`): The XML Element to encode
             code_map (CodeMap): A dictionary with the constraints and the corresponding code
                 to convert the XML element into a label code.
-            pos (int, optional): The position of the element in the text. Defaults to 0.
 
         Returns:
-            (Tuple[List[int], List[Tuple[int, int]], int]): A tuple with:
-                - the list of label ids
-                - the offsets indicating the start and end postition of each labeled element
-                - the position of the element in the text
+            (Dict[array, List[Tuple[int, int]]]): 'label_ids', 'offsets' and 'xml' as in `encode`.
         """
-        text_element = element.text or ''
-        L_text = len(text_element)
-        text_tail = element.tail or ''
-        L_tail = len(text_tail)
-        code = self._get_code(element, code_map)
-        inner_text = innertext(element)
-        L_inner_text = len(inner_text)
-        if code:
-            if L_inner_text > 0:
-                encoded = [code] * L_inner_text
-                offsets = [(pos, pos + L_inner_text)]
-                pos += L_inner_text
-            else:
-                encoded = []
-                offsets = []
-        else:
-            encoded = [None] * L_text
-            offsets = []
-            pos += L_text
-            for child in element:
-                child_encoded, child_offsets, pos = self._encode(child, code_map, pos=pos)
-                encoded += child_encoded
-                offsets += child_offsets
-        encoded = encoded + [None] * L_tail
-        pos += L_tail
-        return encoded, offsets, pos
+        spans, length = self._encode(element, code_map)
+        encoded = array('b', bytes(length))
+        for start, end, code in spans:
+            encoded[start:end] = array('b', [code]) * (end - start)
+        offsets = [(start, end) for start, end, _ in spans]
+        return {'label_ids': encoded, 'offsets': offsets, 'xml': tostring(element)}
+
+    def encode_many(self, element, code_maps: List[CodeMap]) -> List[dict]:
+        """Encodes XML Element with several CodeMaps in a single traversal of the tree.
+
+        Args:
+            element (`lxml.etree.Element`): The XML Element to encode
+            code_maps (List[CodeMap]): The CodeMaps, or SourceDataCodes, to encode the element with.
+
+        Returns:
+            (List[dict]): For each CodeMap, the same dictionary as returned by `encode`.
+        """
+        spans_per_map, lengths = self._encode_many(element, code_maps)
+        xml = tostring(element)
+        results = []
+        for spans, length in zip(spans_per_map, lengths):
+            encoded: List[Union[int, None]] = [None] * length
+            for start, end, code in spans:
+                encoded[start:end] = [code] * (end - start)
+            offsets = [(start, end) for start, end, _ in spans]
+            results.append({'label_ids': encoded, 'offsets': offsets, 'xml': xml})
+        return results
+
+    def _encode(self, element, code_map: CodeMap) -> Tuple[List[Tuple[int, int, int]], int]:
+        """Finds the spans of text labeled with a code in a single depth-first walk of the XML Element.
+        Elements nested in a labeled element are not visited, the text of the labeled element is only measured.
+
+        Args:
+            element (`lxml.etree.Element`): The XML Element to encode
+            code_map (CodeMap): A dictionary with the constraints and the corresponding code
+                to convert the XML element into a label code.
+
+        Returns:
+            (Tuple[List[Tuple[int, int, int]], int]): A tuple with:
+                - the start, end and code of each labeled element, in document order
+                - the length of the text of the element, including its tail
+        """
+        spans_per_map, lengths = self._encode_many(element, [code_map])
+        return spans_per_map[0], lengths[0]
+
+    def _encode_many(self, element, code_maps: List[CodeMap]) -> Tuple[List[List[Tuple[int, int, int]]], List[int]]:
+        """Same as `_encode` for several CodeMaps at once. Each CodeMap keeps its own position,
+        and stops descending into the elements it labeled.
+
+        Returns:
+            (Tuple[List[List[Tuple[int, int, int]]], List[int]]): The spans and the length of the
+                encoded text for each CodeMap.
+        """
+        n_maps = len(code_maps)
+        spans: List[List[Tuple[int, int, int]]] = [[] for _ in range(n_maps)]
+        pos = [0] * n_maps
+        # (element, maps still descending, True) marks the end of the element, where its tail starts
+        stack = [(element, tuple(range(n_maps)), False)]
+        while stack:
+            current, active, closing = stack.pop()
+            if closing:
+                L_tail = len(current.tail or '')
+                for i in active:
+                    pos[i] += L_tail
+                continue
+            stack.append((current, active, True))
+            L_text = len(current.text or '')
+            L_inner_text = None
+            descending = []
+            for i in active:
+                code = self._get_code(current, code_maps[i])
+                if code:
+                    if L_inner_text is None:
+                        L_inner_text = sum(len(t) for t in current.itertext())
+                    if L_inner_text > 0:
+                        spans[i].append((pos[i], pos[i] + L_inner_text, code))
+                        pos[i] += L_inner_text
+                else:
+                    pos[i] += L_text
+                    descending.append(i)
+            if descending:
+                children_active = tuple(descending)
+                stack.extend((child, children_active, False) for child in reversed(current))
+        return spans, pos
 
     def _get_code(self, element, code_map: CodeMap) -> Union[int, None]:
         """Returns the code for the element if it matches the constraints in code_map."""
@@ -542,34 +936,254 @@ class XMLEncoder(XMLExtractor):
                     return code
         return None
 
+    def _label_buffers(self, element, code_maps: List[CodeMap]) -> List[np.ndarray]:
+        """Character-level label codes of the element for several CodeMaps, as integer arrays
+        with 0 for the positions that are not assigned with any code."""
+        spans_per_map, lengths = self._encode_many(element, code_maps)
+        buffers = []
+        for spans, length in zip(spans_per_map, lengths):
+            buffer = np.zeros(length, dtype=np.int64)
+            for start, end, code in spans:
+                buffer[start:end] = code
+            buffers.append(buffer)
+        return buffers
+
+    @staticmethod
+    def _segment_words(text: Union[str, List[str]]) -> Tuple[List[str], np.ndarray, np.ndarray]:
+        """Splits the text into words in a single regex scan: runs of alphanumeric characters,
+        and every other character except spaces. A trailing run of alphanumeric characters is dropped.
+
+        Returns:
+            Tuple[List[str], np.ndarray, np.ndarray]: The words, the position of their first character
+            and whether they are a run of alphanumeric characters.
+        """
+        if not isinstance(text, str):
+            text = "".join(text)
+        matches = list(WORD_RE.finditer(text))
+        if matches and matches[-1].lastindex == 1 and matches[-1].end() == len(text):
+            matches.pop()
+        words = [m.group() for m in matches]
+        starts = np.fromiter((m.start() for m in matches), dtype=np.intp, count=len(matches))
+        is_run = np.fromiter((m.lastindex == 1 for m in matches), dtype=bool, count=len(matches))
+        return words, starts, is_run
+
     @staticmethod
-    def _labels_to_iob2(code_map: CodeMap, labels: List[int]) -> List[str]:
+    def _labels_to_iob2(code_map: CodeMap, labels: List[str]) -> List[str]:
         """
         Args:
             code_map (CodeMap): CodeMap, each specifying The XML-to-code mapping of label codes
                                 to specific combinations of tag name and attribute values.
-            labels (List):        List of labels for each word inside the XML elements.
+            labels (List):        List of labels for each word inside the XML elements, "O" or the label code.
 
         Returns:
             List[str]           Word-level tokenized labels in IOB2 format
 
         """
-        iob2_labels = []
+        codes = np.array([0 if label == "O" else int(label) for label in labels], dtype=np.int64)
+        return XMLEncoder._codes_to_iob2(code_map, codes)
+
+    @staticmethod
+    def _codes_to_iob2(code_map: CodeMap, codes: np.ndarray) -> List[str]:
+        """IOB2 labels of word-level label codes, 0 being outside: a code starts an entity (B-) unless
+        the previous word has the same code (I-). `iob2_labels` holds the B- and I- labels of code c at 2c - 1 and 2c.
+        """
+        if code_map.name == "panel_start":
+            return ["O"] * len(codes)
+        previous = np.concatenate(([0], codes[:-1]))
+        index = np.where(codes == 0, 0, 2 * codes - (codes != previous))
+        return np.asarray(code_map.iob2_labels, dtype=object)[index].tolist()
+
+
+# encoder of the current worker process, set once per process by `XMLEncoder._encode_file_list`
+class DatasetWriter:
+    """Writes the examples of an encoder into the files of each split as they are encoded,
+    the files and the index of the shards being closed on exit.
+
+    Args:
+        encoder (XMLEncoder): The encoder of the examples, giving the schema of the parquet files.
+        outfolder (str): Path to the output folder.
+        format (str, optional): "jsonl" or "parquet". Defaults to "jsonl".
+        buffer_size (int, optional): Size of the write buffer of each jsonl file in bytes. Defaults to 1 MB.
+        row_group_size (int, optional): Number of examples per parquet row group. Defaults to 1000.
+        max_shard_size (int, optional): If provided, each split is written into shards listed in `index.json`,
+            as with `XMLEncoder.write_jsonl` and `XMLEncoder.write_parquet`. Defaults to None.
+        compression (str, optional): Compression of the files. Defaults to None.
+    """
+
+    def __init__(
+            self,
+            encoder: XMLEncoder,
+            outfolder: str,
+            format: str = "jsonl",
+            buffer_size: int = 1024**2,
+            row_group_size: int = 1000,
+            max_shard_size: Union[int, None] = None,
+            compression: Union[str, None] = None,
+            ):
+        self.encoder = encoder
+        self.outfolder = outfolder
+        self.format = format
+        self.row_group_size = row_group_size
+        self.max_shard_size = max_shard_size
+        self.counts: Dict[str, int] = {}
+        if format == "jsonl":
+            self._writers = {
+                split: JSONLinesShardWriter(outfolder, split, max_shard_size, compression, buffer_size)
+                for split in SPLITS
+            }
+        elif format == "parquet":
+            self._schema = encoder.arrow_schema()
+            self._buffers: Dict[str, List[Dict[str, list]]] = {split: [] for split in SPLITS}
+            self._writers = {
+                split: ParquetShardWriter(outfolder, split, self._schema, max_shard_size, compression)
+                for split in SPLITS
+            }
+        else:
+            raise ValueError(f"Invalid format {format}. Must be jsonl or parquet")
+
+    def write(self, split: str, example: Dict[str, list]):
+        if self.format == "jsonl":
+            self._writers[split].write(example)
+            return
+        self._buffers[split].append(example)
+        if len(self._buffers[split]) == self.row_group_size:
+            self._writers[split].write_batch(self.encoder._record_batch(self._buffers[split], self._schema))
+            self._buffers[split] = []
+
+    def __enter__(self) -> "DatasetWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None and self.format == "parquet":
+                for split, examples in self._buffers.items():
+                    if examples:
+                        self._writers[split].write_batch(self.encoder._record_batch(examples, self._schema))
+        finally:
+            shards = {split: writer.close() for split, writer in self._writers.items()}
+        if exc_type is None:
+            if self.max_shard_size is not None:
+                write_index(self.outfolder, shards)
+            self.counts = {
+                split: sum(shard["num_examples"] for shard in split_shards) for split, split_shards in shards.items()
+            }
+
+
+def encode_files(encoders: List[XMLEncoder], num_proc: int = 1) -> Iterator[Tuple[str, List[list]]]:
+    """Encodes the files of the split dictionary with the `_encode_xml_example` of several encoders in a single
+    pass. Encoders sharing an `XMLCorpus` parse each file once, in the worker processes as well, and the examples
+    of a file are released once all of them encoded it, as long as every encoder registered with the corpus is
+    part of the pass. With a manifest, the encodings of the files that did not change are read back instead
+    and the new ones are recorded.
+
+    Args:
+        encoders (List[XMLEncoder]): Encoders with the same split dictionary.
+        num_proc (int, optional): Number of worker processes. Files are sent to the workers
+            in chunks. Defaults to 1, encoding the files in the current process.
+
+    Yields:
+        Tuple[str, List[list]]: File name and encoded examples of each encoder, in the order of `split_dict`
+            whatever the number of processes.
+    """
+    file_names = list(encoders[0].split_dict)
+    if any(list(encoder.split_dict) != file_names for encoder in encoders):
+        raise ValueError("The encoders must have the same split dictionary")
+    to_encode = []
+    for file_name in file_names:
+        indices = tuple(i for i, encoder in enumerate(encoders) if file_name not in encoder._fresh)
+        if indices:
+            to_encode.append((file_name, indices))
+    encoded = _encode_file_list(encoders, to_encode, num_proc)
+    manifests = {id(encoder.manifest): encoder.manifest for encoder in encoders if encoder.manifest is not None}
+    try:
+        for file_name in tqdm(file_names):
+            fresh = [file_name in encoder._fresh for encoder in encoders]
+            new_examples = iter(next(encoded) if not all(fresh) else [])
+            results = []
+            for encoder, is_fresh in zip(encoders, fresh):
+                if is_fresh:
+                    encoder._release(file_name)
+                    results.append(encoder.manifest.get(file_name, encoder._manifest_key))  # type: ignore
+                    continue
+                examples = next(new_examples)
+                if encoder.manifest is not None:
+                    encoder.manifest.set(file_name, encoder._manifest_key, encoder._content_hashes[file_name], examples)
+                results.append(examples)
+            yield file_name, results
+    finally:
+        encoded.close()
+        for manifest in manifests.values():
+            manifest.commit()
+
+
+def write_datasets(
+        generators: Dict[str, XMLEncoder],
+        outfolder: str,
+        format: str = "jsonl",
+        num_proc: int = 1,
+        **kwargs,
+        ) -> Dict[str, Dict[str, int]]:
+    """Writes the datasets of several generators in a single pass over the XML files, each file being encoded
+    by every generator before the next one is extracted. Generators sharing an `XMLCorpus` thus parse each file
+    once while only holding the examples of the file being encoded.
+
+    Args:
+        generators (Dict[str, XMLEncoder]): Generators with the same split dictionary, by task.
+        outfolder (str): Path to the output folder, with a subfolder per task.
+        format (str, optional): "jsonl" or "parquet". Defaults to "jsonl".
+        num_proc (int, optional): Number of processes encoding the XML files. Defaults to 1.
+        **kwargs: `buffer_size`, `row_group_size`, `max_shard_size` and `compression` of `DatasetWriter`.
+
+    Returns:
+        Dict[str, Dict[str, int]]: Number of examples written in each split, by task.
+    """
+    with ExitStack() as stack:
+        writers = {
+            task: stack.enter_context(DatasetWriter(generator, os.path.join(outfolder, task), format, **kwargs))
+            for task, generator in generators.items()
+        }
+        for file_name, encoded in encode_files(list(generators.values()), num_proc):
+            for (task, generator), examples in zip(generators.items(), encoded):
+                for split, example in generator._file_examples(file_name, examples):
+                    writers[task].write(split, example)
+    return {task: writer.counts for task, writer in writers.items()}
+
+
+def _encode_file_list(encoders: List[XMLEncoder], to_encode: List[Tuple[str, Tuple[int, ...]]], num_proc: int) -> Iterator[List[list]]:
+    """Encodes each file with the encoders at the given indices."""
+    if num_proc <= 1 or len(to_encode) <= 1:
+        for file_name, indices in to_encode:
+            yield [encoders[i]._encode_xml_example(file_name) for i in indices]
+        return
+    shared = [encoder.corpus is not None for encoder in encoders]
+    file_names = [file_name for file_name, _ in to_encode]
+    indices_list = [indices for _, indices in to_encode]
+    chunksize = max(1, len(to_encode) // (num_proc * 4))
+    with ProcessPoolExecutor(max_workers=num_proc, initializer=_init_worker, initargs=(encoders, shared)) as executor:
+        results = executor.map(_encode_file, file_names, indices_list, chunksize=chunksize)
+        for (file_name, indices), examples in zip(to_encode, results):
+            for i in indices:
+                encoders[i]._release(file_name)
+            yield examples
+
+
+_worker_encoders: List[XMLEncoder] = []
 
-        for idx, label in enumerate(labels):
-            if code_map.name == "panel_start":
-                iob2_labels.append("O")
 
-            if code_map.name != "panel_start":
-                if label == "O":
-                    iob2_labels.append(label)
+def _init_worker(encoders: List[XMLEncoder], shared: List[bool]):
+    # the encoders that share a corpus in the main process share one in the worker
+    global _worker_encoders
+    corpus = XMLCorpus()
+    for encoder, in_corpus in zip(encoders, shared):
+        if in_corpus:
+            encoder.corpus = corpus
+            corpus.register(encoder)
+    _worker_encoders = encoders
 
-                if label != "O":
-                    if idx == 0:
-                        iob2_labels.append(code_map.iob2_labels[int(label) * 2 - 1])
-                    if (idx > 0) and (labels[idx - 1] != label):
-                        iob2_labels.append(code_map.iob2_labels[int(label) * 2 - 1])
-                    if (idx > 0) and (labels[idx - 1] == label):
-                        iob2_labels.append(code_map.iob2_labels[int(label) * 2])
 
-        return iob2_labels
+def _encode_file(file_name: str, indices: Tuple[int, ...]) -> List[list]:
+    encoded = [_worker_encoders[i]._encode_xml_example(file_name) for i in indices]
+    for i, encoder in enumerate(_worker_encoders):
+        if i not in indices:
+            encoder._release(file_name)
+    return encoded
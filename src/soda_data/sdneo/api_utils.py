@@ -1,13 +1,18 @@
+import asyncio
+import json
 import os
 from json.decoder import JSONDecodeError
-from typing import List, Union
+from typing import Dict, List, Union
+from urllib.parse import urlparse
 
+import aiohttp
 import requests
 from dotenv import load_dotenv
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 
 from ..common import logging
+from ..common.http_cache import BaseHTTPCache, CachedSession
 
 load_dotenv()
 FROM = str(os.getenv("FROM"))
@@ -25,8 +30,19 @@ class ResilientRequests:
     Creates a resilient session that will retry several times when a query fails.
     """
 
-    def __init__(self, user=None, password=None):
-        self.session_retry = self.requests_retry_session()
+    def __init__(
+        self,
+        user=None,
+        password=None,
+        pool_connections=10,
+        pool_maxsize=10,
+        cache: Union[BaseHTTPCache, None] = None,
+    ):
+        self.session_retry = self.requests_retry_session(
+            session=CachedSession(cache) if cache is not None else None,
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+        )
         if user is not None and password is not None:
             self.session_retry.auth = (user, password)
         self.session_retry.headers.update({"Accept": "application/json", "From": FROM})
@@ -37,6 +53,8 @@ class ResilientRequests:
         backoff_factor=0.3,
         status_forcelist=(500, 502, 504),
         session=None,
+        pool_connections=10,
+        pool_maxsize=10,
     ) -> requests.Session:
         """Creates a resilient session that will retry several times when a query fails.
 
@@ -45,6 +63,10 @@ class ResilientRequests:
             backoff_factor (float, optional): Defaults to 0.3.
             status_forcelist (tuple, optional): Defaults to (500, 502, 504).
             session (requests.Session, optional): A Requests session. Defaults to None.
+            pool_connections (int, optional): Number of hosts for which connection pools
+                are kept. Defaults to 10.
+            pool_maxsize (int, optional): Maximum number of connections kept alive
+                per host. Defaults to 10.
 
         Returns:
             requests.Session: A Requests session.
@@ -57,11 +79,34 @@ class ResilientRequests:
             backoff_factor=backoff_factor,
             status_forcelist=status_forcelist,
         )
-        adapter = HTTPAdapter(max_retries=retry)
+        adapter = HTTPAdapter(
+            max_retries=retry,
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+        )
         session.mount("http://", adapter)
         session.mount("https://", adapter)
         return session
 
+    def connection_stats(self) -> Dict[str, int]:
+        """Returns how many requests were sent through the session's connection pools,
+        how many connections were opened for them and thus how many requests reused a connection.
+        """
+        n_requests, n_connections = 0, 0
+        adapters = {id(a): a for a in self.session_retry.adapters.values()}.values()
+        for adapter in adapters:
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    n_requests += pool.num_requests
+                    n_connections += pool.num_connections
+        return {
+            "requests": n_requests,
+            "connections": n_connections,
+            "reused": n_requests - n_connections,
+        }
+
     def request(
         self, url: str, params: Union[dict, None] = None
     ) -> Union[None, List[dict], dict]:
@@ -88,3 +133,134 @@ class ResilientRequests:
             logger.error("server query failed")
             logger.error(e)
         return data
+
+
+class AsyncResilientRequests:
+    """
+    Asynchronous counterpart of ResilientRequests. Requests are retried with the same
+    policy as `ResilientRequests.requests_retry_session`, the number of requests in flight
+    is bounded by a semaphore and requests to a same host can be rate limited.
+    Must be used as an async context manager:
+
+        async with AsyncResilientRequests(user, password) as client:
+            data = await client.request(url)
+    """
+
+    def __init__(
+        self,
+        user=None,
+        password=None,
+        max_concurrency=32,
+        rate_limit=0.0,
+        retries=4,
+        backoff_factor=0.3,
+        status_forcelist=(500, 502, 504),
+    ):
+        """
+        Args:
+            user (str, optional): User name for basic authentication. Defaults to None.
+            password (str, optional): Password for basic authentication. Defaults to None.
+            max_concurrency (int, optional): Maximum number of requests in flight. Defaults to 32.
+            rate_limit (float, optional): Maximum number of requests per second to a same host.
+                No limit if 0. Defaults to 0.0.
+            retries (int, optional): Maximum number of retries. Defaults to 4.
+            backoff_factor (float, optional): Defaults to 0.3.
+            status_forcelist (tuple, optional): Defaults to (500, 502, 504).
+        """
+        self.auth = (
+            aiohttp.BasicAuth(user, password)
+            if user is not None and password is not None
+            else None
+        )
+        self.headers = {"Accept": "application/json", "From": FROM}
+        self.max_concurrency = max_concurrency
+        self.rate_limit = rate_limit
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.status_forcelist = status_forcelist
+        self.session: Union[aiohttp.ClientSession, None] = None
+        self._semaphore: Union[asyncio.Semaphore, None] = None
+        self._host_locks: Dict[str, asyncio.Lock] = {}
+        self._host_next_slot: Dict[str, float] = {}
+
+    async def __aenter__(self) -> "AsyncResilientRequests":
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.session = aiohttp.ClientSession(
+            auth=self.auth,
+            headers=self.headers,
+            timeout=aiohttp.ClientTimeout(total=30),
+            connector=aiohttp.TCPConnector(limit=self.max_concurrency),
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def _backoff_time(self, n_errors: int) -> float:
+        """Same backoff as urllib3's Retry: no wait after the first error,
+        then backoff_factor * 2 ** (n_errors - 1) seconds."""
+        if n_errors <= 1:
+            return 0.0
+        return self.backoff_factor * (2 ** (n_errors - 1))
+
+    async def _throttle(self, url: str):
+        """Waits for the next free slot of the host if requests are rate limited."""
+        if not self.rate_limit:
+            return
+        host = urlparse(url).netloc
+        lock = self._host_locks.setdefault(host, asyncio.Lock())
+        async with lock:
+            now = asyncio.get_running_loop().time()
+            next_slot = max(self._host_next_slot.get(host, now), now)
+            if next_slot > now:
+                await asyncio.sleep(next_slot - now)
+            self._host_next_slot[host] = next_slot + 1.0 / self.rate_limit
+
+    async def request(
+        self, url: str, params: Union[dict, None] = None
+    ) -> Union[None, List[dict], dict]:
+        """
+        Performs a request to a given url and returns the data as a json object.
+        """
+        assert self.session is not None and self._semaphore is not None, (
+            "AsyncResilientRequests must be used as an async context manager"
+        )
+        data = {}
+        n_errors = 0
+        async with self._semaphore:
+            while True:
+                await self._throttle(url)
+                try:
+                    async with self.session.get(url, params=params) as response:
+                        if (
+                            response.status in self.status_forcelist
+                            and n_errors < self.retries
+                        ):
+                            n_errors += 1
+                            await asyncio.sleep(self._backoff_time(n_errors))
+                            continue
+                        if response.status == 200:
+                            text = await response.text()
+                            try:
+                                data = json.loads(text)
+                            except JSONDecodeError:
+                                logger.error(
+                                    f"""skipping {url}: response is string and not json data:
+                                    '''{text}'''"""
+                                )
+                                data = {}
+                        else:
+                            logger.debug(
+                                f"failed loading json object with {url} ({response.status})"
+                            )
+                        return data
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if n_errors < self.retries:
+                        n_errors += 1
+                        await asyncio.sleep(self._backoff_time(n_errors))
+                        continue
+                    logger.error("server query failed")
+                    logger.error(e)
+                    return data
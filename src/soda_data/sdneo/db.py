@@ -1,7 +1,7 @@
 import re
-from typing import Callable, Dict, List, Tuple, Union
+from typing import Callable, Dict, Iterator, List, Tuple, Union
 
-from neo4j import GraphDatabase, Transaction
+from neo4j import GraphDatabase, Record, Transaction
 
 from ..common import logging
 
@@ -106,6 +106,14 @@ class Instance:
             results = session.write_transaction(tx_funct, q.code, q.params)
             return results
 
+    def stream(self, q: Query) -> Iterator[Record]:
+        """Runs a read query and yields the records as the driver receives them,
+        instead of materializing the full result first."""
+        with self._driver.session() as session:
+            results = session.run(q.code, q.params)
+            for record in results:
+                yield record
+
     def exists(self, q: Query) -> bool:
         def tx_funct(tx, code, params):
             results = tx.run(code, params)
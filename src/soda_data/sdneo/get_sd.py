@@ -1,6 +1,8 @@
+import asyncio
 from argparse import ArgumentParser
 
-from .smartnode import Collection
+from ..common.http_cache import HTTPCache, RedisHTTPCache
+from .smartnode import Collection, SmartNode
 
 if __name__ == "__main__":
     parser = ArgumentParser(description="Download the SourceData xml tagged dataset.")
@@ -9,23 +11,98 @@ if __name__ == "__main__":
         "--name", default="PUBLICSEARCH", help="The name of the collection to download."
     )
     parser.add_argument(
-        "--api", default="neo", choices=["sdapi", "neo"], help="Data source"
+        "--api", default="neo", choices=["sdapi", "sdapi_async", "neo"], help="Data source"
+    )
+    parser.add_argument(
+        "--subtree",
+        action="store_true",
+        help="Fetch each article subtree from neo4j with a single query.",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=0,
+        help="Number of article subtrees fetched from neo4j per query (0 to disable).",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of threads exporting articles from neo4j concurrently.",
+    )
+    parser.add_argument(
+        "--pool_maxsize",
+        type=int,
+        default=10,
+        help="Maximum number of connections kept alive to the SourceData REST API.",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=32,
+        help="Maximum number of concurrent requests to the SourceData REST API (sdapi_async).",
+    )
+    parser.add_argument(
+        "--rate_limit",
+        type=float,
+        default=0.0,
+        help="Maximum number of requests per second to the SourceData REST API (0 for no limit).",
+    )
+    parser.add_argument(
+        "--http_cache",
+        nargs="?",
+        const="sqlite",
+        choices=["sqlite", "redis"],
+        help="Serve the SourceData and EuropePMC responses from a cache on disk under CACHE "
+        "(sqlite) or shared by all workers through the redis server at REDIS_URL (redis).",
+    )
+    parser.add_argument(
+        "--cache_ttl",
+        type=float,
+        default=24 * 60 * 60,
+        help="Seconds during which cached responses are used without revalidation.",
     )
 
     args = parser.parse_args()
     collection_name = args.name
     dest_dir = args.dest_dir
     print(args.api)
+    if args.http_cache == "redis":
+        cache = RedisHTTPCache(ttl=args.cache_ttl)
+    elif args.http_cache == "sqlite":
+        cache = HTTPCache(ttl=args.cache_ttl)
+    else:
+        cache = None
 
     if args.api == "sdapi":
+        SmartNode.configure_sd_api_session(pool_maxsize=args.pool_maxsize, cache=cache)
         collection = Collection(
             auto_save=True, sub_dir=dest_dir, overwrite=True
         ).from_sd_REST_API(collection_name)
+        print(f"SourceData API connections: {SmartNode.SD_API_SESSION.connection_stats()}")
+    elif args.api == "sdapi_async":
+        collection = asyncio.run(
+            Collection(
+                auto_save=True, sub_dir=dest_dir, overwrite=True
+            ).from_sd_REST_API_async(
+                collection_name,
+                max_concurrency=args.concurrency,
+                rate_limit=args.rate_limit,
+            )
+        )
     elif args.api == "neo":
+        SmartNode.HTTP_CACHE = cache
         collection = Collection(
             auto_save=True, sub_dir=dest_dir, overwrite=True
-        ).from_neo(collection_name)
+        ).from_neo(
+            collection_name,
+            subtree=args.subtree,
+            batch_size=args.batch_size,
+            workers=args.workers,
+        )
     else:
         raise ValueError("Invalid API")
 
     print(f"downloaded collection: {collection.props}")
+    if cache is not None:
+        print(f"HTTP cache: {cache.stats()}")
@@ -118,6 +118,84 @@ RETURN
     ]
 
 
+# One record per article node, with all its figures, their panels and ordered tags.
+# As in GET_LIST_OF_TAGS and GET_PANEL_PROPERTIES, every article node with the DOI is included,
+# `in_collection` telling those linked to the collection. Article._from_neo_subtree takes the
+# properties, the figure labels and the panel ids from these only, as the other per node queries,
+# and merges the tags of all the nodes.
+class GET_ARTICLE_SUBTREE(Query):
+    code = """
+UNWIND $dois AS doi
+MATCH (:SDCollection {name: $collection_name})-->(:SDArticle {doi: doi})
+WITH DISTINCT doi
+MATCH (article:SDArticle {doi: doi})
+OPTIONAL MATCH (collection:SDCollection {name: $collection_name})-->(article)
+WITH article, count(collection) > 0 AS in_collection
+OPTIONAL MATCH (article)-->(figure:SDFigure)-->(:SDPanel)
+WITH DISTINCT article, in_collection, figure
+OPTIONAL MATCH (figure)-->(panel:SDPanel)-->(:SDTag)
+WITH DISTINCT article, in_collection, figure, panel
+CALL {
+    WITH panel
+    OPTIONAL MATCH (panel)-->(tag:SDTag)
+    WITH tag ORDER BY toInteger(tag.tag_id)
+    RETURN COLLECT(properties(tag)) AS tag_id_list
+}
+WITH article, in_collection, figure, panel, tag_id_list ORDER BY split(panel.panel_label,"-")[1]
+WITH article, in_collection, figure, COLLECT(
+    CASE WHEN panel IS NOT NULL THEN {
+        paper_doi: panel.paper_doi,
+        figure_label: panel.fig_label,
+        figure_id: figure.fig_label,
+        panel_id: panel.panel_id,
+        panel_label: panel.panel_label,
+        panel_number: split(panel.panel_label,"-")[1],
+        caption: panel.caption,
+        formatted_caption: panel.formatted_caption,
+        href: panel.href,
+        coords: panel.coords,
+        tag_id_list: tag_id_list
+    } END
+) AS panel_list
+RETURN
+    article.doi AS doi,
+    article.title AS title,
+    article.journal_name AS journal_name,
+    article.pub_date AS pub_date,
+    article.pmid AS pmid,
+    article.pmcid AS pmcid,
+    article.import_id AS import_id,
+    article.pub_year AS pub_year,
+    article.nb_figures AS nb_figures,
+    in_collection,
+    COLLECT(
+        CASE WHEN figure IS NOT NULL THEN {
+            paper_doi: article.doi,
+            figure_label: figure.fig_label,
+            figure_id: split(figure.href,"=")[1],
+            figure_title: figure.fig_title,
+            href: figure.href,
+            captioned: coalesce(figure.caption <> "", false),
+            panel_list: panel_list
+        } END
+    ) AS figure_list
+ORDER BY in_collection DESC
+    """
+    returns = [
+        "doi",
+        "title",
+        "journal_name",
+        "pub_date",
+        "pmid",
+        "pmcid",
+        "import_id",
+        "pub_year",
+        "nb_figures",
+        "in_collection",
+        "figure_list",
+    ]
+
+
 class GET_PANEL_PROPERTIES(Query):
     code = """
     MATCH (article: SDArticle {doi: $doi})-->(figure: SDFigure {fig_label: $figure_label})-->(panel:SDPanel)-->(tag: SDTag)
@@ -1,7 +1,11 @@
+import asyncio
 from abc import ABC
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
 from pathlib import Path
-from typing import List, Union
+from typing import Callable, Dict, List, Tuple, Union
 
+import requests
 from lxml.etree import Element, ElementTree, XMLSyntaxError, fromstring, tostring
 from tqdm import tqdm
 
@@ -9,8 +13,9 @@ from dataclasses import dataclass, field
 
 from ..apis.epmc import EPMC
 from ..common import logging
+from ..common.http_cache import BaseHTTPCache
 from . import DB, SD_API_PASSWORD, SD_API_USERNAME
-from .api_utils import ResilientRequests
+from .api_utils import AsyncResilientRequests, ResilientRequests
 from .data_classes import (
     ArticleDoiList,
     ArticleProperties,
@@ -24,6 +29,7 @@ from .data_classes import (
 from .db import Instance
 from .queries import (
     GET_ARTICLE_PROPS,
+    GET_ARTICLE_SUBTREE,
     GET_FIGURE_PROPERTIES,
     GET_LIST_OF_ARTICLES,
     GET_LIST_OF_FIGURES,
@@ -62,6 +68,10 @@ class SmartNode(ABC):
     # SOURCE_XML_DIR: str = "xml_source_files/"
     DEST_XML_DIR: str = "xml_destination_files/"
     XML_SERIALIZER = XMLSerializer()
+    # shared by all the nodes so that connections to the REST API are kept alive and reused
+    SD_API_SESSION = ResilientRequests(SD_API_USERNAME, SD_API_PASSWORD)
+    # optional cache of the SourceData and EuropePMC responses (SQLite or Redis)
+    HTTP_CACHE: Union[BaseHTTPCache, None] = None
 
     def __init__(self, ephemeral: bool = False):
         self.props: Properties
@@ -77,6 +87,20 @@ class SmartNode(ABC):
         """Instantiates properties and children from the SourceData REST API"""
         raise NotImplementedError
 
+    async def from_sd_REST_API_async(self, *args) -> "SmartNode":
+        """Instantiates properties and children from the SourceData REST API, concurrently"""
+        raise NotImplementedError
+
+    @staticmethod
+    def _response_dict(response: Union[None, List[dict], dict]) -> dict:
+        """Returns the first element of a list response, the response if it is a dict, else {}"""
+        if response and isinstance(response, list):
+            return response[0]
+        elif response and isinstance(response, dict):
+            return response
+        else:
+            return {}
+
     @property
     def relationships(self) -> List[Relationship]:
         return self._relationships
@@ -85,10 +109,36 @@ class SmartNode(ABC):
     def relationships(self, rel: List[Relationship]):
         self._relationships = rel
 
+    @classmethod
+    def configure_sd_api_session(
+        cls,
+        pool_connections: int = 10,
+        pool_maxsize: int = 10,
+        cache: Union[BaseHTTPCache, None] = None,
+    ):
+        """Replaces the session shared by all nodes to request the SourceData REST API.
+
+        Args:
+            pool_connections (int, optional): Number of hosts for which connection pools are kept.
+                Defaults to 10.
+            pool_maxsize (int, optional): Maximum number of connections kept alive per host.
+                Should be at least the number of concurrent requests. Defaults to 10.
+            cache (BaseHTTPCache, optional): Cache serving the SourceData and EuropePMC
+                responses. Defaults to None.
+        """
+        SmartNode.HTTP_CACHE = cache
+        SmartNode.SD_API_SESSION = ResilientRequests(
+            SD_API_USERNAME,
+            SD_API_PASSWORD,
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            cache=cache,
+        )
+
     @staticmethod
     def _request(url: str) -> Union[None, List[dict], dict]:
         """Makes a request to the SourceData REST API and returns the response as a dict"""
-        response = ResilientRequests(SD_API_USERNAME, SD_API_PASSWORD).request(url)
+        response = SmartNode.SD_API_SESSION.request(url)
         return response
 
     def _filepath(self, sub_dir: str, basename: str) -> Path:
@@ -227,8 +277,81 @@ class Collection(SmartNode):
         self._add_relationships("has_article", articles)
         return self._finish()
 
-    def from_neo(self, collection_name: str) -> SmartNode:
-        """Instantiates properties and children from the Neo4j database"""
+    async def from_sd_REST_API_async(
+        self, collection_name: str, max_concurrency: int = 32, rate_limit: float = 0.0
+    ) -> SmartNode:
+        """Instantiates properties and children from the SourceData REST API.
+        Articles, figures and panels are requested concurrently and the resulting
+        tree is the same as with `from_sd_REST_API`.
+
+        Args:
+            collection_name (str): Name of the collection.
+            max_concurrency (int, optional): Maximum number of requests in flight. Defaults to 32.
+            rate_limit (float, optional): Maximum number of requests per second to the API.
+                No limit if 0. Defaults to 0.0.
+        """
+        async with AsyncResilientRequests(
+            SD_API_USERNAME,
+            SD_API_PASSWORD,
+            max_concurrency=max_concurrency,
+            rate_limit=rate_limit,
+        ) as client:
+            logger.debug(f"from sd API collection {collection_name}")
+            url_get_collection = self.SD_REST_API + self.GET_COLLECTION + collection_name
+            self.url_get_collection = url_get_collection
+            response = await client.request(url_get_collection)
+            self.props = self.REST_API_PARSER.collection_props(
+                self._response_dict(response)
+            )
+            url_get_list_of_papers = (
+                str(self.SD_REST_API)
+                + str(self.GET_COLLECTION)
+                + str(self.props.collection_id)
+                + self.GET_LIST
+            )
+            response_2 = await client.request(url_get_list_of_papers)
+            if isinstance(response_2, list):
+                article_ids = self.REST_API_PARSER.children_of_collection(
+                    response_2, self.props.collection_id
+                )
+            else:
+                article_ids = []
+            articles = [self._new_article() for _ in article_ids]
+            with tqdm(total=len(article_ids), desc="articles") as progress:
+
+                async def load(article: "Article", article_id: str):
+                    await article.from_sd_REST_API_async(
+                        self.props.collection_id, article_id, client
+                    )
+                    progress.update(1)
+
+                await asyncio.gather(
+                    *[
+                        load(article, article_id)
+                        for article, article_id in zip(articles, article_ids)
+                    ]
+                )
+        self._add_relationships("has_article", articles)  # type: ignore
+        return self._finish()
+
+    def from_neo(
+        self,
+        collection_name: str,
+        subtree: bool = False,
+        batch_size: int = 0,
+        workers: int = 1,
+    ) -> SmartNode:
+        """Instantiates properties and children from the Neo4j database
+
+        Args:
+            collection_name (str): Name of the collection in the database.
+            subtree (bool, optional): Fetch each article with all its figures, panels
+                and tags in a single query instead of one query per node. Defaults to False.
+            batch_size (int, optional): If larger than 0, fetch the subtrees of this many
+                articles per query and stream the records back. Implies `subtree`. Defaults to 0.
+            workers (int, optional): Number of threads exporting articles (or batches of
+                articles) concurrently. They share the neo4j driver. Defaults to 1.
+        """
         collection_query = GET_NEO_COLLECTION(
             params={"collection_name": collection_name}
         )
@@ -238,22 +361,132 @@ class Collection(SmartNode):
             params={"collection_name": collection_name}
         )
         article_ids = ArticleDoiList(**DB.query(get_articles_list)[0].data())
-        articles = []
         article_list = (
             article_ids.doi_list if not self.is_test else article_ids.doi_list[:5]
         )
-        for article_id in tqdm(article_list, desc="articles"):
-            article = Article(
-                auto_save=self.auto_save,
-                ephemeral=self.auto_save,
-                overwrite=self.overwrite,
-                sub_dir=self.sub_dir,
+        abstracts = self._prefetch_abstracts(article_list)
+        if batch_size > 0:
+            batches = [
+                article_list[start:start + batch_size]
+                for start in range(0, len(article_list), batch_size)
+            ]
+            load: Callable[[List[str]], List[SmartNode]] = partial(
+                self._articles_from_neo_batch, abstracts=abstracts
             )
-            article.from_neo(self.props.collection_name, article_id)
-            articles.append(article)
+        else:
+            batches = [[doi] for doi in article_list]
+            load = partial(self._articles_from_neo, subtree=subtree, abstracts=abstracts)
+        articles = self._load_articles(load, batches, workers)
         self._add_relationships("has_article", articles)
         return self._finish()
 
+    def _load_articles(
+        self,
+        load: Callable[[List[str]], List[SmartNode]],
+        batches: List[List[str]],
+        workers: int = 1,
+    ) -> List[SmartNode]:
+        """Loads the batches of DOIs with `load`, using a pool of `workers` threads if larger than 1.
+        Articles are returned in the order of the batches. A batch that fails is logged and skipped."""
+        results: List[List[SmartNode]] = []
+        with tqdm(total=sum(len(batch) for batch in batches), desc="articles") as progress:
+            if workers > 1:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    futures = {
+                        executor.submit(self._try_load, load, batch): len(batch)
+                        for batch in batches
+                    }
+                    for future in as_completed(futures):
+                        progress.update(futures[future])
+                    results = [future.result() for future in futures]
+            else:
+                for batch in batches:
+                    results.append(self._try_load(load, batch))
+                    progress.update(len(batch))
+        return [article for result in results for article in result]
+
+    @staticmethod
+    def _try_load(
+        load: Callable[[List[str]], List[SmartNode]], batch: List[str]
+    ) -> List[SmartNode]:
+        try:
+            return load(batch)
+        except Exception as err:
+            logger.error(f"failed to export {batch}: {err!r}")
+            return []
+
+    def _prefetch_abstracts(self, doi_list: List[str]) -> Dict[str, str]:
+        """Fetches from EuropePMC the abstracts of the articles that will be exported,
+        with a few queries for the whole collection instead of one per article."""
+        to_export = [doi for doi in doi_list if not self._new_article()._exists(doi)]
+        if not to_export:
+            return {}
+        try:
+            return EPMC(cache=self.HTTP_CACHE).get_abstracts(to_export)
+        except requests.RequestException as err:
+            logger.warning(f"could not prefetch the abstracts, fetching them one by one: {err!r}")
+            return {}
+
+    def _articles_from_neo(
+        self,
+        doi_list: List[str],
+        subtree: bool = False,
+        abstracts: Dict[str, str] = {},
+    ) -> List[SmartNode]:
+        """Fetches the articles one by one, with one query per node or per article subtree."""
+        articles = []
+        for doi in doi_list:
+            article = self._new_article()
+            if subtree:
+                article.from_neo_subtree(
+                    self.props.collection_name, doi, abstract=abstracts.get(doi)
+                )
+            else:
+                article.from_neo(
+                    self.props.collection_name, doi, abstract=abstracts.get(doi)
+                )
+            articles.append(article)
+        return articles
+
+    def _articles_from_neo_batch(
+        self, doi_list: List[str], abstracts: Dict[str, str] = {}
+    ) -> List[SmartNode]:
+        """Fetches the subtrees of a batch of articles with a single query."""
+        batch = [doi for doi in doi_list if not self._new_article()._skip_existing(doi)]
+        if not batch:
+            return []
+        get_article_subtrees = GET_ARTICLE_SUBTREE(
+            params={"dois": batch, "collection_name": self.props.collection_name}
+        )
+        # duplicated article nodes give several records, merged as the per node queries do
+        subtrees: Dict[str, List[dict]] = {}
+        for record in DB.stream(get_article_subtrees):
+            subtree = record.data()
+            subtrees.setdefault(subtree["doi"], []).append(subtree)
+        articles = []
+        for doi in batch:
+            if doi not in subtrees:
+                continue
+            try:
+                article = self._new_article()._from_neo_subtree(
+                    subtrees[doi], abstract=abstracts.get(doi)
+                )
+                articles.append(article)
+            except Exception as err:
+                logger.error(f"failed to export {doi}: {err!r}")
+        missing = set(batch) - set(subtrees)
+        if missing:
+            logger.warning(f"no article found in neo4j for {missing}")
+        return articles
+
+    def _new_article(self) -> "Article":
+        return Article(
+            auto_save=self.auto_save,
+            ephemeral=self.auto_save,
+            overwrite=self.overwrite,
+            sub_dir=self.sub_dir,
+        )
+
 
 class Article(SmartNode):
     """SourceData Article object."""
@@ -324,8 +557,54 @@ class Article(SmartNode):
             )
             return None
 
-    def from_neo(self, collection_id: str, doi: str) -> Union[SmartNode, None]:
-        """Instantiates properties and children from the Neo4j database"""
+    async def from_sd_REST_API_async(
+        self, collection_id: str, doi: str, client: AsyncResilientRequests
+    ) -> Union[SmartNode, None]:
+        """Instantiates properties and children from the SourceData REST API, concurrently"""
+        if collection_id and doi:
+            logger.debug(f"from sd API article {doi}")
+            if self._skip_existing(doi):
+                return None
+            url = (
+                self.SD_REST_API
+                + self.GET_COLLECTION
+                + collection_id
+                + "/"
+                + self.GET_ARTICLE
+                + doi
+            )
+            response = await client.request(url)
+            if response:
+                response_dict = self._response_dict(response)
+                self.props: ArticleProperties = self.REST_API_PARSER.article_props(
+                    response_dict
+                )
+                fig_indices = self.REST_API_PARSER.children_of_article(
+                    response_dict, collection_id, doi
+                )
+                figures = await asyncio.gather(
+                    *[
+                        Figure().from_sd_REST_API_async(collection_id, doi, idx, client)
+                        for idx in fig_indices
+                    ]
+                )
+                self._add_relationships("has_figure", figures)  # type: ignore
+            else:
+                logger.warning(f"API response was empty, no props set for doi='{doi}'.")
+                return None
+            return self._finish()
+        else:
+            logger.error(
+                f"""Cannot create Article with empty params supplied:
+                ('{collection_id}, {doi}')!"""
+            )
+            return None
+
+    def from_neo(
+        self, collection_id: str, doi: str, abstract: Union[str, None] = None
+    ) -> Union[SmartNode, None]:
+        """Instantiates properties and children from the Neo4j database.
+        The abstract is fetched from EuropePMC unless it is given."""
         if collection_id and doi:
             logger.debug(f"  from sd API article {doi}")
             filepath = self._filepath(self.sub_dir, self._basename(doi))
@@ -337,8 +616,9 @@ class Article(SmartNode):
                     params={"doi": doi, "collection_name": collection_id}
                 )
                 properties = DB.query(get_article_properties)[0].data()
-                epmc = EPMC()
-                properties["abstract"] = epmc.get_abstract(doi)
+                if abstract is None:
+                    abstract = EPMC(cache=self.HTTP_CACHE).get_abstract(doi)
+                properties["abstract"] = abstract
                 self.props = ArticleProperties(**properties)
                 figures = []
 
@@ -360,6 +640,72 @@ class Article(SmartNode):
             )
             return None
 
+    def from_neo_subtree(
+        self, collection_id: str, doi: str, abstract: Union[str, None] = None
+    ) -> Union[SmartNode, None]:
+        """Instantiates properties and all descendants from the Neo4j database
+        with a single query returning the whole article subtree."""
+        if collection_id and doi:
+            logger.debug(f"  from neo article subtree {doi}")
+            if self._skip_existing(doi):
+                return None
+            else:
+                get_article_subtree = GET_ARTICLE_SUBTREE(
+                    params={"dois": [doi], "collection_name": collection_id}
+                )
+                subtrees = [record.data() for record in DB.query(get_article_subtree)]
+                return self._from_neo_subtree(subtrees, abstract=abstract)
+        else:
+            logger.error(
+                f"""Cannot create Article with empty params supplied:
+                ('{collection_id}, {doi}')!"""
+            )
+            return None
+
+    def _exists(self, doi: str) -> bool:
+        """Whether the article was already saved and must not be overwritten."""
+        filepath = self._filepath(self.sub_dir, self._basename(doi))
+        return self.auto_save and not self.overwrite and filepath.exists()
+
+    def _skip_existing(self, doi: str) -> bool:
+        """Same as `_exists`, with a warning if the article is skipped."""
+        if self._exists(doi):
+            filepath = self._filepath(self.sub_dir, self._basename(doi))
+            logger.warning(f"{filepath} already exists, not overwriting.")
+            return True
+        return False
+
+    def _from_neo_subtree(
+        self, subtrees: List[dict], abstract: Union[str, None] = None
+    ) -> SmartNode:
+        """Builds the article and its descendants from the GET_ARTICLE_SUBTREE records of a DOI,
+        one per article node. Properties are taken from the first record of the collection."""
+        collection_subtree = next(subtree for subtree in subtrees if subtree["in_collection"])
+        properties = {
+            k: v for k, v in collection_subtree.items() if k not in ("figure_list", "in_collection")
+        }
+        if abstract is None:
+            abstract = EPMC(cache=self.HTTP_CACHE).get_abstract(properties["doi"])
+        properties["abstract"] = abstract
+        self.props = ArticleProperties(**properties)
+        # as with GET_LIST_OF_FIGURES, the labels are those of the captioned figures of the collection,
+        # and all the figures with these labels are merged, whatever their caption or article node
+        figures_by_label: Dict[str, List[dict]] = {}
+        labels = set()
+        for subtree in subtrees:
+            for figure_data in subtree["figure_list"]:
+                figures_by_label.setdefault(figure_data["figure_label"], []).append(
+                    {**figure_data, "in_collection": subtree["in_collection"]}
+                )
+                if figure_data["captioned"] and subtree["in_collection"]:
+                    labels.add(figure_data["figure_label"])
+        figures = []
+        for label in sorted_nicely(labels):
+            fig = Figure()._from_neo_subtree(figures_by_label[label])
+            figures.append(fig)
+        self._add_relationships("has_figure", figures)
+        return self._finish()
+
     def _finish(self) -> "SmartNode":
         if self.auto_save:
             logger.info("auto saving")
@@ -438,6 +784,49 @@ class Figure(SmartNode):
             )
             return None
 
+    async def from_sd_REST_API_async(
+        self,
+        collection_id: str,
+        doi: str,
+        figure_index: int,
+        client: AsyncResilientRequests,
+    ) -> Union[SmartNode, None]:
+        """Instantiates properties and children from the SourceData REST API, concurrently"""
+        if collection_id and doi and figure_index:
+            logger.debug(f"    from sd API figure {figure_index}")
+            url = (
+                self.SD_REST_API
+                + self.GET_COLLECTION
+                + collection_id
+                + "/"
+                + self.GET_ARTICLE
+                + doi
+                + "/"
+                + self.GET_FIGURE
+                + str(figure_index)
+            )
+            response = await client.request(url)
+            if response:
+                response_dict = self._response_dict(response)
+                self.props = self.REST_API_PARSER.figure_props(response_dict, doi)
+                panel_ids = self.REST_API_PARSER.children_of_figures(response_dict)
+                panels = await asyncio.gather(
+                    *[
+                        Panel().from_sd_REST_API_async(panel_id, client)
+                        for panel_id in panel_ids
+                    ]
+                )
+                self._add_relationships("has_panel", panels)  # type: ignore
+            else:
+                return None
+            return self._finish()
+        else:
+            logger.error(
+                f"""Cannot create Figure with empty params supplied:
+                ('{collection_id}, {doi}')!"""
+            )
+            return None
+
     def from_neo(
         self, collection_id: str, doi: str, figure_index: str
     ) -> Union[None, SmartNode]:
@@ -472,6 +861,52 @@ class Figure(SmartNode):
         else:
             return None
 
+    @staticmethod
+    def _tag_order(tag: dict) -> Tuple[bool, int]:
+        """Sort key ordering tags as `ORDER BY toInteger(tag.tag_id)`, tags without an integer id last."""
+        try:
+            return (False, int(float(tag.get("tag_id"))))
+        except (TypeError, ValueError, OverflowError):
+            return (True, 0)
+
+    def _from_neo_subtree(self, figure_data: List[dict]) -> SmartNode:
+        """Builds the figure and its panels from the figure maps of GET_ARTICLE_SUBTREE
+        records. All maps share the same figure label, `in_collection` telling those of
+        article nodes of the collection; properties are taken from the first of these."""
+        collection_figures = [fig for fig in figure_data if fig["in_collection"]]
+        properties = {
+            k: v
+            for k, v in collection_figures[0].items()
+            if k not in ("panel_list", "captioned", "in_collection")
+        }
+        self.props = FigureProperties(**properties)
+        # as with GET_LIST_OF_PANELS, the panels are those of the figures of the collection
+        panel_list = [panel for fig in collection_figures for panel in fig["panel_list"]]
+        if len(collection_figures) > 1:
+            panel_list = sorted(
+                panel_list,
+                key=lambda p: (p["panel_number"] is None, p["panel_number"] or ""),
+            )
+        # the panel nodes sharing an id are merged, as GET_LIST_OF_TAGS collects the tags
+        # of all the paths to the panel id, from any article node with the DOI
+        panels_by_id: Dict[str, List[dict]] = {}
+        for panel_data in panel_list:
+            panels_by_id.setdefault(panel_data["panel_id"], []).append(panel_data)
+        for fig in figure_data:
+            if not fig["in_collection"]:
+                for panel_data in fig["panel_list"]:
+                    if panel_data["panel_id"] in panels_by_id:
+                        panels_by_id[panel_data["panel_id"]].append(panel_data)
+        panels = []
+        for panel_id, panel_maps in panels_by_id.items():
+            panel_data = panel_maps[0]
+            if len(panel_maps) > 1:
+                tags = [tag for panel_map in panel_maps for tag in panel_map["tag_id_list"]]
+                panel_data = {**panel_data, "tag_id_list": sorted(tags, key=self._tag_order)}
+            panels.append(Panel()._from_neo_subtree(panel_data))
+        self._add_relationships("has_panel", panels)
+        return self._finish()
+
 
 class Panel(SmartNode):
     """SourceData Panel object."""
@@ -500,6 +935,25 @@ class Panel(SmartNode):
         else:
             return None
 
+    async def from_sd_REST_API_async(
+        self, panel_id: str, client: AsyncResilientRequests
+    ) -> Union[None, SmartNode]:
+        """Instantiates properties and children from the SourceData REST API, concurrently"""
+        logger.debug(f"      from sd API panel {panel_id}")
+        url = self.SD_REST_API + self.GET_PANEL + panel_id
+        response = await client.request(url)
+        if response:
+            assert isinstance(response, dict)
+            self.props = self.REST_API_PARSER.panel_props(response)
+            tags_data = self.REST_API_PARSER.children_of_panels(response)
+            tagged_entities = [
+                TaggedEntity().from_sd_REST_API(tag) for tag in tags_data
+            ]
+            self._add_relationships("has_entity", tagged_entities)
+            return self._finish()
+        else:
+            return None
+
     def from_neo(
         self, panel_id: str, doi: str, figure_id: str
     ) -> Union[None, SmartNode]:
@@ -525,6 +979,16 @@ class Panel(SmartNode):
             )
             return None
 
+    def _from_neo_subtree(self, panel_data: dict) -> SmartNode:
+        """Builds the panel and its tagged entities from a panel map of a GET_ARTICLE_SUBTREE record."""
+        properties = {k: v for k, v in panel_data.items() if k != "tag_id_list"}
+        self.props = PanelProperties(**properties)
+        tagged_entities = [
+            TaggedEntity().from_neo(tag) for tag in panel_data["tag_id_list"]
+        ]
+        self._add_relationships("has_entity", tagged_entities)
+        return self._finish()
+
 
 class TaggedEntity(SmartNode):
     """SourceData TaggedEntity object."""
@@ -0,0 +1,45 @@
+import unittest
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from soda_data.sdneo.api_utils import AsyncResilientRequests
+
+
+class TestAsyncResilientRequests(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.calls = 0
+
+        async def flaky(request):
+            self.calls += 1
+            if self.calls < 3:
+                return web.Response(status=500)
+            return web.json_response({"doi": "10.1234/5678"})
+
+        async def not_json(request):
+            return web.Response(text="not json")
+
+        async def missing(request):
+            return web.Response(status=404)
+
+        app = web.Application()
+        app.router.add_get("/flaky", flaky)
+        app.router.add_get("/not_json", not_json)
+        app.router.add_get("/missing", missing)
+        self.server = TestServer(app)
+        await self.server.start_server()
+
+    async def asyncTearDown(self):
+        await self.server.close()
+
+    async def test_retry_on_server_error(self):
+        async with AsyncResilientRequests(backoff_factor=0.0) as client:
+            data = await client.request(str(self.server.make_url("/flaky")))
+        self.assertEqual(data, {"doi": "10.1234/5678"})
+        self.assertEqual(self.calls, 3)
+
+    async def test_failed_requests(self):
+        async with AsyncResilientRequests(backoff_factor=0.0) as client:
+            self.assertEqual(await client.request(str(self.server.make_url("/not_json"))), {})
+            self.assertEqual(await client.request(str(self.server.make_url("/missing"))), {})
@@ -1,9 +1,15 @@
+import json
+import os
+import shutil
+import tempfile
 import unittest
+from urllib.parse import parse_qs, urlparse
 
 import responses
 import yaml
 
 from soda_data.apis.epmc import EPMC
+from soda_data.common.http_cache import HTTPCache
 from soda_data.sdneo.api_utils import ResilientRequests
 
 ARTICLE_DOI_LIST = ["10.15252/embr.201949956", "10.15252/embr.201845832"]
@@ -53,6 +59,15 @@ class TestEPMC(unittest.TestCase):
         self.assertEqual(rr.session_retry.auth, ("John", "doe"))
         rr = ResilientRequests(user=None, password="doe")
 
+    def test_pool_size(self):
+        rr = ResilientRequests(pool_connections=2, pool_maxsize=5)
+        adapter = rr.session_retry.get_adapter("https://api.sourcedata.io/")
+        self.assertEqual(adapter._pool_connections, 2)
+        self.assertEqual(adapter._pool_maxsize, 5)
+        self.assertEqual(
+            rr.connection_stats(), {"requests": 0, "connections": 0, "reused": 0}
+        )
+
     @responses.activate
     def test_string_body(self):
         self._add_from_file("/app/tests/test_responses/uniprot.yaml")
@@ -66,3 +81,66 @@ class TestEPMC(unittest.TestCase):
         rr = ResilientRequests(user="John", password="doe")
         self.assertEqual(rr.session_retry.auth, ("John", "doe"))
         rr.request("https://www.ebi.ac.uk/bad_request")
+
+    @responses.activate
+    def test_get_abstracts(self):
+        pages = {
+            "*": {
+                "nextCursorMark": "page2",
+                "resultList": {"result": [{"doi": "10.1/ABC", "abstractText": "first\nabstract"}]},
+            },
+            "page2": {
+                "nextCursorMark": "page2",
+                "resultList": {"result": [{"doi": "10.1/def", "abstractText": "second"}]},
+            },
+        }
+
+        def callback(request):
+            params = parse_qs(urlparse(request.url).query)
+            self.assertEqual(params["query"], ['DOI:"10.1/abc" OR DOI:"10.1/DEF" OR DOI:"10.1/none"'])
+            return (200, {}, json.dumps(pages[params["cursorMark"][0]]))
+
+        responses.add_callback(
+            responses.GET,
+            "https://www.ebi.ac.uk/europepmc/webservices/rest/search",
+            callback=callback,
+        )
+        abstracts = EPMC().get_abstracts(["10.1/abc", "10.1/DEF", "10.1/none"])
+        self.assertEqual(
+            abstracts,
+            {"10.1/abc": "first abstract", "10.1/DEF": "second", "10.1/none": EPMC.NO_ABSTRACT},
+        )
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    def test_get_abstracts_cached(self):
+        def callback(request):
+            query = parse_qs(urlparse(request.url).query)["query"][0]
+            results = [{"doi": doi.split('"')[1], "abstractText": "abstract"} for doi in query.split(" OR ")]
+            return (200, {}, json.dumps({"resultList": {"result": results}}))
+
+        responses.add_callback(
+            responses.GET,
+            "https://www.ebi.ac.uk/europepmc/webservices/rest/search",
+            callback=callback,
+        )
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            cache = HTTPCache(path=os.path.join(tmp_dir, "http_cache.sqlite"))
+            dois = ["10.1/a", "10.1/b", "10.1/c"]
+            EPMC(cache=cache).get_abstracts(dois, chunk_size=2)
+            self.assertEqual(len(responses.calls), 2)
+            # the first pages of the two queries are looked up with a single get_many
+            get, get_many = cache.get, cache.get_many
+            lookups = []
+            cache.get = lambda url: lookups.append([url]) or get(url)
+            cache.get_many = lambda urls: lookups.append(urls) or get_many(urls)
+            abstracts = EPMC(cache=cache).get_abstracts(dois, chunk_size=2)
+            self.assertEqual(abstracts, {doi: "abstract" for doi in dois})
+            # the sqlite get_many gets the urls one by one, the requests did not look them up again
+            self.assertEqual(len(lookups[0]), 2)
+            self.assertEqual(lookups[1:], [[url] for url in lookups[0]])
+            self.assertEqual(len(responses.calls), 2)
+            cache.close()
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
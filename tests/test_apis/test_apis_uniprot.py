@@ -1,4 +1,9 @@
+import json
+import os
+import shutil
+import tempfile
 import unittest
+from urllib.parse import parse_qs, urlparse
 
 import requests
 import responses
@@ -6,6 +11,7 @@ from requests.models import Response
 import yaml
 
 from soda_data.apis.uniprot import Uniprot
+from soda_data.common.http_cache import HTTPCache
 
 PROTEIN_FUNCTION = """Multifunctional protein involved in the transcription and replication of viral RNAs. Contains the proteinases responsible for the cleavages of the polyprotein. Inhibits host translation by associating with the open head conformation of the 40S subunit (PubMed:33479166, PubMed:33080218, PubMed:32680882, PubMed:32908316). The C-terminus binds to and obstructs ribosomal mRNA entry tunnel (PubMed:33479166, PubMed:33080218, PubMed:32680882, PubMed:32908316). Thereby inhibits antiviral response triggered by innate immunity or interferons (PubMed:33080218, PubMed:32680882, PubMed:32979938). The nsp1-40S ribosome complex further induces an endonucleolytic cleavage near the 5'UTR of host mRNAs, targeting them for degradation (By similarity). Viral mRNAs less susceptible to nsp1-mediated inhibition of translation, because of their 5'-end leader sequence (PubMed:32908316, PubMed:33080218). May play a role in the modulation of host cell survival signaling pathway by interacting with host PHB and PHB2. Indeed, these two proteins play a role in maintaining the functional integrity of the mitochondria and protecting cells from various stresses. Responsible for the cleavages located at the N-terminus of the replicase polyprotein. Participates together with nsp4 in the assembly of virally-induced cytoplasmic double-membrane vesicles necessary for viral replication (By similarity). Antagonizes innate immune induction of type I interferon by blocking the phosphorylation, dimerization and subsequent nuclear translocation of host IRF3 (PubMed:32733001). Prevents also host NF-kappa-B signaling (By similarity). In addition, PL-PRO possesses a deubiquitinating/deISGylating activity and processes both 'Lys-48'- and 'Lys-63'-linked polyubiquitin chains from cellular substrates (PubMed:32726803). Cleaves preferentially ISG15 from antiviral protein IFIH1 (MDA5), but not RIGI (PubMed:33727702). Can play a role in host ADP-ribosylation by ADP-ribose (PubMed:32578982). Participates in the assembly of virally-induced cytoplasmic double-membrane vesicles necessary for viral replication. Cleaves the C-terminus of replicase polyprotein at 11 sites (PubMed:32321856). Recognizes substrates containing the core sequence [ILMVF]-Q-|-[SGACN] (PubMed:32198291, PubMed:32272481). May cleave human NLRP1 in lung epithelial cells, thereby activating the NLRP1 inflammasome pathway (PubMed:35594856). May cleave human GSDMD, triggering alternative GSDME-mediated epithelial cell death upon activation of the NLRP1 inflammasome, which may enhance the release interleukins 1B, 6, 16 and 18 (PubMed:35594856). Also able to bind an ADP-ribose-1''-phosphate (ADRP) (PubMed:32198291, PubMed:32272481). Plays a role in the initial induction of autophagosomes from host reticulum endoplasmic (By similarity). Later, limits the expansion of these phagosomes that are no longer able to deliver viral components to lysosomes (By similarity). Binds to host TBK1 without affecting TBK1 phosphorylation; the interaction with TBK1 decreases IRF3 phosphorylation, which leads to reduced IFN-beta production (PubMed:32979938). Plays a role in viral RNA synthesis (PubMed:32358203, PubMed:32277040, PubMed:32438371, PubMed:32526208). Forms a hexadecamer with nsp8 (8 subunits of each) that may participate in viral replication by acting as a primase. Alternatively, may synthesize substantially longer products than oligonucleotide primers (By similarity). Plays a role in viral RNA synthesis (PubMed:32358203, PubMed:32277040, PubMed:32438371, PubMed:32526208). Forms a hexadecamer with nsp7 (8 subunits of each) that may participate in viral replication by acting as a primase. Alternatively, may synthesize substantially longer products than oligonucleotide primers (By similarity). Interacts with ribosome signal recognition particle RNA (SRP) (PubMed:33080218). Together with NSP9, suppress protein integration into the cell membrane, thereby disrupting host immune defenses (PubMed:33080218). Catalytic subunit of viral RNA capping enzyme which catalyzes the RNA guanylyltransferase reaction for genomic and sub-genomic RNAs (PubMed:35944563). The kinase-like NiRAN domain of NSP12 transfers RNA to the amino terminus of NSP9, forming a covalent RNA-protein intermediate (PubMed:35944563). Subsequently, the NiRAN domain transfers RNA to GDP, forming the core cap structure GpppA-RNA (PubMed:35944563). The NSP14 and NSP16 methyltransferases then add methyl groups to form functional cap structures (PubMed:35944563). Interacts with ribosome signal recognition particle RNA (SRP) (PubMed:33080218). Together with NSP8, suppress protein integration into the cell membrane, thereby disrupting host immune defenses (PubMed:33080218). Plays a pivotal role in viral transcription by stimulating both nsp14 3'-5' exoribonuclease (By similarity) and nsp16 2'-O-methyltransferase activities (PubMed:35944563). Therefore plays an essential role in viral mRNAs cap methylation"""
 
@@ -135,3 +141,86 @@ class TestUniprot(unittest.TestCase):
             self.assertEqual(recommended_names, results[accession]["recommended_names"])
             self.assertEqual(short_names, results[accession]["short_names"])
             self.assertEqual(functions, results[accession]["functions"])
+
+    @responses.activate
+    def test_entry_fetched_once(self):
+        self._add_from_file("/app/tests/test_responses/uniprot.yaml")
+        uniprot = Uniprot()
+        for _ in range(3):
+            self.assertEqual(uniprot.get_short_names("P0DTC1"), ["pp1a"])
+            self.assertEqual(
+                uniprot.get_recommended_names("P0DTC1"),
+                ["Replicase polyprotein 1a", "ORF1a polyprotein"],
+            )
+            self.assertTrue(uniprot.get_protein_function("P0DTC1"))
+        self.assertEqual(len(responses.calls), 1)
+        entry = uniprot.get_entry("P0DTC1")
+        self.assertEqual(entry.accession, "P0DTC1")
+
+    @responses.activate
+    def test_entry_memo_eviction(self):
+        self._add_from_file("/app/tests/test_responses/uniprot.yaml")
+        uniprot = Uniprot(max_entries=2)
+        for accession in ["P34152", "P34153", "P34152", "P0DTC1", "P34152"]:
+            uniprot.get_entry(accession)
+        # P34153 was the least recently used entry when P0DTC1 was added
+        self.assertEqual(len(responses.calls), 3)
+        uniprot.get_entry("P34153")
+        self.assertEqual(len(responses.calls), 4)
+
+    @responses.activate
+    def test_fetch_many(self):
+        entries = {
+            "P1": {"accession": "P1", "secondaryAccession": ["S1"], "comments": []},
+            "P2": {"accession": "P2", "comments": []},
+            "P3": {"accession": "P3", "comments": []},
+        }
+        requested = []
+
+        def callback(request):
+            accessions = parse_qs(urlparse(request.url).query)["accession"][0].split(",")
+            requested.append(accessions)
+            body = [entries[acc] for acc in accessions if acc in entries]
+            return (200, {}, json.dumps(body))
+
+        responses.add_callback(
+            responses.GET, "https://www.ebi.ac.uk/proteins/api/proteins", callback=callback
+        )
+        uniprot = Uniprot()
+        result = uniprot.fetch_many(["P1", "S1", "P2", "MISSING", "P1"], batch_size=2, max_concurrency=2)
+        self.assertEqual(list(result), ["P1", "S1", "P2", "MISSING"])
+        self.assertEqual(result["S1"].accession, "P1")
+        self.assertFalse(result["MISSING"])
+        self.assertEqual(sorted(requested), [["P1", "S1"], ["P2", "MISSING"]])
+        # fetched entries are memoized
+        result = uniprot.fetch_many(["P2", "P3"])
+        self.assertEqual(requested[-1], ["P3"])
+        self.assertEqual(uniprot.get_entry("S1").accession, "P1")
+        self.assertEqual(len(responses.calls), 3)
+
+    @responses.activate
+    def test_fetch_many_cached(self):
+        def callback(request):
+            accessions = parse_qs(urlparse(request.url).query)["accession"][0].split(",")
+            return (200, {}, json.dumps([{"accession": acc, "comments": []} for acc in accessions]))
+
+        responses.add_callback(
+            responses.GET, "https://www.ebi.ac.uk/proteins/api/proteins", callback=callback
+        )
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            cache = HTTPCache(path=os.path.join(tmp_dir, "http_cache.sqlite"))
+            Uniprot(cache=cache).fetch_many(["P1", "P2", "P3"], batch_size=2)
+            self.assertEqual(len(responses.calls), 2)
+            # a new instance finds the batches in the cache, all looked up with a single get_many
+            get_many = cache.get_many
+            looked_up = []
+            cache.get_many = lambda urls: looked_up.append(urls) or get_many(urls)
+            result = Uniprot(cache=cache).fetch_many(["P1", "P2", "P3", "P4"], batch_size=2, max_concurrency=2)
+            self.assertEqual([entry.accession for entry in result.values()], ["P1", "P2", "P3", "P4"])
+            self.assertEqual(len(looked_up), 1)
+            self.assertEqual(len(looked_up[0]), 2)
+            self.assertEqual(len(responses.calls), 3)
+            cache.close()
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
@@ -3,10 +3,19 @@ import os
 from soda_data import TEST_FOLDER
 from soda_data.dataproc import utils
 import shutil
+import tempfile
+import gzip
+import pyarrow.parquet as pq
 
 from xml.etree import ElementTree
-from soda_data.dataproc.xml_extract import XMLExtractor
+from lxml.etree import SubElement, fromstring
+import pickle
+from unittest import mock
+from soda_data.dataproc import xml_extract
+from soda_data.dataproc.xml_extract import XMLCorpus, XMLEncoder, XMLExtractor, write_datasets
 from soda_data.dataproc.xml_extract import SourceDataCodes as sdc
+from soda_data.dataproc.manifest import EncodingManifest
+from soda_data.dataproc.shards import changed_shards, read_index
 from soda_data.dataproc.token_classification import (
     DataGeneratorForTokenClassification,
     DataGeneratorForPanelization,
@@ -132,6 +141,240 @@ class TestXMLExtractor(unittest.TestCase):
         self.assertTrue(isinstance(ElementTree.fromstring(xml_elements["test"][0]), ElementTree.Element))
 
 
+class TestXMLEncoder(unittest.TestCase):
+    def test_encode(self):
+        xml_encoder = XMLEncoder(xml_data=XML_FILE, xpath=".//sd-panel", split_dict=SPLIT_DICT_TEST)
+        element = fromstring(
+            '<sd-panel>A <sd-tag entity_type="protein">p<i>53</i></sd-tag> and '
+            '<sd-tag entity_type="molecule">ATP</sd-tag><sd-tag entity_type="protein"></sd-tag>.</sd-panel>'
+        )
+        encoded = xml_encoder.encode(element, sdc.ENTITY_TYPES.value)
+        geneprod, small_mol = 2, 1
+        self.assertEqual(
+            encoded["label_ids"],
+            [None, None] + [geneprod] * 3 + [None] * 5 + [small_mol] * 3 + [None],
+        )
+        self.assertEqual(encoded["offsets"], [(2, 5), (10, 13)])
+        encoded_array = xml_encoder.encode_array(element, sdc.ENTITY_TYPES.value)
+        self.assertEqual(list(encoded_array["label_ids"]), [c or 0 for c in encoded["label_ids"]])
+        self.assertEqual(encoded_array["offsets"], encoded["offsets"])
+
+    def test_encode_many(self):
+        xml_encoder = XMLEncoder(xml_data=XML_FILE, xpath=".//sd-panel", split_dict=SPLIT_DICT_TEST)
+        code_maps = [sdc.PANELIZATION, sdc.ENTITY_TYPES, sdc.GENEPROD_ROLES, sdc.SMALL_MOL_ROLES]
+        for element in xml_encoder._parse_xml_file(XML_FILE):
+            encoded_many = xml_encoder.encode_many(element, code_maps)
+            for code_map, encoded in zip(code_maps, encoded_many):
+                self.assertEqual(encoded, xml_encoder.encode(element, code_map))
+
+    def test_labels_to_iob2(self):
+        labels = ["1", "1", "O", "2", "1", "1", "O", "2"]
+        self.assertEqual(
+            XMLEncoder._labels_to_iob2(sdc.GENEPROD_ROLES.value, labels),
+            [
+                "B-CONTROLLED_VAR", "I-CONTROLLED_VAR", "O", "B-MEASURED_VAR",
+                "B-CONTROLLED_VAR", "I-CONTROLLED_VAR", "O", "B-MEASURED_VAR",
+            ],
+        )
+        self.assertEqual(XMLEncoder._labels_to_iob2(sdc.PANELIZATION.value, ["1", "O"]), ["O", "O"])
+
+    def test_segment_words(self):
+        words, starts, is_run = XMLEncoder._segment_words("Fig 1(a), x_y end")
+        self.assertEqual(words, ["Fig", "1", "(", "a", ")", ",", "x", "_", "y"])
+        self.assertEqual(starts.tolist(), [0, 4, 5, 6, 7, 8, 10, 11, 12])
+        self.assertEqual(is_run.tolist(), [True, True, False, True, False, False, True, False, True])
+
+    def test_shared_corpus(self):
+        corpus = XMLCorpus()
+        kwargs = dict(xml_data=XML_FOLDER, xpath_filter=".//sd-tag", min_length=32, split_dict=SPLIT_DICT_TEST)
+        pairs = []
+        for code_map, roles in [(sdc.ENTITY_TYPES, "single"), (sdc.GENEPROD_ROLES, "single"), (sdc.SMALL_MOL_ROLES, "multiple")]:
+            shared = DataGeneratorForTokenClassification(code_map=code_map, roles=roles, corpus=corpus, **kwargs)
+            alone = DataGeneratorForTokenClassification(code_map=code_map, roles=roles, **kwargs)
+            pairs.append((shared, alone))
+        pairs.append((DataGeneratorForPanelization(corpus=corpus, **kwargs), DataGeneratorForPanelization(**kwargs)))
+        self.assertEqual(corpus.n_parsed, 0)  # files are extracted as they are encoded
+        for shared, alone in pairs:
+            self.assertEqual(shared.generate_dataset(), alone.generate_dataset())
+        self.assertEqual(corpus.n_parsed, 2)
+        # every generator consumed the files: nothing is left in the corpus
+        self.assertEqual(corpus._examples, {})
+
+    def test_write_datasets(self):
+        corpus = XMLCorpus()
+        kwargs = dict(xml_data=XML_FOLDER, xpath_filter=".//sd-tag", min_length=32, split_dict=SPLIT_DICT_TEST)
+        generators = {
+            "panelization": DataGeneratorForPanelization(corpus=corpus, **kwargs),
+            "ner": DataGeneratorForTokenClassification(corpus=corpus, **kwargs),
+            "roles_gene": DataGeneratorForTokenClassification(code_map=sdc.GENEPROD_ROLES, corpus=corpus, **kwargs),
+        }
+        # files whose examples are held by the corpus whenever a generator consumes them
+        held = []
+        release = corpus.release
+
+        def record(extractor, filepath):
+            held.append(len({key[0] for key in corpus._examples}))
+            release(extractor, filepath)
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            with mock.patch.object(corpus, "release", record):
+                counts = write_datasets(generators, os.path.join(tmp_dir, "single_pass"))
+            # each file is parsed once and released before the next one is extracted
+            self.assertEqual(corpus.n_parsed, 2)
+            self.assertEqual(max(held), 1)
+            self.assertEqual(corpus._examples, {})
+            for task, generator in generators.items():
+                self.assertEqual(counts[task], generator.write_jsonl(os.path.join(tmp_dir, task)))
+                for split in ["train", "validation", "test"]:
+                    with open(os.path.join(tmp_dir, task, f"{split}.jsonl")) as f:
+                        expected = f.read()
+                    with open(os.path.join(tmp_dir, "single_pass", task, f"{split}.jsonl")) as f:
+                        self.assertEqual(f.read(), expected)
+            counts_parquet = write_datasets(generators, os.path.join(tmp_dir, "parquet"), "parquet", num_proc=2)
+            self.assertEqual(counts_parquet, counts)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def test_worker_shared_corpus(self):
+        corpus = XMLCorpus()
+        kwargs = dict(xml_data=XML_FOLDER, xpath_filter=".//sd-tag", min_length=32, split_dict=SPLIT_DICT_TEST)
+        encoders = [
+            DataGeneratorForPanelization(corpus=corpus, **kwargs),
+            DataGeneratorForTokenClassification(corpus=corpus, **kwargs),
+            DataGeneratorForTokenClassification(code_map=sdc.GENEPROD_ROLES, corpus=corpus, **kwargs),
+        ]
+        expected = [encoder._encode_xml_example("test") for encoder in encoders]
+        # the copies sent to a worker share a corpus of their own, parsing each file once for all of them
+        xml_extract._init_worker(pickle.loads(pickle.dumps(encoders)), [True] * len(encoders))
+        worker_corpus = xml_extract._worker_encoders[0].corpus
+        self.assertEqual(xml_extract._encode_file("test", (0, 1, 2)), expected)
+        self.assertEqual(worker_corpus.n_parsed, 1)
+        self.assertEqual(worker_corpus._examples, {})
+        # the encoders that do not encode the file release it
+        self.assertEqual(xml_extract._encode_file("test_copy", (1,)), [encoders[1]._encode_xml_example("test_copy")])
+        self.assertEqual(worker_corpus.n_parsed, 2)
+        self.assertEqual(worker_corpus._examples, {})
+
+    def test_generate_dataset_num_proc(self):
+        corpus = XMLCorpus()
+        kwargs = dict(xml_data=XML_FOLDER, xpath_filter=".//sd-tag", min_length=32, split_dict=SPLIT_DICT_TEST)
+        ner = DataGeneratorForTokenClassification(apply_generic_patch=True, corpus=corpus, **kwargs)
+        self.assertEqual(ner.generate_dataset(num_proc=2), ner.generate_dataset())
+        panelization = DataGeneratorForPanelization(corpus=corpus, **kwargs)
+        self.assertEqual(panelization.generate_dataset(num_proc=2), panelization.generate_dataset())
+
+    def test_write_jsonl(self):
+        kwargs = dict(xml_data=XML_FOLDER, xpath_filter=".//sd-tag", min_length=32, split_dict=SPLIT_DICT_TEST)
+        generators = [
+            DataGeneratorForTokenClassification(apply_generic_patch=True, **kwargs),
+            DataGeneratorForPanelization(**kwargs),
+        ]
+        for generator in generators:
+            tmp_dir = tempfile.mkdtemp()
+            try:
+                generator.to_jsonl(generator.generate_dataset(), os.path.join(tmp_dir, "materialized"))
+                counts = generator.write_jsonl(os.path.join(tmp_dir, "streamed"))
+                for split in ["train", "validation", "test"]:
+                    with open(os.path.join(tmp_dir, "materialized", f"{split}.jsonl")) as f:
+                        materialized = f.read()
+                    with open(os.path.join(tmp_dir, "streamed", f"{split}.jsonl")) as f:
+                        streamed = f.read()
+                    self.assertEqual(streamed, materialized)
+                    self.assertEqual(counts[split], materialized.count("\n"))
+            finally:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def test_write_parquet(self):
+        kwargs = dict(xml_data=XML_FOLDER, xpath_filter=".//sd-tag", min_length=32, split_dict=SPLIT_DICT_TEST)
+        generators = [
+            DataGeneratorForTokenClassification(roles="multiple", **kwargs),
+            DataGeneratorForPanelization(**kwargs),
+        ]
+        for generator in generators:
+            tmp_dir = tempfile.mkdtemp()
+            try:
+                dataset = generator.generate_dataset()
+                counts = generator.write_parquet(tmp_dir, row_group_size=4)
+                self.assertEqual(counts["train"], len(dataset["train"]["words"]))
+                table = pq.read_table(os.path.join(tmp_dir, "train.parquet"))
+                self.assertTrue(table.equals(generator.to_arrow(dataset)["train"]))
+                n_row_groups = (counts["train"] + 3) // 4
+                self.assertEqual(pq.ParquetFile(os.path.join(tmp_dir, "train.parquet")).num_row_groups, n_row_groups)
+                names = generator.label_code_map.iob2_labels
+                labels = [[names[i] for i in ids] for ids in table.column("labels").to_pylist()]
+                self.assertEqual(labels, dataset["train"]["labels"])
+                self.assertEqual(table.column("words").to_pylist(), dataset["train"]["words"])
+            finally:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def test_sharded_output(self):
+        generator = DataGeneratorForTokenClassification(
+            xml_data=XML_FOLDER, xpath_filter=".//sd-tag", min_length=32, split_dict=SPLIT_DICT_TEST
+            )
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            generator.write_jsonl(os.path.join(tmp_dir, "single"))
+            sharded = os.path.join(tmp_dir, "sharded")
+            counts = generator.write_jsonl(sharded, max_shard_size=20000, compression="gzip")
+            index = read_index(os.path.join(sharded, "index.json"))
+            self.assertEqual([s["file"] for s in index["train"]], ["train-00000-of-00002.jsonl.gz", "train-00001-of-00002.jsonl.gz"])
+            self.assertEqual(sum(s["num_examples"] for s in index["train"]), counts["train"])
+            content = b""
+            for shard in index["train"]:
+                with gzip.open(os.path.join(sharded, shard["file"])) as f:
+                    content += f.read()
+            with open(os.path.join(tmp_dir, "single", "train.jsonl"), "rb") as f:
+                self.assertEqual(content, f.read())
+
+            # the same examples give the same shards
+            generator.write_jsonl(sharded, max_shard_size=20000, compression="gzip")
+            self.assertEqual(changed_shards(read_index(os.path.join(sharded, "index.json")), index), [])
+            generator.write_jsonl(sharded, max_shard_size=10**6, compression="gzip")
+            self.assertEqual(len(os.listdir(sharded)), 4)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def test_manifest(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            xml_dir = os.path.join(tmp_dir, "xml")
+            shutil.copytree(XML_FOLDER, xml_dir)
+            manifest = EncodingManifest(os.path.join(tmp_dir, "encoding_manifest.sqlite"))
+            kwargs = dict(xml_data=xml_dir, xpath_filter=".//sd-tag", min_length=32, split_dict=SPLIT_DICT_TEST)
+            expected = DataGeneratorForTokenClassification(**kwargs).generate_dataset()
+            first = DataGeneratorForTokenClassification(manifest=manifest, **kwargs)
+            self.assertEqual(first.generate_dataset(), expected)
+            self.assertEqual(manifest.stats()["encoded"], 2)
+
+            again = DataGeneratorForTokenClassification(manifest=manifest, **kwargs)
+            self.assertEqual(again.files_to_encode, [])
+            self.assertEqual(again.generate_dataset(), expected)
+            self.assertEqual(manifest.stats()["reused"], 2)
+
+            roles = DataGeneratorForTokenClassification(code_map=sdc.GENEPROD_ROLES, manifest=manifest, **kwargs)
+            self.assertEqual(sorted(roles.files_to_encode), ["test", "test_copy"])
+
+            with open(os.path.join(xml_dir, "test_copy.xml"), "a") as f:
+                f.write("\n")
+            changed = DataGeneratorForTokenClassification(manifest=manifest, **kwargs)
+            self.assertEqual(changed.files_to_encode, ["test_copy"])
+            self.assertEqual(changed.generate_dataset(), expected)
+            manifest.close()
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def test_encode_deep_nesting(self):
+        xml_encoder = XMLEncoder(xml_data=XML_FILE, xpath=".//sd-panel", split_dict=SPLIT_DICT_TEST)
+        element = fromstring("<sd-panel/>")
+        parent = element
+        for _ in range(5000):  # deeper than the recursion limit
+            parent = SubElement(parent, "b")
+            parent.text = "x"
+        encoded = xml_encoder.encode(element, sdc.ENTITY_TYPES.value)
+        self.assertEqual(len(encoded["label_ids"]), 5000)
+
+
 class TestTokenClassification(unittest.TestCase):
     def test_dict(self):
         if not os.path.exists(TEST_FOLDER):
@@ -245,6 +488,25 @@ class TestTokenClassification(unittest.TestCase):
     #         set(labels) == set(["O", "B-MEASURED_VAR", "I-MEASURED_VAR", "B-CONTROLLED_VAR", "I-CONTROLLED_VAR"])
     #         )
 
+    def test_generic_patch(self):
+        kwargs = dict(xml_data=XML_FOLDER, xpath_filter=".//sd-tag", min_length=32, split_dict=SPLIT_DICT_TEST)
+        unpatched = DataGeneratorForTokenClassification(**kwargs).generate_dataset()
+        patched = DataGeneratorForTokenClassification(
+            apply_generic_patch=True, generic_patches={"entity_types": {"neor", "t cell"}}, **kwargs
+            ).generate_dataset()
+        for words, labels, patched_labels in zip(
+                unpatched["train"]["words"], unpatched["train"]["labels"], patched["train"]["labels"]
+                ):
+            self.assertEqual(len(labels), len(patched_labels))
+            for i, (word, label, patched_label) in enumerate(zip(words, labels, patched_labels)):
+                # a single word entity, possibly ending the example
+                single_word = i + 1 == len(labels) or not labels[i + 1].startswith("I-")
+                if word == "NeoR" and label == "B-GENEPROD" and single_word:
+                    self.assertEqual(patched_label, "O")
+                elif label == "O":
+                    self.assertEqual(patched_label, "O")
+        self.assertNotEqual(unpatched["train"]["labels"], patched["train"]["labels"])
+
 
 class TestPanelization(unittest.TestCase):
     def test_generate_dataset(self):
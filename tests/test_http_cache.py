@@ -0,0 +1,124 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import responses
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+from soda_data.common.http_cache import CachedSession, HTTPCache, RedisHTTPCache
+from soda_data.sdneo.api_utils import ResilientRequests
+
+URL = "https://api.sourcedata.io/collection/97/papers"
+
+
+class TestHTTPCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache = HTTPCache(path=os.path.join(self.tmp_dir, "http_cache.sqlite"))
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    @responses.activate
+    def test_hit(self):
+        responses.add(responses.GET, URL, json=[{"doi": "10.1234/5678"}])
+        rr = ResilientRequests(cache=self.cache)
+        self.assertEqual(rr.request(URL), [{"doi": "10.1234/5678"}])
+        self.assertEqual(rr.request(URL), [{"doi": "10.1234/5678"}])
+        self.assertEqual(len(responses.calls), 1)
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["entries"]), (1, 1, 1))
+
+    @responses.activate
+    def test_params_in_key(self):
+        responses.add(responses.GET, URL, json={"page": 1})
+        rr = ResilientRequests(cache=self.cache)
+        rr.request(URL, params={"page": 1})
+        rr.request(URL, params={"page": 2})
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    def test_revalidation(self):
+        self.cache.ttl = 0
+        responses.add(responses.GET, URL, json={"doi": "a"}, headers={"ETag": '"v1"'})
+        responses.add(responses.GET, URL, status=304)
+        rr = ResilientRequests(cache=self.cache)
+        self.assertEqual(rr.request(URL), {"doi": "a"})
+        self.assertEqual(rr.request(URL), {"doi": "a"})
+        self.assertEqual(responses.calls[1].request.headers["If-None-Match"], '"v1"')
+        self.assertEqual(self.cache.stats()["revalidated"], 1)
+
+    @responses.activate
+    def test_no_cache_on_error(self):
+        responses.add(responses.GET, URL, status=404)
+        rr = ResilientRequests(cache=self.cache)
+        rr.request(URL)
+        self.assertEqual(self.cache.stats()["entries"], 0)
+
+    @responses.activate
+    def test_lru_eviction(self):
+        self.cache.max_size = 25
+        for i in range(3):
+            responses.add(responses.GET, f"{URL}/{i}", body="x" * 10)
+        rr = ResilientRequests(cache=self.cache)
+        rr.request(f"{URL}/0")
+        rr.request(f"{URL}/1")
+        rr.request(f"{URL}/0")  # 0 is now more recently used than 1
+        rr.request(f"{URL}/2")
+        self.assertIsNotNone(self.cache.get(f"{URL}/0"))
+        self.assertIsNone(self.cache.get(f"{URL}/1"))
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+class TestRedisHTTPCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = RedisHTTPCache(client=fakeredis.FakeRedis(), compress_min_size=16)
+
+    @responses.activate
+    def test_shared_between_sessions(self):
+        responses.add(responses.GET, URL, json={"abstract": "x" * 100})
+        ResilientRequests(cache=self.cache).request(URL)
+        data = ResilientRequests(cache=self.cache).request(URL)
+        self.assertEqual(data, {"abstract": "x" * 100})
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(self.cache.client.hget(self.cache._redis_key(URL), "compressed"), b"1")
+        self.assertGreater(self.cache.client.ttl(self.cache._redis_key(URL)), 0)
+
+    @responses.activate
+    def test_get_many(self):
+        for i in range(3):
+            responses.add(responses.GET, f"{URL}/{i}", json={"i": i})
+        rr = ResilientRequests(cache=self.cache)
+        rr.request(f"{URL}/0")
+        rr.request(f"{URL}/2")
+        entries = self.cache.get_many([f"{URL}/{i}" for i in range(3)])
+        self.assertEqual(sorted(entries), [f"{URL}/0", f"{URL}/2"])
+        self.assertEqual(entries[f"{URL}/2"].body, b'{"i": 2}')
+
+    @responses.activate
+    def test_prefetch(self):
+        for i in range(3):
+            responses.add(responses.GET, f"{URL}/{i}", json={"i": i})
+        session = CachedSession(self.cache)
+        session.get(f"{URL}/0")
+        lookups = []
+        get = self.cache.get
+        self.cache.get = lambda url: lookups.append(url) or get(url)
+        urls = [f"{URL}/{i}" for i in range(3)]
+        with session.prefetch(urls):
+            data = [session.get(url).json() for url in urls]
+        self.assertEqual(data, [{"i": 0}, {"i": 1}, {"i": 2}])
+        # the urls were looked up at once, only the missing ones were requested
+        self.assertEqual(lookups, [])
+        self.assertEqual(len(responses.calls), 3)
+        self.assertEqual(session._prefetched, {})
+        session.get(f"{URL}/1")
+        self.assertEqual(lookups, [f"{URL}/1"])
+        self.assertEqual(len(responses.calls), 3)
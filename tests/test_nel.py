@@ -0,0 +1,276 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pyarrow as pa
+import torch
+from transformers import BertConfig, BertModel, BertTokenizerFast
+
+from soda_data.dataproc import nel
+from soda_data.dataproc.embedding_cache import EmbeddingCache
+from soda_data.dataproc.nel import EmbeddingWriter
+
+VOCAB = [
+    "[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]",
+    "the", "gene", "##s", "p", "##53", "kin", "##ase", "binds", "to", "il", "##2", "-", "2", "(", ")", ",", ".",
+]
+CAPTIONS = [
+    "The p53 kinase binds IL-2 genes.",
+    "The p53 genes (IL-2, kinase) bind to the p53 kinase genes, p53 binds IL2.",
+    "p53.",
+]
+MAX_LENGTH = 8  # 6 caption tokens per window
+WINDOW = 2
+
+
+class TestCaptionEmbeddings(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        vocab_file = os.path.join(cls.tmp_dir, "vocab.txt")
+        with open(vocab_file, "w") as f:
+            f.write("\n".join(VOCAB) + "\n")
+        cls.tokenizer = BertTokenizerFast(vocab_file=vocab_file)
+        torch.manual_seed(0)
+        config = BertConfig(
+            vocab_size=len(VOCAB), hidden_size=16, num_hidden_layers=1, num_attention_heads=2,
+            intermediate_size=32, max_position_embeddings=MAX_LENGTH,
+        )
+        cls.model = BertModel(config).eval()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir, ignore_errors=True)
+
+    def _token_ids(self, caption):
+        return self.tokenizer(caption, add_special_tokens=False)["input_ids"]
+
+    def _window_outputs(self, caption):
+        """Embeddings of the caption tokens averaged over the windows, each window in its own forward pass."""
+        ids = self._token_ids(caption)
+        sums = torch.zeros((len(ids), 16))
+        counts = torch.zeros((len(ids), 1))
+        with torch.no_grad():
+            for start, end in nel.window_bounds(len(ids), MAX_LENGTH - 2, WINDOW):
+                input_ids = torch.tensor([self.tokenizer.build_inputs_with_special_tokens(ids[start:end])])
+                hidden = self.model(input_ids=input_ids).last_hidden_state[0]
+                sums[start:end] += hidden[1:1 + end - start]  # after [CLS]
+                counts[start:end] += 1
+        return sums / counts
+
+    def test_window_bounds(self):
+        self.assertEqual(nel.window_bounds(14, 6, 2), [(0, 6), (4, 10), (8, 14)])
+        self.assertEqual(nel.window_bounds(3, 6, 2), [(0, 3)])
+        with self.assertRaises(ValueError):
+            nel.window_bounds(14, 6, 6)
+
+    def test_embed_captions(self):
+        # the captions have words of several subword tokens and are longer than the model
+        self.assertIn("##53", self.tokenizer.tokenize(CAPTIONS[0]))
+        self.assertGreater(len(self._token_ids(CAPTIONS[1])), 2 * MAX_LENGTH)
+        embeddings = nel.embed_captions(CAPTIONS, self.tokenizer, self.model, MAX_LENGTH, WINDOW, batch_size=1)
+        for caption, caption_embeddings in zip(CAPTIONS, embeddings):
+            self.assertEqual(caption_embeddings.shape, (len(self._token_ids(caption)), 16))
+            # the positions of overlapping windows are the mean of the outputs of the windows
+            self.assertTrue(torch.allclose(caption_embeddings, self._window_outputs(caption), atol=1e-5))
+        self.assertEqual(nel.embed_captions([], self.tokenizer, self.model), [])
+
+    def test_embed_captions_batched(self):
+        # padded batches of windows of several captions, fewer per batch than there are windows
+        n_windows = sum(len(nel.window_bounds(len(self._token_ids(c)), MAX_LENGTH - 2, WINDOW)) for c in CAPTIONS)
+        self.assertGreater(n_windows, 3)
+        single = nel.embed_captions(CAPTIONS, self.tokenizer, self.model, MAX_LENGTH, WINDOW, batch_size=1)
+        batched = nel.embed_captions(CAPTIONS, self.tokenizer, self.model, MAX_LENGTH, WINDOW, batch_size=3)
+        for caption, one, many in zip(CAPTIONS, single, batched):
+            self.assertTrue(torch.allclose(many, one, atol=1e-5))
+            self.assertTrue(torch.allclose(many, self._window_outputs(caption), atol=1e-5))
+
+    def test_embed_captions_cache(self):
+        cache = EmbeddingCache("model", folder=os.path.join(self.tmp_dir, "cache"))
+        try:
+            expected = nel.embed_captions(CAPTIONS, self.tokenizer, self.model, MAX_LENGTH, WINDOW)
+            computed = nel.embed_captions(CAPTIONS[:2], self.tokenizer, self.model, MAX_LENGTH, WINDOW, cache=cache)
+            embeddings = nel.embed_captions(CAPTIONS, self.tokenizer, self.model, MAX_LENGTH, WINDOW, cache=cache)
+            self.assertEqual(cache.stats(), {"hits": 2, "misses": 3, "entries": 3})
+            for i, (one, cached) in enumerate(zip(expected, embeddings)):
+                self.assertEqual(cached.dtype, np.float16)
+                self.assertTrue(np.array_equal(cached, one.numpy().astype(np.float16)))
+                if i < 2:
+                    self.assertTrue(np.array_equal(computed[i], cached))
+                    # the captions found in the cache are views of the mapped file
+                    self.assertIsInstance(cached.base, np.memmap)
+            caption = CAPTIONS[1]
+            word_subwords = nel.align_words(caption, self.tokenizer)
+            spans = [(0, 2), (3, 5)]
+            self.assertTrue(np.allclose(
+                nel.span_embeddings(embeddings[1], word_subwords, spans),
+                nel.span_embeddings(expected[1], word_subwords, spans),
+                atol=1e-2,
+            ))
+        finally:
+            cache.close()
+
+    def test_align_words(self):
+        for caption in CAPTIONS:
+            first, last = nel.align_words(caption, self.tokenizer)
+            offsets = self.tokenizer(caption, add_special_tokens=False, return_offsets_mapping=True)["offset_mapping"]
+            word_spans = [m.span() for m in nel.WORD_RE.finditer(caption)]
+            self.assertEqual(len(first), len(word_spans))
+            for (word_start, word_end), f, l in zip(word_spans, first, last):
+                intersecting = [k for k, (s, e) in enumerate(offsets) if s < word_end and e > word_start]
+                self.assertEqual(list(range(f, l)), intersecting)
+
+    def test_span_embeddings(self):
+        caption = CAPTIONS[0]
+        embeddings = nel.embed_captions([caption], self.tokenizer, self.model, MAX_LENGTH, WINDOW)[0]
+        word_subwords = nel.align_words(caption, self.tokenizer)
+        words = nel.tokenize(caption)  # The p53 kinase binds IL - 2 genes .
+        labels = ["O", "B-GENEPROD", "I-GENEPROD", "O", "B-GENEPROD", "I-GENEPROD", "I-GENEPROD", "O", "O"]
+        self.assertEqual(len(words), len(labels))
+        spans = nel.entity_spans(labels)
+        self.assertEqual(spans, [(1, 3), (4, 7)])
+        pooled = nel.span_embeddings(embeddings, word_subwords, spans)
+        # p ##53 kin ##ase, then il - 2
+        self.assertTrue(np.allclose(pooled[0], embeddings[1:5].mean(dim=0).numpy(), atol=1e-6))
+        self.assertTrue(np.allclose(pooled[1], embeddings[6:9].mean(dim=0).numpy(), atol=1e-6))
+
+        panel_data = {"words": words, "labels": labels}
+        word_embeddings = nel.assign_embeddings_to_words(word_subwords, embeddings, panel_data)
+        self.assertEqual(word_embeddings[0], [])
+        self.assertEqual(word_embeddings[1], word_embeddings[2])
+        self.assertTrue(np.allclose(word_embeddings[5], pooled[1]))
+
+
+class TestFileChunks(unittest.TestCase):
+    def test_file_chunks(self):
+        def dataset(*captions):
+            return [{"figure_caption": caption} for caption in captions]
+
+        # the panels of a figure share its caption, counted once
+        datasets = [dataset("a", "a"), dataset("b", "c"), dataset("c"), dataset("d", "e"), dataset("f")]
+        chunks = list(nel.file_chunks(iter(datasets), 3))
+        self.assertEqual(chunks, [datasets[:2], datasets[2:4], datasets[4:]])
+        self.assertEqual(list(nel.file_chunks(iter(datasets), 1)), [[d] for d in datasets])
+        self.assertEqual(list(nel.file_chunks(iter([]), 3)), [])
+
+
+class TestEmbeddingWriter(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def _read(self, path):
+        with pa.memory_map(path) as source:
+            table = pa.ipc.open_file(source).read_all()
+        return table
+
+    def test_round_trip(self):
+        rng = np.random.default_rng(0)
+        for float16, dtype in [(False, np.float32), (True, np.float16)]:
+            path = os.path.join(self.tmp_dir, f"float16_{float16}.arrow")
+            writer = EmbeddingWriter(path, 4, float16=float16, buffer_rows=3)
+            chunks = [rng.standard_normal((n, 4)) for n in [2, 0, 3, 1]]
+            rows = [writer.write(chunk) for chunk in chunks]
+            writer.close()
+            self.assertEqual(rows, [[0, 1], [], [2, 3, 4], [5]])
+            table = self._read(path)
+            self.assertEqual(table.num_rows, 6)
+            self.assertEqual(table.schema.field("embedding").type, pa.list_(pa.from_numpy_dtype(dtype), 4))
+            stored = np.stack(table.column("embedding").to_numpy(zero_copy_only=False))
+            for chunk, chunk_rows in zip(chunks, rows):
+                np.testing.assert_array_equal(stored[chunk_rows].reshape(-1, 4), chunk.astype(dtype))
+
+    def test_empty(self):
+        # a split without entities still gets its file
+        path = os.path.join(self.tmp_dir, "empty.arrow")
+        writer = EmbeddingWriter(path, 4)
+        self.assertEqual(writer.write(np.zeros((0, 4))), [])
+        writer.close()
+        table = self._read(path)
+        self.assertEqual(table.num_rows, 0)
+        self.assertEqual(table.schema.field("embedding").type, pa.list_(pa.float32(), 4))
+
+
+FIGURE_XML = """<article doi="10.1234/test.1">
+<fig><title>Title about <b>p53</b>.</title><sd-panel>A: <sd-tag category="entity" entity_type="protein" ext_ids="P04637" ext_urls="https://www.uniprot.org/uniprot/"
+ ext_tax_ids="9606">TP53 protein</sd-tag> <i><sd-tag category="entity" entity_type="gene" ext_ids="P04637"
+ ext_urls="https://www.uniprot.org/uniprot/" ext_tax_ids="9606">p53</sd-tag></i> binds <sd-tag category="entity"
+ entity_type="protein" ext_ids="Q00987" ext_urls="https://www.uniprot.org/uniprot/" ext_tax_ids="9606">MDM2</sd-tag>.</sd-panel><sd-panel>B: MDM2 and <sd-tag category="entity" entity_type="gene" ext_ids="" ext_urls=""
+ ext_tax_ids="">Actin</sd-tag> with <sd-tag category="entity" entity_type="molecule" ext_ids="CHEBI:1"
+ ext_urls="https://www.ebi.ac.uk/chebi/" ext_tax_ids="">drug</sd-tag>.</sd-panel>
+</fig>
+</article>
+"""
+
+
+class TestProcessXmlFile(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "figure.xml")
+        with open(self.path, "w") as f:
+            f.write(FIGURE_XML)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def test_process_xml_file(self):
+        dataset = nel.process_xml_file(self.path)
+        words = "Title about p53 . A : TP53 protein p53 binds MDM2 . B : MDM2 and Actin with drug .".split()
+        self.assertEqual(len(dataset), 2)
+        for panel_data in dataset:
+            self.assertEqual(panel_data["doi"], "10.1234/test.1")
+            self.assertEqual(panel_data["words"], words)
+            self.assertEqual(
+                panel_data["figure_caption"], "Title about p53. A: TP53 protein p53 binds MDM2. B: MDM2 and Actin with drug."
+            )
+
+        p53 = "https://www.uniprot.org/uniprot/P04637"
+        mdm2 = "https://www.uniprot.org/uniprot/Q00987"
+        # the words of the tags of the panel are labelled wherever they occur in the caption,
+        # the nested p53 tag continues the entity of the TP53 tag with the same ID
+        first, second = dataset
+        self.assertEqual(first["labels"], [
+            "O", "O", "B-GENEPROD", "O", "O", "O", "B-GENEPROD", "I-GENEPROD", "I-GENEPROD", "O",
+            "B-GENEPROD", "O", "O", "O", "B-GENEPROD", "O", "O", "O", "O", "O",
+        ])
+        self.assertEqual(first["ext_dbs"], [
+            "O", "O", p53, "O", "O", "O", p53, p53, p53, "O", mdm2, "O", "O", "O", mdm2, "O", "O", "O", "O", "O",
+        ])
+        self.assertEqual(first["tax_ids"], [
+            "O", "O", "9606", "O", "O", "O", "9606", "9606", "9606", "O",
+            "9606", "O", "O", "O", "9606", "O", "O", "O", "O", "O",
+        ])
+        # a tag without IDs is labelled with empty IDs, a molecule is not labelled
+        self.assertEqual(second["labels"], ["B-GENEPROD" if i == 16 else "O" for i in range(len(words))])
+        self.assertEqual(second["ext_dbs"], ["O"] * len(words))
+        self.assertEqual(second["tax_ids"], ["O"] * len(words))
+
+
+class TestEmbeddingCache(unittest.TestCase):
+    def test_embedding_cache(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            cache = EmbeddingCache("model", folder=tmp_dir)
+            first, second = np.random.rand(3, 4), np.random.rand(5, 4)
+            self.assertIsNone(cache.get("a caption"))
+            cache.set("a caption", first)
+            cache.set("another caption", second)
+            self.assertTrue(np.array_equal(cache.get("a caption"), first.astype(np.float16)))
+            self.assertIsNone(cache.get("a caption", window=10))
+            cache.close()
+
+            cache = EmbeddingCache("model", folder=tmp_dir)
+            embeddings = cache.get("another caption")
+            self.assertIsInstance(embeddings.base, np.memmap)
+            self.assertTrue(np.array_equal(embeddings, second.astype(np.float16)))
+            other_model = EmbeddingCache("other model", folder=tmp_dir)
+            self.assertIsNone(other_model.get("another caption"))
+            other_model.close()
+            self.assertEqual(cache.stats(), {"hits": 1, "misses": 0, "entries": 2})
+            cache.close()
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
@@ -1,6 +1,7 @@
 from py2neo import Graph
 import shutil
 import unittest
+from lxml.etree import tostring
 from soda_data.sdneo.smartnode import Article, Collection
 import os
 
@@ -12,16 +13,7 @@ NEO_URI = os.getenv("NEO_URI")
 NEO_USERNAME = os.getenv("NEO_USERNAME")
 NEO_PASSWORD = os.getenv("NEO_PASSWORD")
 
-
-class TestCollection(unittest.TestCase):
-
-    def test_from_neo_collection(self):
-        """Test the from_neo method."""
-
-        # connect to our neo4j database
-        GRAPH = Graph(NEO_URI, auth=(NEO_USERNAME, NEO_PASSWORD))
-
-        query = """
+TEST_GRAPH = """
         CREATE (test:SDCollection {id: 11, name:'PUBLICSEARCH', source:'sdapi'})
         CREATE (article: SDArticle {
         id: 20,
@@ -125,25 +117,14 @@ class TestCollection(unittest.TestCase):
         (panel1)-[:has_tag]->(tag1);
 
         """
-        GRAPH.run(query)
-        collection = Collection(auto_save=True, is_test=True)
-        collection.from_neo(collection_name="PUBLICSEARCH")
-        self.assertTrue(collection.props.collection_name == "PUBLICSEARCH")  # type: ignore
-        shutil.rmtree("/app/xml_destination_files", ignore_errors=True)
-        GRAPH.run("MATCH (n) DETACH DELETE n")
 
-    def test_from_neo_article(self):
-        """Test the from_neo method."""
-        GRAPH = Graph(NEO_URI, auth=(NEO_USERNAME, NEO_PASSWORD))
-
-        query = """
-        CREATE (test:SDCollection {id: 11, name:'PUBLICSEARCH', source:'sdapi'})
+# a second article node with the DOI, outside the collection: the tags of its copy of panel 77017
+# are merged as GET_LIST_OF_TAGS does, its other figures and panels are left out. The copy has the
+# properties of the panel of the collection, GET_PANEL_PROPERTIES returning either.
+DUPLICATE_ARTICLE = """
         CREATE (article: SDArticle {
-        id: 20,
+        id: 21,
         pub_date: "1900-01-01",
-        journalName: "EMBO reports",
-        year: "2019",
-        import_id: "SD4885",
         source: "sdapi",
         title: "Apicomplexan F-actin is required for efficient nuclear entry during host cell invasion",
         pmid: "",
@@ -151,57 +132,22 @@ class TestCollection(unittest.TestCase):
         doi: "10.15252/embr.201948896",
         nb_figures: 7
                 })
-        CREATE (figure4:SDFigure {id: 9227,
-        caption: "<sd-panel> <p><strong>Figure 4. Time lapse analysis of F-actin and nuclear dynamics during host cell invasion</strong></p> <p><strong>A.</strong> Time-lapse analysis of invading RH Cb-EmeraldFP parasites. During penetration, an F-actin ring is formed at the TJ (orange arrow). The nucleus (purple) is squeezed through the TJ (red arrowhead) and posterior F-actin appears to be directly connected to the nucleus and TJ (blue arrow). The time-lapse is presented in Movie EV7.</p> <p><strong>B.</strong> Analysis of nucleus deformation during live imaging shown in A. The nucleus constricts while its passing through the TJ (red arrowheads).</p> <p><strong>C.</strong> The posterior end of the parasite deforms during the invasion process. F-actin is accumulated during invasion, with the posterior end contracting (blue arrow).</p> <p><strong>D.</strong> Time-lapse stills depicting RH Cb-EmeraldFP parasites invading in absence of detectable F-actin at the junction (orange arrow). The nucleus (purple) is squeezed through the TJ (red arrowhead) during invasion. Actin accumulation at the posterior pole of the parasite is strongly detected in all cases (blue arrow). The time-lapse is presented in Movie EV7.</p> <p><strong>E.</strong> Analysis of nucleus deformation during live imaging shown in (D). The nucleus appears to not show constriction once its passing through the TJ when the F-actin ring is not present.</p> <p><strong>F.</strong> The posterior end of the parasite also deforms during the invasion process.</p> <p><strong>G.</strong> Z-stack gallery depicting mid-invading <em>myoA</em> KO parasites. Note that the nucleus is located located at the back during invasion events.</p> <p>Data information: Numbers indicate minutes:seconds. Scale bar represents 5 µm. White arrow points to direction of invasion.</p> </sd-panel>",
+        CREATE (figure4:SDFigure {id: 9231,
+        caption: "",
         source: "sdapi",
         href: "https://api.sourcedata.io/file.php?figure_id=28353",
         fig_label: "Figure 4",
         fig_title: ""
                 })
-        CREATE (figure1:SDFigure {id: 9224,
-        caption: "",
-        source: "sdapi",
-        href: "https://api.sourcedata.io/file.php?figure_id=28348",
-        fig_label: "Figure 1",
-        fig_title: ""
-                })
-        CREATE (figure2:SDFigure {id: 9225,
-        caption: "",
-        source: "sdapi",
-        href: "https://api.sourcedata.io/file.php?figure_id=28350",
-        fig_label: "Figure 2",
-        fig_title: ""
-                })
-        CREATE (figure3:SDFigure {id: 9226,
-        caption: "",
-        source: "sdapi",
-        href: "https://api.sourcedata.io/file.php?figure_id=28352",
-        fig_label: "Figure 3",
-        fig_title: ""
-                })
-        CREATE (figure5:SDFigure {id: 9228,
-        caption: "",
-        source: "sdapi",
-        href: "https://api.sourcedata.io/file.php?figure_id=28354",
-        fig_label: "Figure 5",
-        fig_title: ""
-                })
-        CREATE (figure6:SDFigure {id: 9229,
-        caption: "",
-        source: "sdapi",
-        href: "https://api.sourcedata.io/file.php?figure_id=28355",
-        fig_label: "Figure 6",
-        fig_title: ""
-                })
-        CREATE (figure7:SDFigure {id: 9230,
-        caption: "",
+        CREATE (figure8:SDFigure {id: 9232,
+        caption: "<sd-panel>A.</sd-panel>",
         source: "sdapi",
-        href: "https://api.sourcedata.io/file.php?figure_id=28356",
-        fig_label: "Figure 6",
+        href: "https://api.sourcedata.io/file.php?figure_id=28357",
+        fig_label: "Figure 8",
         fig_title: ""
                 })
         CREATE (panel1:SDPanel {
-        id: 9594,
+        id: 9595,
         panel_id: "77017",
         paper_doi: "10.15252/embr.201948896",
         fig_label: "Figure 4",
@@ -211,12 +157,38 @@ class TestCollection(unittest.TestCase):
         href: "https://api.sourcedata.io/file.php?panel_id=77017",
         coords: "topleft_x=8, topleft_y=683, bottomright_x=1011, bottomright_y=1066"
         })
+        CREATE (panel2:SDPanel {
+        id: 9596,
+        panel_id: "77018",
+        paper_doi: "10.15252/embr.201948896",
+        fig_label: "Figure 8",
+        panel_label: "Figure 8-A",
+        caption: "<sd-panel>A. <sd-tag id='sdTag412'>actin</sd-tag></sd-panel>",
+        source: "sdapi",
+        href: "https://api.sourcedata.io/file.php?panel_id=77018",
+        coords: ""
+        })
         CREATE (tag1:SDTag {
-            id: 409,
-            tag_id: "sdTag409",
+            id: 410,
+            tag_id: "410",
+            role: "intervention",
+            ext_urls: "",
+            text: "myoA",
+            category: "entity",
+            type: "gene",
+            source: "sdapi",
+            ext_ids: "",
+            ext_tsx_ids: "",
+            ext_dbs: "",
+            ext_names: "",
+            in_caption: true
+        })
+        CREATE (tag2:SDTag {
+            id: 412,
+            tag_id: "412",
             role: "assayed",
             ext_urls: "",
-            text: "Z-stack",
+            text: "actin",
             category: "entity",
             type: "protein",
             source: "sdapi",
@@ -228,21 +200,88 @@ class TestCollection(unittest.TestCase):
         })
 
         CREATE
-        (test)-[:has_article]->(article),
-        (article)-[:has_figure]->(figure1),
-        (article)-[:has_figure]->(figure2),
-        (article)-[:has_figure]->(figure3),
         (article)-[:has_figure]->(figure4),
-        (article)-[:has_figure]->(figure5),
-        (article)-[:has_figure]->(figure6),
-        (article)-[:has_figure]->(figure7),
+        (article)-[:has_figure]->(figure8),
         (figure4)-[:has_panel]->(panel1),
-        (panel1)-[:has_tag]->(tag1);
+        (figure8)-[:has_panel]->(panel2),
+        (panel1)-[:has_tag]->(tag1),
+        (panel2)-[:has_tag]->(tag2);
 
         """
-        GRAPH.run(query)
+
+
+class TestCollection(unittest.TestCase):
+
+    def test_from_neo_collection(self):
+        """Test the from_neo method."""
+
+        # connect to our neo4j database
+        GRAPH = Graph(NEO_URI, auth=(NEO_USERNAME, NEO_PASSWORD))
+
+        GRAPH.run(TEST_GRAPH)
+        collection = Collection(auto_save=True, is_test=True)
+        collection.from_neo(collection_name="PUBLICSEARCH")
+        self.assertTrue(collection.props.collection_name == "PUBLICSEARCH")  # type: ignore
+        shutil.rmtree("/app/xml_destination_files", ignore_errors=True)
+        GRAPH.run("MATCH (n) DETACH DELETE n")
+
+    def test_from_neo_article(self):
+        """Test the from_neo method."""
+        GRAPH = Graph(NEO_URI, auth=(NEO_USERNAME, NEO_PASSWORD))
+
+        GRAPH.run(TEST_GRAPH)
         article = Article(auto_save=True)
         article.from_neo(collection_id="PUBLICSEARCH", doi="10.15252/embr.201948896")
         self.assertEqual(article.props.title, "Apicomplexan F-actin is required for efficient nuclear entry during host cell invasion")
 
         GRAPH.run("MATCH (n) DETACH DELETE n")
+
+    def test_from_neo_article_subtree(self):
+        """Test that the single query subtree fetch builds the same article as from_neo."""
+        GRAPH = Graph(NEO_URI, auth=(NEO_USERNAME, NEO_PASSWORD))
+        GRAPH.run(TEST_GRAPH)
+        article = Article(auto_save=False)
+        article.from_neo(collection_id="PUBLICSEARCH", doi="10.15252/embr.201948896")
+        article_subtree = Article(auto_save=False)
+        article_subtree.from_neo_subtree(collection_id="PUBLICSEARCH", doi="10.15252/embr.201948896")
+        self.assertEqual(str(article_subtree), str(article))
+        self.assertEqual(
+            tostring(article_subtree.XML_SERIALIZER.generate_article(article_subtree)),
+            tostring(article.XML_SERIALIZER.generate_article(article)),
+        )
+
+        GRAPH.run("MATCH (n) DETACH DELETE n")
+
+    def test_from_neo_article_subtree_duplicate(self):
+        """Test that the subtree fetch matches from_neo with an article node outside the collection."""
+        GRAPH = Graph(NEO_URI, auth=(NEO_USERNAME, NEO_PASSWORD))
+        GRAPH.run(TEST_GRAPH)
+        GRAPH.run(DUPLICATE_ARTICLE)
+        article = Article(auto_save=False)
+        article.from_neo(collection_id="PUBLICSEARCH", doi="10.15252/embr.201948896")
+        article_subtree = Article(auto_save=False)
+        article_subtree.from_neo_subtree(collection_id="PUBLICSEARCH", doi="10.15252/embr.201948896")
+        figures = [rel.target for rel in article_subtree.relationships]
+        self.assertEqual([fig.props.figure_label for fig in figures], ["Figure 4"])
+        panels = [rel.target for rel in figures[0].relationships]
+        self.assertEqual([p.props.panel_id for p in panels], ["77017"])
+        self.assertEqual(len(panels[0].relationships), 2)
+        self.assertEqual(str(article_subtree), str(article))
+        self.assertEqual(
+            tostring(article_subtree.XML_SERIALIZER.generate_article(article_subtree)),
+            tostring(article.XML_SERIALIZER.generate_article(article)),
+        )
+
+        GRAPH.run("MATCH (n) DETACH DELETE n")
+
+    def test_from_neo_collection_batches(self):
+        """Test that batched subtree fetching builds the same collection as from_neo."""
+        GRAPH = Graph(NEO_URI, auth=(NEO_USERNAME, NEO_PASSWORD))
+        GRAPH.run(TEST_GRAPH)
+        collection = Collection(auto_save=False, is_test=True)
+        collection.from_neo(collection_name="PUBLICSEARCH")
+        collection_batches = Collection(auto_save=False, is_test=True)
+        collection_batches.from_neo(collection_name="PUBLICSEARCH", batch_size=2)
+        self.assertEqual(str(collection_batches), str(collection))
+
+        GRAPH.run("MATCH (n) DETACH DELETE n")
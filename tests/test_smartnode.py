@@ -51,6 +51,23 @@ class TestCollection(unittest.TestCase):
             [{"collection_id": "97", "name": "PUBLICSEARCH"}],
         )
 
+    def test_load_articles_workers(self):
+        """Articles are returned in order and a failing DOI does not stop the export."""
+        def load(batch):
+            if "bad" in batch:
+                raise RuntimeError("boom")
+            return [Article() for _ in batch]
+
+        collection = Collection(auto_save=False)
+        batches = [["a"], ["bad"], ["b", "c"], ["d"]]
+        serial = collection._load_articles(load, batches, workers=1)
+        parallel = collection._load_articles(load, batches, workers=3)
+        self.assertEqual(len(serial), 4)
+        self.assertEqual(len(parallel), 4)
+
+        order = collection._load_articles(lambda batch: batch, batches, workers=3)  # type: ignore
+        self.assertEqual(order, ["a", "bad", "b", "c", "d"])
+
 
 class TestArticle(unittest.TestCase):
 
@@ -121,6 +138,53 @@ class TestArticle(unittest.TestCase):
         )
         shutil.rmtree("/app/xml_destination_files", ignore_errors=True)
 
+    def test_from_neo_subtree_merge(self):
+        """Records of duplicated article nodes are merged like the per node queries do."""
+        def panel(panel_id, number, tag_ids):
+            return {
+                "paper_doi": "10.1/x", "figure_label": "Fig 1", "figure_id": "Fig 1", "panel_id": panel_id,
+                "panel_label": f"Fig 1-{number}", "panel_number": number, "caption": "", "formatted_caption": "",
+                "href": "", "coords": "", "tag_id_list": [{"tag_id": t, "text": f"t{t}"} for t in tag_ids],
+            }
+
+        def figure(label, captioned, panels):
+            return {
+                "paper_doi": "10.1/x", "figure_label": label, "figure_id": "1", "figure_title": "",
+                "href": "", "captioned": captioned, "panel_list": panels,
+            }
+
+        properties = {
+            "doi": "10.1/x", "title": "", "journal_name": "", "pub_date": "", "pmid": "", "pmcid": "",
+            "import_id": "", "pub_year": "", "nb_figures": 2,
+        }
+        subtrees = [
+            # an article node with the DOI outside the collection
+            {
+                **properties, "title": "outside", "in_collection": False,
+                "figure_list": [figure("Fig 1", False, [panel("p1", "A", ["5"]), panel("p3", "C", ["4"])]),
+                                figure("Fig 3", True, [panel("p4", "A", ["6"])])],
+            },
+            {
+                **properties, "in_collection": True,
+                "figure_list": [figure("Fig 1", False, [panel("p1", "A", ["2"])]), figure("Fig 2", False, [])],
+            },
+            {
+                **properties, "in_collection": True,
+                "figure_list": [figure("Fig 1", True, [panel("p2", "B", ["3"]), panel("p1", "A", ["10", "1"])])],
+            },
+        ]
+        article = Article(auto_save=False)._from_neo_subtree(subtrees, abstract="")
+        self.assertEqual(article.props.title, "")
+        figures = [rel.target for rel in article.relationships]
+        # Fig 2 has no captioned figure node and Fig 3 is only captioned outside the collection;
+        # the panels of the uncaptioned Fig 1 are kept
+        self.assertEqual([fig.props.figure_label for fig in figures], ["Fig 1"])
+        panels = [rel.target for rel in figures[0].relationships]
+        # the panels come from the collection, their tags from every article node
+        self.assertEqual([p.props.panel_id for p in panels], ["p1", "p2"])
+        tags = [rel.target.props.tag_id for rel in panels[0].relationships]
+        self.assertEqual(tags, ["1", "2", "5", "10"])
+
 
 class TestFigure(unittest.TestCase):
     def test_empty_doi(self):